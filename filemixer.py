@@ -16,16 +16,14 @@ def main(args):
         with Output(mixer.samplerate, mixer.samplewidth, mixer.nchannels) as output:
             levelmeter = LevelMeter(rms_mode=False, lowest=-50)
             temp_stream = AudiofileToWavStream("samples/909_crash.wav", hqresample=hqresample)
+            crash_sample = Sample("samples/909_crash.wav").normalize()
+            mixer.schedule_at(mixer.frame_at(5.0), lambda: mixer.add_stream(temp_stream))
+            mixer.schedule_at(mixer.frame_at(10.0), lambda: mixer.add_sample(crash_sample))
             for timestamp, sample in mixed_samples:
                 levelmeter.update(sample)
                 output.play_sample(sample)
                 time.sleep(sample.duration*0.4)
                 levelmeter.print(bar_width=60)
-                if 5.0 <= timestamp <= 5.1:
-                    mixer.add_stream(temp_stream)
-                if 10.0 <= timestamp <= 10.1:
-                    sample = Sample("samples/909_crash.wav").normalize()
-                    mixer.add_sample(sample)
     print("done.")
 
 
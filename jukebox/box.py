@@ -10,36 +10,97 @@ import time
 import os
 import subprocess
 import datetime
+import threading
 import tkinter as tk
 import tkinter.ttk as ttk
 import tkinter.font
 import tkinter.messagebox
 import tkinter.filedialog
 from .backend import BACKEND_PORT
-from synthesizer.streaming import AudiofileToWavStream, StreamMixer, VolumeFilter
-from synthesizer.sample import Sample, Output, LevelMeter
+from .musicfiledb import FormatProbeDatabase
+from synthesizer.streaming import AudiofileToWavStream, StreamMixer, GainRampFilter, PrefetchedWavStream
+from synthesizer.sample import Sample, Output, LevelMeter, BufferSizeController
 import Pyro4
 import Pyro4.errors
 import Pyro4.futures
 
-StreamMixer.buffer_size = 4096      # larger is less skips and less cpu usage but more latency and slower meters
-hqresample = AudiofileToWavStream.supports_hq_resample()
-if not hqresample:
-    print("WARNING: ffmpeg isn't compiled with libsoxr, so hq resampling is not supported.")
+StreamMixer.buffer_size = 4096      # the block size the streams are read in; the player adapts the mixing block size itself
+StreamMixer.readahead = 8           # buffers decoded ahead per track in a background thread, so ffmpeg stalls don't cause skips
+
+
+class DecoderPool:
+    """
+    Starts decoding the upcoming tracks of the playlist in advance, so that a deck that needs its
+    next track doesn't have to wait for ffprobe and ffmpeg to start up (or for a disk to spin up).
+    The start of every upcoming track is buffered (in memory, or in a temp file when it gets large).
+    """
+    size = 2                # how many upcoming tracks to decode in advance
+    prefetch_seconds = 20   # how much of each track to buffer
+
+    def __init__(self):
+        self.decoders = {}      # filename -> PrefetchedWavStream, or None while it is being started
+        self.lock = threading.Lock()
+
+    def prepare(self, filenames):
+        """Start decoding the given files, and stop decoding files that are no longer upcoming."""
+        filenames = filenames[:self.size]
+        with self.lock:
+            stale = [self.decoders.pop(f) for f in list(self.decoders) if f not in filenames]
+            new = [f for f in filenames if f not in self.decoders]
+            for filename in new:
+                self.decoders[filename] = None
+        for stream in stale:
+            if stream:
+                stream.close()
+        for filename in new:
+            Pyro4.futures.Future(self._start_decoder)(filename)
+
+    def _start_decoder(self, filename):
+        try:
+            stream = AudiofileToWavStream(filename, hqresample=AudiofileToWavStream.supports_hq_resample())
+        except Exception as x:
+            print("Can't decode upcoming track:", x)
+            with self.lock:
+                self.decoders.pop(filename, None)
+            return
+        prefetch_size = self.prefetch_seconds * Sample.norm_samplerate * Sample.norm_samplewidth * Sample.norm_nchannels
+        stream = PrefetchedWavStream(stream, prefetch_size)
+        with self.lock:
+            if filename in self.decoders and self.decoders[filename] is None:
+                self.decoders[filename] = stream
+                return
+        stream.close()  # the track was taken or removed from the playlist in the meantime
+
+    def take(self, filename):
+        """Returns the decoded stream for the file, or None if it isn't available (yet)."""
+        with self.lock:
+            return self.decoders.pop(filename, None)
+
+    def close(self):
+        with self.lock:
+            streams = list(self.decoders.values())
+            self.decoders.clear()
+        for stream in streams:
+            if stream:
+                stream.close()
 
 
 class Player:
-    async_queue_size = 3     # larger is less chance of getting skips, but latency increases
+    min_buffer_time = 0.1    # seconds of audio queued for output; it grows automatically when skips occur
+    latency_ceiling = 1.0    # ...but never beyond this
     update_rate = 40         # larger is less cpu usage but more chance of getting skips
     levelmeter_lowest = -40  # dB
 
     def __init__(self, app):
         self.app = app
+        if not AudiofileToWavStream.supports_hq_resample():
+            print("WARNING: ffmpeg isn't compiled with libsoxr, so hq resampling is not supported.")
         self.app.after(self.update_rate, self.tick)
         self.app.firstTrackFrame.play()
         self.stopping = False
         self.mixer = StreamMixer([], endless=True)
-        self.output = Output(self.mixer.samplerate, self.mixer.samplewidth, self.mixer.nchannels, queuesize=self.async_queue_size)
+        self.output = Output(self.mixer.samplerate, self.mixer.samplewidth, self.mixer.nchannels)
+        self.buffering = BufferSizeController(self.output, self.min_buffer_time, self.latency_ceiling)
         self.mixed_samples = iter(self.mixer)
         self.levelmeter = LevelMeter(rms_mode=False, lowest=self.levelmeter_lowest)
 
@@ -50,17 +111,23 @@ class Player:
         self.mixer.close()
         self.output.close()
 
-    def switch_player(self):
+    def switch_player(self, stopping_track):
         """
-        The actual switching of the main track player. Note that it can be playing
+        The actual switching of the main track player. Note that the other one can be playing
         already because of the fade-in mixing.
         """
-        first_is_playing = self.app.firstTrackFrame.playing
-        self.app.firstTrackFrame.play(not first_is_playing)
-        self.app.secondTrackFrame.play(first_is_playing)
+        stopping_track.play(False)
+        self.other_track(stopping_track).play(True)
+
+    def other_track(self, track):
+        if track is self.app.firstTrackFrame:
+            return self.app.secondTrackFrame
+        return self.app.firstTrackFrame
 
     def tick(self):
-        if self.output.queue_size() <= self.async_queue_size/2:
+        buffer_time = self.buffering.update()
+        if self.output.queued_frames() <= buffer_time * self.mixer.samplerate:
+            self.mixer.buffer_size = self.buffering.block_frames(self.mixer.samplerate)
             self.app.firstTrackFrame.tick(self.mixer)
             self.app.secondTrackFrame.tick(self.mixer)
             _, sample = next(self.mixed_samples)
@@ -78,13 +145,13 @@ class Player:
         if sample and sample.duration > 0:
             self.mixer.add_sample(sample)
 
-    def start_play_other(self):
-        # @todo fix the track switching and fadein/fadeout, it's a bit of a mess
-        if self.app.firstTrackFrame.playing:
-            other_track = self.app.secondTrackFrame
-        else:
-            other_track = self.app.firstTrackFrame
-        other_track.start_fadein()
+    def start_play_other(self, fading_track):
+        self.other_track(fading_track).start_fadein()
+
+    def crossfade_to(self, track):
+        """Let the mixer crossfade from the other track's stream to the given track's (new) stream."""
+        from_stream = self.other_track(track).sample_stream
+        self.mixer.crossfade(from_stream, track.sample_stream, TrackFrame.crossfade_time)
 
 
 class TrackFrame(ttk.LabelFrame):
@@ -103,8 +170,9 @@ class TrackFrame(ttk.LabelFrame):
         self.stream = None
         self.stream_started = 0
         self.stream_opened = False
+        self.sample_stream = None
         self.volumeVar = tk.DoubleVar(value=100)
-        self.volumefilter = VolumeFilter()
+        self.volumefilter = GainRampFilter()
         self.fadeout = None
         self.fadein = None
         ttk.Label(self, text="title / artist / album").pack()
@@ -138,7 +206,7 @@ class TrackFrame(ttk.LabelFrame):
 
     def skip(self):
         if self.playing:
-            self.app.switch_player()
+            self.app.switch_player(self)
         self.close_stream()
         self.titleLabel["text"] = ""
         self.artistLabel["text"] = ""
@@ -169,18 +237,12 @@ class TrackFrame(ttk.LabelFrame):
                 else:
                     status = " PLAYING "
                 self.stateLabel["text"] = dotsl+status+dotsr
-                if self.fadeout:
-                    self.volumeVar.set(self.fadeout*remaining/self.crossfade_time)
-                    self.on_volumechange(self.volumeVar.get())
-                elif remaining <= self.crossfade_time < self.current_track_duration:
-                    self.fadeout = self.volumeVar.get()
-                    self.app.start_playing_other()
-                if self.fadein:
-                    if stream_time >= self.crossfade_time:
-                        self.fadein = None
-                    else:
-                        self.volumeVar.set(100*stream_time/self.crossfade_time)
-                        self.on_volumechange(self.volumeVar.get())
+                # the crossfade itself is done by the mixer, here we only start it and keep track of the state
+                if not self.fadeout and remaining <= self.crossfade_time < self.current_track_duration:
+                    self.fadeout = True
+                    self.app.start_playing_other(self)
+                if self.fadein and stream_time >= self.crossfade_time:
+                    self.fadein = None
                 if self.stream.closed:
                     # Stream is closed, probably exhausted. Skip to other track.
                     self.skip()
@@ -191,10 +253,15 @@ class TrackFrame(ttk.LabelFrame):
                 Pyro4.futures.Future(self.start_stream)(mixer)
 
     def start_stream(self, mixer):
-        self.stream = AudiofileToWavStream(self.current_track_filename, hqresample=hqresample)
+        self.stream = self.app.decoders.take(self.current_track_filename) or \
+            AudiofileToWavStream(self.current_track_filename, hqresample=AudiofileToWavStream.supports_hq_resample())
         self.stream_started = time.time()
         self.after_idle(lambda s=self: s.set_state(s.state_playing))
-        mixer.add_stream(self.stream, [self.volumefilter])
+        if self.fadein:
+            self.sample_stream = mixer.open_stream(self.stream, [self.volumefilter])
+            self.app.player.crossfade_to(self)
+        else:
+            self.sample_stream = mixer.add_stream(self.stream, [self.volumefilter])
         if self.stream.format_probe and self.stream.format_probe.duration and not self.current_track_duration:
             # get the duration from the stream itself
             self.current_track_duration = self.stream.format_probe.duration
@@ -207,12 +274,14 @@ class TrackFrame(ttk.LabelFrame):
         if self.stream_opened:
             self.stream.close()
             self.stream = None
+            self.sample_stream = None
             self.stream_opened = False
 
     def next_track(self, hashcode):
         if self.stream_opened:
             self.stream.close()
             self.stream = None
+            self.sample_stream = None
             self.stream_opened = False
         self.current_track = hashcode
         track = self.app.backend.track(hashcode=self.current_track)
@@ -237,8 +306,7 @@ class TrackFrame(ttk.LabelFrame):
     def start_fadein(self):
         if self.current_track_duration <= self.crossfade_time:
             return
-        self.volumereset(0)
-        self.fadein = self.crossfade_time
+        self.fadein = True
         self.playing = True
 
     def set_state(self, state):
@@ -329,6 +397,11 @@ class PlaylistFrame(ttk.LabelFrame):
             return self.listTree.item(items[0], "values")[4]
         return None
 
+    def peek_locations(self, amount):
+        """The file locations of the first few tracks in the playlist."""
+        items = self.listTree.get_children()[:amount]
+        return [self.listTree.item(item, "values")[5] for item in items]
+
     def do_to_top(self):
         sel = self.listTree.selection()
         if sel:
@@ -360,7 +433,8 @@ class PlaylistFrame(ttk.LabelFrame):
             track["artist"] or '-',
             track["album"] or '-',
             datetime.timedelta(seconds=int(track["duration"])),
-            track["hash"]])
+            track["hash"],
+            track["location"]])
 
 
 class SearchFrame(ttk.LabelFrame):
@@ -472,7 +546,7 @@ class JingleFrame(ttk.LabelFrame):
         if shift:
             filename = tkinter.filedialog.askopenfilename()
             if filename:
-                with AudiofileToWavStream(filename, hqresample=hqresample) as wav:
+                with AudiofileToWavStream(filename, hqresample=AudiofileToWavStream.supports_hq_resample()) as wav:
                     sample = Sample(wav)
                     self.jingles[event.widget.jingle_nr] = sample
                 event.widget["state"] = tk.NORMAL
@@ -513,14 +587,19 @@ class JukeboxGui(tk.Tk):
         self.statusbar = ttk.Label(f, text="<status>", relief=tk.GROOVE, anchor=tk.CENTER)
         self.statusbar.pack(fill=tk.X, expand=True)
         f.pack()
+        self.probe_cache = AudiofileToWavStream.probe_cache = FormatProbeDatabase()     # don't run ffprobe again for files played before
+        self.decoders = DecoderPool()
         self.player = Player(self)
         self.backend = None
         self.backend_process = None
         self.show_status("Connecting to backend file service...")
         self.after(500, self.connect_backend)
+        self.after(1000, self.prepare_upcoming_tracks)
 
     def destroy(self):
         self.player.stop()
+        self.decoders.close()
+        self.probe_cache.close()
         super().destroy()
         if self.backend_process:
             print("\n")
@@ -565,8 +644,16 @@ class JukeboxGui(tk.Tk):
             return self.playlistFrame.peek()
         return self.playlistFrame.pop()
 
-    def switch_player(self):
-        self.player.switch_player()
+    def prepare_upcoming_tracks(self):
+        # the tracks that are loaded in a deck but haven't started yet come first, then the playlist
+        upcoming = [deck.current_track_filename for deck in (self.firstTrackFrame, self.secondTrackFrame)
+                    if deck.current_track and not deck.stream]
+        upcoming.extend(self.playlistFrame.peek_locations(DecoderPool.size))
+        self.decoders.prepare(upcoming)
+        self.after(1000, self.prepare_upcoming_tracks)
+
+    def switch_player(self, stopping_track):
+        self.player.switch_player(stopping_track)
 
     def update_levels(self, left, right):
         self.after_idle(lambda: self.levelmeterFrame.update_meters(left, right))
@@ -574,8 +661,8 @@ class JukeboxGui(tk.Tk):
     def play_sample(self, sample):
         self.player.play_sample(sample)
 
-    def start_playing_other(self):
-        self.player.start_play_other()
+    def start_playing_other(self, fading_track):
+        self.player.start_play_other(fading_track)
 
 
 if __name__ == "__main__":
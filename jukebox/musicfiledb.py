@@ -15,21 +15,25 @@ import urllib.parse
 import urllib.request
 import sqlite3
 import os
+import threading
 import tinytag
 import appdirs
 from tqdm import tqdm
+from synthesizer.probecache import FormatProbeCache, AudioFormatProbe
 
 
-__all__ = ["MusicFileDatabase", "Track"]
+__all__ = ["MusicFileDatabase", "Track", "FormatProbeDatabase"]
+
+
+def default_dbfile():
+    dblocation = appdirs.user_data_dir("PythonJukebox", "Razorvine")
+    os.makedirs(dblocation, mode=0o700, exist_ok=True)
+    return os.path.join(dblocation, "tracks.sqlite")
 
 
 class MusicFileDatabase:
     def __init__(self, dbfile=None, scan_changes=True, silent=False):
-        if not dbfile:
-            dblocation = appdirs.user_data_dir("PythonJukebox", "Razorvine")
-            os.makedirs(dblocation, mode=0o700, exist_ok=True)
-            dbfile = os.path.join(dblocation, "tracks.sqlite")
-        dbfile = os.path.abspath(dbfile)
+        dbfile = os.path.abspath(dbfile or default_dbfile())
         self.dbfile = dbfile
         self.dbconn = sqlite3.connect(dbfile, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
         self.dbconn.row_factory = sqlite3.Row   # make sure we can get results by column name
@@ -248,6 +252,64 @@ class MusicFileDatabase:
                 self.dbconn.execute("DELETE FROM tracks WHERE id=?", (track_id,))
 
 
+class FormatProbeDatabase(FormatProbeCache):
+    """
+    Probe cache that stores the audio format probes in the format_probes table of the track database,
+    so a file only has to be probed by ffprobe once (until it is changed).
+    The connection is shared between threads because streams are opened from background threads.
+    The database is also used by the backend. If it can't be used (it's locked for instance),
+    the probe is simply not cached: a cache problem must never keep a track from playing.
+    """
+    timeout = 0.5   # seconds to wait for a lock on the database
+
+    def __init__(self, dbfile=None):
+        super().__init__()
+        self.dbfile = os.path.abspath(dbfile or default_dbfile())
+        self.dbconn = sqlite3.connect(self.dbfile, timeout=self.timeout, check_same_thread=False)
+        self.dblock = threading.Lock()
+        try:
+            with self.dblock:
+                self.dbconn.execute("""CREATE TABLE IF NOT EXISTS format_probes
+                    (
+                        location nvarchar(500) NOT NULL,
+                        size int NOT NULL,
+                        modified real NOT NULL,
+                        rate int,
+                        channels int,
+                        sampformat varchar(20),
+                        fileformat varchar(100),
+                        duration real,
+                        PRIMARY KEY (location, size, modified)
+                    );""")
+                self.dbconn.commit()
+        except sqlite3.Error as x:
+            print("format probe cache database unavailable:", x)
+
+    def close(self):
+        with self.dblock:
+            self.dbconn.close()
+
+    def load(self, key):
+        try:
+            with self.dblock:
+                probe = self.dbconn.execute("SELECT rate, channels, sampformat, fileformat, duration FROM format_probes "
+                                            "WHERE location=? AND size=? AND modified=?", key).fetchone()
+        except sqlite3.Error:
+            return None
+        return AudioFormatProbe(*probe) if probe else None
+
+    def store(self, key, probe):
+        with self.dblock:
+            try:
+                # older probes of the same file are stale now
+                self.dbconn.execute("DELETE FROM format_probes WHERE location=?", (key[0],))
+                self.dbconn.execute("INSERT INTO format_probes(location, size, modified, rate, channels, sampformat, fileformat, duration) "
+                                    "VALUES (?,?,?,?,?,?,?,?)", key + tuple(probe))
+                self.dbconn.commit()
+            except sqlite3.Error:
+                self.dbconn.rollback()      # the probe is still cached in memory
+
+
 class Track:
     def __init__(self, trackid, title, artist, album, year, genre, duration, modified, location):
         self.id = trackid
@@ -482,6 +482,24 @@ def chords():
             out.play_sample(s)
 
 
+def polyphony():
+    from synthesizer.voices import VoiceEngine   # requires numpy
+    engine = VoiceEngine(voices=16, waveform="sawtooth", amplitude=0.06, attack=0.02, decay=0.2, sustain_level=0.6, release=0.8)
+    blocks = engine.blocks()
+    with Output(nchannels=1) as out:
+        for rootnote in octave_notes:
+            chord_keys = major_chord_keys(rootnote, 3)
+            print("chord", rootnote, ["{0} {1}".format(note, octave) for note, octave in chord_keys])
+            for note, octave in chord_keys:
+                engine.note_on(notes[octave][note], key=(note, octave))
+            # the chord rings on while the next one starts
+            for _ in range(16):
+                out.play_sample(next(blocks))
+            engine.all_notes_off()
+        for _ in range(40):
+            out.play_sample(next(blocks))
+
+
 if __name__ == "__main__":
     harmonics()
     osc_bench()
@@ -503,3 +521,4 @@ if __name__ == "__main__":
     stereo_pan()
     vibrato()
     chords()
+    polyphony()
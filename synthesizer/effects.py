@@ -0,0 +1,516 @@
+"""
+Declarative effect chains for samples and sample streams.
+You describe the effects once, as a chain of effect stages, and render it onto samples (or use it as
+a filter on a SampleStream). Consecutive stages that only change the volume of the sound (gain, fades,
+envelopes, panning) are fused: their gain curves are multiplied together and applied in a single pass
+over the sample data, in blocks that fit in the cpu cache. A chain can be reused for any number of samples.
+Requires numpy.
+
+Written by Irmen de Jong (irmen@razorvine.net) - License: MIT open-source.
+"""
+
+import bisect
+import itertools
+import numpy
+from .sample import Sample
+
+
+__all__ = ["EffectChain", "Effect", "Gain", "Fade", "Envelope", "Pan", "Echo", "ConvolutionReverb", "Biquad"]
+
+
+class Effect:
+    """
+    Base class for the stages of an effect chain.
+    Gain effects (fusable = True) only provide the gain curve for a range of frames (see gains),
+    the chain itself applies it. Other effects process the sample values themselves (see process).
+    """
+    fusable = False
+
+    def set_params(self, samplerate, nchannels, length):
+        """Called before rendering. The length is in frames, or None if it's unknown (for streams)."""
+        self.samplerate = samplerate
+        self.length = length
+
+    def output_channels(self, nchannels):
+        """The number of channels the effect produces for input with the given number of channels."""
+        return nchannels
+
+    def gains(self, start, nframes):
+        """
+        Returns the gain for the frames start...start+nframes: a single value, an array of shape (nframes, 1),
+        or an array of shape (nframes, 2) with a different gain for the left and right channels.
+        The base class leaves the sample values as they are (unity gain).
+        """
+        return 1.0
+
+    def process(self, values, start):
+        """Processes the block of sample values (shape (frames, channels)) that starts at the given frame."""
+        return values * self.gains(start, len(values))
+
+    def frames(self, seconds):
+        return int(seconds * self.samplerate)
+
+    @staticmethod
+    def curve(points, start, nframes):
+        """
+        Evaluates a piecewise linear curve, given as (frame, gain) points, for the frames start...start+nframes.
+        Before the first and after the last point the curve is flat.
+        If the curve is flat for all of these frames, just that single gain value is returned.
+        """
+        xp, fp = [], []
+        for x, y in points:
+            if xp and x <= xp[-1]:
+                # a point at the same position makes the curve jump to the new value right there
+                x = xp[-1] + 1e-9
+            xp.append(x)
+            fp.append(y)
+        first = bisect.bisect_right(xp, start)
+        last = bisect.bisect_left(xp, start + nframes - 1)
+        if first >= last and fp[max(first - 1, 0)] == fp[min(last, len(fp) - 1)]:
+            return fp[min(last, len(fp) - 1)]
+        positions = numpy.arange(start, start + nframes, dtype=float)
+        return numpy.interp(positions, xp, fp)[:, numpy.newaxis]
+
+
+class Gain(Effect):
+    """Amplifies the sound by a fixed factor."""
+    fusable = True
+
+    def __init__(self, gain):
+        self.gain = gain
+
+    def gains(self, start, nframes):
+        return self.gain
+
+
+class Fade(Effect):
+    """
+    Fades in from start_volume during the first fadein seconds, and fades out to target_volume
+    in the last fadeout seconds (the fade out requires the length of the sound to be known).
+    """
+    fusable = True
+
+    def __init__(self, fadein=0.0, fadeout=0.0, start_volume=0.0, target_volume=0.0):
+        assert fadein >= 0 and fadeout >= 0
+        self.fadein = fadein
+        self.fadeout = fadeout
+        self.start_volume = start_volume
+        self.target_volume = target_volume
+
+    def gains(self, start, nframes):
+        points = [(0, self.start_volume if self.fadein else 1.0)]
+        if self.fadein:
+            points.append((self.frames(self.fadein), 1.0))
+        if self.fadeout and self.length is not None:
+            points.append((max(0, self.length - self.frames(self.fadeout)), 1.0))
+            points.append((self.length, self.target_volume))
+        return self.curve(points, start, nframes)
+
+
+class Envelope(Effect):
+    """
+    ADSR volume envelope, like Sample.envelope. A,D,R are in seconds, the sustain level is a factor.
+    The release is at the end of the sound; for streams of unknown length the sustain level is held.
+    """
+    fusable = True
+
+    def __init__(self, attack, decay, sustainlevel, release):
+        assert attack >= 0 and decay >= 0 and release >= 0
+        assert 0 <= sustainlevel <= 1
+        self.attack = attack
+        self.decay = decay
+        self.sustainlevel = sustainlevel
+        self.release = release
+
+    def gains(self, start, nframes):
+        attack = self.frames(self.attack)
+        decay_end = attack + self.frames(self.decay)
+        points = [(0, 0.0 if attack else 1.0), (attack, 1.0), (decay_end, self.sustainlevel)]
+        if self.length is not None:
+            release_start = max(decay_end, self.length - self.frames(self.release))
+            points.append((release_start, self.sustainlevel))
+            points.append((self.length, 0.0 if self.release else self.sustainlevel))
+        return self.curve(points, start, nframes)
+
+
+class Pan(Effect):
+    """
+    Linear stereo panning, -1 = full left, 1 = full right, like Sample.pan.
+    If you provide a LFO (an oscillator, or an array with a panning value for every frame) that is used instead.
+    Mono sound becomes stereo.
+    """
+    fusable = True
+
+    def __init__(self, panning=0.0, lfo=None):
+        self.panning = panning
+        self.lfo = lfo
+
+    def set_params(self, samplerate, nchannels, length):
+        super().set_params(samplerate, nchannels, length)
+        if self.lfo is not None and not isinstance(self.lfo, numpy.ndarray):
+            self.lfo_values = iter(self.lfo)
+
+    def output_channels(self, nchannels):
+        return 2
+
+    def gains(self, start, nframes):
+        if self.lfo is None:
+            return numpy.array([[(1 - self.panning) / 2, (1 + self.panning) / 2]])
+        if isinstance(self.lfo, numpy.ndarray):
+            panning = self.lfo[start:start + nframes]
+            if len(panning) < nframes:
+                # after the end of the lfo array, its last value is kept
+                panning = numpy.concatenate((panning, numpy.full(nframes - len(panning), self.lfo[-1])))
+        else:
+            panning = numpy.fromiter(itertools.islice(self.lfo_values, nframes), dtype=float, count=nframes)
+        gains = numpy.empty((nframes, 2))
+        gains[:, 0] = 1 - panning
+        gains[:, 1] = 1 + panning
+        gains *= 0.5
+        return gains
+
+
+class FusedGains(Effect):
+    """A group of consecutive gain effects that the chain applies as one, block by block."""
+    def __init__(self, effects):
+        self.effects = effects
+
+    def set_params(self, samplerate, nchannels, length):
+        for effect in self.effects:
+            effect.set_params(samplerate, nchannels, length)
+            nchannels = effect.output_channels(nchannels)
+
+    def output_channels(self, nchannels):
+        for effect in self.effects:
+            nchannels = effect.output_channels(nchannels)
+        return nchannels
+
+    def process_into(self, values, start, output):
+        gains = self.effects[0].gains(start, len(values))
+        for effect in self.effects[1:]:
+            gains = gains * effect.gains(start, len(values))
+        numpy.multiply(values, gains, out=output)
+
+
+class EffectChain:
+    """
+    A chain of effects (see Effect) that can be rendered onto samples, or used as a SampleStream filter.
+    Consecutive gain effects are fused and applied in one pass, block_frames at a time.
+    When used as a stream filter, effects at the end of the sound (fade out, release) need the duration
+    of the stream in seconds; for streams of unknown length leave it None and those are not applied.
+    """
+    block_frames = 16384
+
+    def __init__(self, *effects, duration=None):
+        self.effects = list(effects)
+        self.duration = duration
+        self.stages = []
+        for effect in self.effects:
+            if effect.fusable and self.stages and isinstance(self.stages[-1], FusedGains):
+                self.stages[-1].effects.append(effect)
+            elif effect.fusable:
+                self.stages.append(FusedGains([effect]))
+            else:
+                self.stages.append(effect)
+        self.position = 0
+
+    def render(self, sample):
+        """Returns a new sample with the effects applied to the given sample (which is left untouched)."""
+        self.prepare(sample.samplerate, sample.nchannels, len(sample))
+        result = Sample.from_raw_frames(b"", sample.samplewidth, sample.samplerate, sample.nchannels, sample.is_float)
+        return result.set_frames_numpy(self.process(sample.get_frames_numpy(), sample.is_float))
+
+    def prepare(self, samplerate, nchannels, length):
+        """Prepares the chain for a sound with the given properties (length in frames or None)."""
+        for stage in self.stages:
+            stage.set_params(samplerate, nchannels, length)
+            nchannels = stage.output_channels(nchannels)
+        self.position = 0
+
+    def process(self, values, is_float):
+        """Processes the next block of sample values (shape (frames, channels)), returns the result values."""
+        start = self.position
+        self.position += len(values)
+        for stage in self.stages:
+            if isinstance(stage, FusedGains):
+                nchannels = stage.output_channels(values.shape[1])
+                output = numpy.empty((len(values), nchannels), dtype=numpy.float32 if is_float else float)
+                for offset in range(0, len(values), self.block_frames):
+                    block = values[offset:offset + self.block_frames]
+                    stage.process_into(block, start + offset, output[offset:offset + len(block)])
+                values = output
+            else:
+                values = stage.process(values, start)
+        if not is_float and values.dtype.kind == 'f':
+            numpy.rint(values, out=values)
+        return values
+
+    # the SampleStream filter interface:
+
+    def set_params(self, buffer_size, samplerate, samplewidth, nchannels):
+        length = int(self.duration * samplerate) if self.duration is not None else None
+        self.prepare(samplerate, nchannels, length)
+
+    def __call__(self, sample):
+        if sample:
+            sample.set_frames_numpy(self.process(sample.get_frames_numpy(), sample.is_float))
+        return sample
+
+
+class Echo(Effect):
+    """
+    Echo as a recursive feedback delay line: every echo comes delay seconds after the previous one,
+    and is decay times as loud. With amount, the number of echos is limited to that (the delay line then
+    exactly cancels the older echos), otherwise the echos go on until they fade away (decay must be < 1 then).
+    The delay line is kept between blocks, so the echos continue across the blocks of a stream.
+    The sound itself is not made longer; Sample.echo takes care of that for samples.
+    A feedback loop with a decay of 1 or more would also amplify its own rounding errors, so then the
+    (limited number of) echos are added as separate taps of the delay line instead.
+    """
+    def __init__(self, delay, decay, amount=None):
+        assert delay > 0
+        if amount is None and not 0 <= decay < 1:
+            raise ValueError("echos without a limited amount need a decay below 1")
+        self.delay = delay
+        self.decay = decay
+        self.amount = amount
+
+    def set_params(self, samplerate, nchannels, length):
+        super().set_params(samplerate, nchannels, length)
+        self.delay_frames = max(1, int(round(self.delay * samplerate)))
+        # to cancel the echos after the given amount, the input of that long ago is needed as well
+        self.history_frames = self.delay_frames * (1 if self.amount is None else self.amount + 1)
+        self.input_history = numpy.zeros((self.history_frames, nchannels))
+        self.echo_history = numpy.zeros((self.delay_frames, nchannels))
+
+    def process(self, values, start):
+        delay, history = self.delay_frames, self.history_frames
+        inputs = numpy.concatenate((self.input_history, values))
+        self.input_history = inputs[len(inputs) - history:].copy()
+        if abs(self.decay) >= 1:
+            result = values.astype(float)
+            for echo in range(1, self.amount + 1):
+                result += self.decay ** echo * inputs[history - echo * delay:history - echo * delay + len(values)]
+            return result
+        # echo[i] = decay * (echo[i-D] + input[i-D]) - decay**(amount+1) * input[i-(amount+1)*D]
+        # computed per chunk of D frames, because every chunk only depends on the chunks before it.
+        echos = numpy.empty((delay + len(values), values.shape[1]))
+        echos[:delay] = self.echo_history
+        cancel = 0.0 if self.amount is None else self.decay ** (self.amount + 1)
+        for offset in range(0, len(values), delay):
+            size = min(delay, len(values) - offset)
+            chunk = echos[delay + offset:delay + offset + size]
+            numpy.add(echos[offset:offset + size], inputs[history - delay + offset:history - delay + offset + size], out=chunk)
+            chunk *= self.decay
+            if cancel:
+                chunk -= cancel * inputs[offset:offset + size]
+        self.echo_history = echos[len(echos) - delay:].copy()
+        return values + echos[delay:]
+
+
+class ConvolutionReverb(Effect):
+    """
+    Convolution reverb: convolves the sound with the impulse response (a Sample) of a room or another reverb.
+    Uses uniformly partitioned FFT convolution: the impulse response is cut in partitions of partition_frames,
+    and the spectra of the previous input blocks are kept in a frequency domain delay line. The cost per block
+    is a couple of FFTs and one multiply-add per partition, however long the impulse response is.
+    There is no extra latency, blocks of any size can be processed (also smaller than a partition).
+    A stereo impulse response gives stereo output, also for mono sound.
+    The reverb is mixed with the dry sound, wet and dry are the levels of both.
+    """
+    def __init__(self, impulse_response, wet=0.3, dry=1.0, partition_frames=1024):
+        self.impulse_response = impulse_response
+        self.wet = wet
+        self.dry = dry
+        self.partition_frames = partition_frames
+        self.spectra = {}     # samplerate -> spectra of the impulse response partitions
+
+    def output_channels(self, nchannels):
+        return max(nchannels, self.impulse_response.nchannels)
+
+    def impulse_response_spectra(self, samplerate):
+        """The spectra of the partitions of the impulse response, shape (partitions, partition_frames+1, channels)."""
+        if samplerate not in self.spectra:
+            ir = self.impulse_response
+            if ir.samplerate != samplerate:
+                ir = ir.copy().resample(samplerate)
+            values = ir.get_frames_numpy().astype(float)
+            if not ir.is_float:
+                values /= 2 ** (8 * (4 if ir.samplewidth == 3 else ir.samplewidth) - 1)
+            size = self.partition_frames
+            num_partitions = max(1, -(-len(values) // size))
+            padded = numpy.zeros((num_partitions * size, values.shape[1]))
+            padded[:len(values)] = values
+            partitions = numpy.zeros((num_partitions, 2 * size, values.shape[1]))
+            partitions[:, :size] = padded.reshape(num_partitions, size, values.shape[1])
+            self.spectra[samplerate] = numpy.fft.rfft(partitions, axis=1)
+        return self.spectra[samplerate]
+
+    def set_params(self, samplerate, nchannels, length):
+        super().set_params(samplerate, nchannels, length)
+        size = self.partition_frames
+        self.ir_spectra = self.impulse_response_spectra(samplerate)
+        self.block = numpy.zeros((2 * size, nchannels))    # the previous input block, and the one being filled
+        self.filled = 0
+        self.delay_line = numpy.zeros((len(self.ir_spectra) - 1, size + 1, nchannels), dtype=complex)
+        self.newest = 0
+        self.tail_spectrum = numpy.zeros((size + 1, self.output_channels(nchannels)), dtype=complex)
+
+    def process(self, values, start):
+        size = self.partition_frames
+        wet = numpy.empty((len(values), self.output_channels(values.shape[1])))
+        offset = 0
+        while offset < len(values):
+            amount = min(size - self.filled, len(values) - offset)
+            position = size + self.filled
+            self.block[position:position + amount] = values[offset:offset + amount]
+            # overlap-save: the not yet filled part of the block is still zero, so the output
+            # of the frames that are already there is exact.
+            spectrum = numpy.fft.rfft(self.block, axis=0)
+            output = numpy.fft.irfft(self.tail_spectrum + spectrum * self.ir_spectra[0], n=2 * size, axis=0)
+            wet[offset:offset + amount] = output[position:position + amount]
+            self.filled += amount
+            offset += amount
+            if self.filled == size:
+                if len(self.delay_line):
+                    # the reverb of the next block that comes from the input blocks up to now.
+                    # The delay line is filled backwards, so from the newest block on it lines up with
+                    # the impulse response partitions in two slices (without having to reorder anything).
+                    partitions = len(self.delay_line)
+                    newest = self.newest = (self.newest - 1) % partitions
+                    self.delay_line[newest] = spectrum
+                    self.tail_spectrum = numpy.einsum("pf...,pf...->f...", self.delay_line[newest:], self.ir_spectra[1:partitions - newest + 1])
+                    if newest:
+                        self.tail_spectrum += numpy.einsum("pf...,pf...->f...", self.delay_line[:newest], self.ir_spectra[partitions - newest + 1:])
+                self.block[:size] = self.block[size:]
+                self.block[size:] = 0.0
+                self.filled = 0
+        return values * self.dry + wet * self.wet
+
+
+class Biquad(Effect):
+    """
+    Biquad IIR filter (the 'Audio EQ Cookbook' designs): lowpass, highpass, bandpass, notch, peak,
+    lowshelf and highshelf. The frequency is the cutoff or center frequency in Hz, q the resonance
+    and gain the boost (or cut) in dB of the peak and shelf filters.
+    The frequency can be modulated by a LFO (an oscillator, or an array with a value for every frame),
+    like the FM of the oscillators: frequency * (1 + lfo value). The filter coefficients are then updated
+    every update_frames frames.
+    The filter is computed per chunk of update_frames frames in state space form: the response to the
+    input of all chunks is computed at once with a few matrix products, only the filter state (two
+    values per channel) has to be carried from one chunk to the next.
+    """
+    kinds = ("lowpass", "highpass", "bandpass", "notch", "peak", "lowshelf", "highshelf")
+    update_frames = 32
+
+    def __init__(self, kind, frequency, q=0.7071, gain=0.0, fm_lfo=None):
+        if kind not in self.kinds:
+            raise ValueError("invalid filter kind")
+        assert frequency > 0 and q > 0
+        self.kind = kind
+        self.frequency = frequency
+        self.q = q
+        self.gain = gain
+        self.fm_lfo = fm_lfo
+
+    def set_params(self, samplerate, nchannels, length):
+        super().set_params(samplerate, nchannels, length)
+        self.state = numpy.zeros((2, nchannels))
+        if self.fm_lfo is None:
+            self.matrices = self.chunk_matrices(numpy.array([float(self.frequency)]))
+        elif not isinstance(self.fm_lfo, numpy.ndarray):
+            self.lfo_values = iter(self.fm_lfo)
+
+    def coefficients(self, frequencies):
+        """The coefficients b0, b1, b2, a1, a2 (normalized to a0 = 1) for an array of frequencies."""
+        w0 = 2 * numpy.pi * numpy.clip(frequencies, 1.0, 0.49 * self.samplerate) / self.samplerate
+        cos = numpy.cos(w0)
+        alpha = numpy.sin(w0) / (2 * self.q)
+        if self.kind == "lowpass":
+            b0 = b2 = (1 - cos) / 2
+            b1, a0, a1, a2 = 1 - cos, 1 + alpha, -2 * cos, 1 - alpha
+        elif self.kind == "highpass":
+            b0 = b2 = (1 + cos) / 2
+            b1, a0, a1, a2 = -(1 + cos), 1 + alpha, -2 * cos, 1 - alpha
+        elif self.kind == "bandpass":
+            b0, b1, b2, a0, a1, a2 = alpha, numpy.zeros_like(cos), -alpha, 1 + alpha, -2 * cos, 1 - alpha
+        elif self.kind == "notch":
+            b0 = b2 = numpy.ones_like(cos)
+            b1, a0, a1, a2 = -2 * cos, 1 + alpha, -2 * cos, 1 - alpha
+        else:
+            a = 10 ** (self.gain / 40)
+            if self.kind == "peak":
+                b0, b1, b2 = 1 + alpha * a, -2 * cos, 1 - alpha * a
+                a0, a1, a2 = 1 + alpha / a, -2 * cos, 1 - alpha / a
+            else:
+                shelf = 2 * numpy.sqrt(a) * alpha
+                sign = 1 if self.kind == "lowshelf" else -1
+                b0 = a * ((a + 1) - sign * (a - 1) * cos + shelf)
+                b1 = sign * 2 * a * ((a - 1) - sign * (a + 1) * cos)
+                b2 = a * ((a + 1) - sign * (a - 1) * cos - shelf)
+                a0 = (a + 1) + sign * (a - 1) * cos + shelf
+                a1 = -sign * 2 * ((a - 1) + sign * (a + 1) * cos)
+                a2 = (a + 1) + sign * (a - 1) * cos - shelf
+        return b0 / a0, b1 / a0, b2 / a0, a1 / a0, a2 / a0
+
+    def chunk_matrices(self, frequencies):
+        """
+        The matrices to compute chunks of update_frames frames, for every frequency:
+        the impulse response (output from the chunk input), the output from the filter state at the
+        start of the chunk, the filter state from the chunk input, and the powers of the state transition.
+        """
+        size = self.update_frames
+        b0, b1, b2, a1, a2 = self.coefficients(frequencies)
+        # transposed direct form II: y = b0*x + s1,  s1' = s2 - a1*s1 + (b1-a1*b0)*x,  s2' = -a2*s1 + (b2-a2*b0)*x
+        transition = numpy.zeros((len(frequencies), 2, 2))
+        transition[:, 0, 0] = -a1
+        transition[:, 0, 1] = 1.0
+        transition[:, 1, 0] = -a2
+        powers = numpy.empty((len(frequencies), size + 1, 2, 2))
+        powers[:, 0] = numpy.identity(2)
+        for power in range(size):
+            numpy.matmul(powers[:, power], transition, out=powers[:, power + 1])
+        inputs = numpy.stack((b1 - a1 * b0, b2 - a2 * b0), axis=-1)
+        state_inputs = numpy.einsum("nkij,nj->nki", powers[:, :size], inputs)
+        response = numpy.concatenate((b0[:, numpy.newaxis], state_inputs[:, :size - 1, 0]), axis=1)
+        lag = numpy.arange(size)[:, numpy.newaxis] - numpy.arange(size)
+        impulse = numpy.where(lag >= 0, response[:, numpy.maximum(lag, 0)], 0.0)
+        return impulse, powers[:, :size, 0, :], state_inputs[:, ::-1], powers
+
+    def process(self, values, start):
+        size = self.update_frames
+        nframes, nchannels = values.shape
+        if not nframes:
+            return values.astype(float)
+        nchunks = -(-nframes // size)
+        chunks = numpy.zeros((nchunks * size, nchannels))
+        chunks[:nframes] = values
+        chunks = chunks.reshape(nchunks, size, nchannels)
+        if self.fm_lfo is None:
+            impulse, from_state, to_state, powers = self.matrices
+        else:
+            if isinstance(self.fm_lfo, numpy.ndarray):
+                lfo = self.fm_lfo[start:start + nframes:size]
+                if len(lfo) < nchunks:
+                    # after the end of the lfo array, its last value is kept
+                    lfo = numpy.concatenate((lfo, numpy.full(nchunks - len(lfo), self.fm_lfo[-1])))
+            else:
+                lfo = numpy.fromiter(itertools.islice(self.lfo_values, nframes), dtype=float, count=nframes)[::size]
+            impulse, from_state, to_state, powers = self.chunk_matrices(self.frequency * (1 + lfo))
+        output = impulse @ chunks
+        state_inputs = numpy.swapaxes(to_state, 1, 2) @ chunks
+        transitions = numpy.broadcast_to(powers[:, size], (nchunks, 2, 2))
+        last = nframes - (nchunks - 1) * size
+        if last < size:
+            # the filter state after a partial last chunk
+            state_inputs[-1] = to_state[-1, size - last:].T @ chunks[-1, :last]
+            transitions = transitions.copy()
+            transitions[-1] = powers[-1, last]
+        states = numpy.empty((nchunks, 2, nchannels))
+        state = self.state
+        for chunk in range(nchunks):
+            states[chunk] = state
+            state = transitions[chunk] @ state + state_inputs[chunk]
+        self.state = state
+        output += from_state @ states
+        return output.reshape(nchunks * size, nchannels)[:nframes]
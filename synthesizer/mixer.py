@@ -14,6 +14,10 @@ import os
 import cmd
 from configparser import ConfigParser
 from .sample import Sample, Output
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 __all__ = ["Mixer", "Song", "Repl"]
 
@@ -21,6 +25,7 @@ __all__ = ["Mixer", "Song", "Repl"]
 class Mixer:
     """
     Mixes a set of ascii-bar tracks using the given sample instruments, into a resulting big sample.
+    The mix has the format of the instruments; with floating-point instruments it never clips.
     """
     def __init__(self, patterns, bpm, ticks, instruments):
         for p in patterns:
@@ -52,7 +57,7 @@ class Mixer:
             total_seconds += len(bar) * 60.0 / self.bpm / self.ticks
         if verbose:
             print("Mixing {:d} patterns...".format(len(self.patterns)))
-        mixed = Sample().make_32bit()
+        mixed = self.empty_mix()
         for index, timestamp, sample in self.mixed_samples(tracker=False):
             if verbose:
                 print("\r{:3.0f} % ".format(timestamp/total_seconds*100), end="")
@@ -84,7 +89,7 @@ class Mixer:
         samples = self.mixed_samples()
         # get the first sample
         index, previous_timestamp, sample = next(samples)
-        mixed = Sample().make_32bit()
+        mixed = self.empty_mix()
         mixed.mix_at(previous_timestamp, sample)
         # continue mixing the following samples
         for index, timestamp, sample in samples:
@@ -99,7 +104,7 @@ class Mixer:
                 overflow = mixed.split(trigger_duration)
             mixed_duration += mixed.duration
             yield mixed
-            mixed = overflow if overflow else Sample().make_32bit()
+            mixed = overflow if overflow else self.empty_mix()
             mixed.mix(sample)
             previous_timestamp = timestamp
         # output the last remaining sample and extend it to the end of the duration if needed
@@ -112,6 +117,13 @@ class Mixer:
         mixed_duration += mixed.duration
         yield mixed
 
+    def empty_mix(self):
+        """Returns a new empty sample in the format of the instruments, to mix them into."""
+        instrument = next(iter(self.instruments.values()), None)
+        if not instrument:
+            return Sample().make_32bit()
+        return Sample.from_raw_frames(b"", instrument.samplewidth, instrument.samplerate, instrument.nchannels, instrument.is_float)
+
     def mixed_triggers(self, tracker):
         """
         Generator for all triggers in chronological sequence.
@@ -203,7 +215,13 @@ class Song:
         """Reads the sample files for the instruments."""
         self.instruments = {}
         for name, file in sorted(instruments.items()):
-            self.instruments[name] = Sample(wave_file=os.path.join(samples_path, file)).normalize().make_32bit(scale_amplitude=False).lock()
+            sample = Sample(wave_file=os.path.join(samples_path, file)).normalize()
+            if numpy:
+                sample.make_float()
+            else:
+                # create headroom in the sample values to mix them without overflowing
+                sample.make_32bit(scale_amplitude=False)
+            self.instruments[name] = sample.lock()
 
     def read_patterns(self, songdef, names):
         """Reads and parses the pattern specs from the song."""
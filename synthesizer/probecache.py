@@ -0,0 +1,67 @@
+"""
+Cache for the audio format probes of files.
+This doesn't depend on the rest of the synthesizer (nor on any audio output library),
+so it can be used by programs that don't play audio themselves, such as the jukebox backend.
+
+Written by Irmen de Jong (irmen@razorvine.net) - License: MIT open-source.
+"""
+
+import os
+import threading
+from collections import namedtuple, OrderedDict
+
+
+__all__ = ["AudioFormatProbe", "FormatProbeCache"]
+
+
+AudioFormatProbe = namedtuple("AudioFormatProbe", ["rate", "channels", "sampformat", "fileformat", "duration"])
+
+
+class FormatProbeCache:
+    """
+    Cache for the AudioFormatProbe results of files, so ffprobe doesn't have to run every time a file is opened.
+    The cache key is the file's path, size and modification time, so a changed file is probed again.
+    This one keeps the probes of the max_entries most recently used files in memory.
+    To store them persistently, override the load and store methods.
+    """
+    max_entries = 1000
+
+    def __init__(self):
+        self.probes = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(filename):
+        stat = os.stat(filename)
+        return os.path.abspath(filename), stat.st_size, stat.st_mtime
+
+    def get(self, filename):
+        """Returns the cached probe for the file, or None if it's not in the cache."""
+        key = self.key(filename)
+        with self.lock:
+            probe = self.probes.get(key)
+            if probe is not None:
+                self.probes.move_to_end(key)
+        if probe is None:
+            probe = self.load(key)
+            if probe:
+                self.remember(key, probe)
+        return probe
+
+    def put(self, filename, probe):
+        key = self.key(filename)
+        self.remember(key, probe)
+        self.store(key, probe)
+
+    def remember(self, key, probe):
+        with self.lock:
+            self.probes[key] = probe
+            self.probes.move_to_end(key)
+            while len(self.probes) > self.max_entries:
+                self.probes.popitem(last=False)
+
+    def load(self, key):
+        return None
+
+    def store(self, key, probe):
+        pass
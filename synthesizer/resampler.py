@@ -0,0 +1,114 @@
+"""
+High quality sample rate conversion, as an alternative to the simple algorithm of audioop.ratecv.
+Uses polyphase windowed-sinc interpolation, vectorized with numpy (which is required).
+The filter banks are computed once per rate ratio and shared between resamplers.
+
+Written by Irmen de Jong (irmen@razorvine.net) - License: MIT open-source.
+"""
+
+import math
+import fractions
+import numpy
+
+
+__all__ = ["Resampler"]
+
+
+class Resampler:
+    """
+    Converts blocks of sample values (numpy arrays of shape (frames, channels)) to another sample rate.
+    The filter history is kept across calls to process, so you can feed it consecutive blocks of a stream.
+    Call flush at the end to get the last frames out.
+    Rate ratios that need too many filter phases (such as arbitrary speed factors) use the nearest
+    of max_phases phases instead of the exact one, which is still far more accurate than linear interpolation.
+    """
+    zero_crossings = 16     # filter length in zero crossings of the sinc function, on each side
+    rolloff = 0.95          # cutoff frequency, relative to the lowest of the two nyquist frequencies
+    kaiser_beta = 8.6
+    max_phases = 512
+    process_chunk = 8192    # number of output frames to compute at once, to limit the memory used
+    _filter_banks = {}      # (up, down, phases) -> filter bank
+
+    def __init__(self, from_rate, to_rate, nchannels):
+        ratio = fractions.Fraction(int(to_rate), int(from_rate))
+        self.up = ratio.numerator
+        self.down = ratio.denominator
+        self.nchannels = nchannels
+        self.phases = min(self.up, self.max_phases)
+        self.bank = self.filter_bank(self.up, self.down, self.phases)
+        self.half_taps = self.bank.shape[1] // 2
+        self.reset()
+
+    def reset(self):
+        """Forget the filter history, to start resampling a new stream."""
+        # history starts with zeros so the first output frame can be centered on the first input frame
+        self.buffer = numpy.zeros((self.half_taps - 1, self.nchannels))
+        self.buffer_start = 1 - self.half_taps   # input frame index of the first frame in the buffer
+        self.input_frames = 0
+        self.output_frames = 0
+
+    @classmethod
+    def filter_bank(cls, up, down, phases):
+        """Returns the (cached) polyphase filter bank, shape (phases, taps), to resample by up/down."""
+        key = (up, down, phases)
+        if key not in cls._filter_banks:
+            cutoff = min(1.0, up / down) * cls.rolloff
+            half_taps = int(math.ceil(cls.zero_crossings / cutoff))
+            # distance of every tap to the interpolated position, for every phase
+            t = (numpy.arange(2 * half_taps) - half_taps + 1)[numpy.newaxis, :] - \
+                (numpy.arange(phases) / phases)[:, numpy.newaxis]
+            window = numpy.i0(cls.kaiser_beta * numpy.sqrt(numpy.clip(1.0 - (t / half_taps) ** 2, 0.0, 1.0)))
+            bank = cutoff * numpy.sinc(cutoff * t) * window / numpy.i0(cls.kaiser_beta)
+            bank /= bank.sum(axis=1, keepdims=True)     # unity gain for every phase
+            cls._filter_banks[key] = bank
+        return cls._filter_banks[key]
+
+    def _positions(self, start, end):
+        # positions of the output frames in the input, in units of 1/phases input frame
+        n = numpy.arange(start, end, dtype=numpy.int64)
+        return (2 * n * self.down * self.phases + self.up) // (2 * self.up)
+
+    def _output_frames_for_input(self, input_frames):
+        return -(-input_frames * self.up // self.down)
+
+    def process(self, values):
+        """Feed the next block of sample values, returns the resampled values available so far."""
+        self.buffer = numpy.concatenate((self.buffer, numpy.asarray(values, dtype=numpy.float64).reshape(-1, self.nchannels)))
+        self.input_frames += len(values)
+        return self._resample(self._output_frames_for_input(self.input_frames))
+
+    def flush(self):
+        """Returns the last resampled values, for the end of the input. The resampler is then reset."""
+        self.buffer = numpy.concatenate((self.buffer, numpy.zeros((self.half_taps + 1, self.nchannels))))
+        result = self._resample(self._output_frames_for_input(self.input_frames))
+        self.reset()
+        return result
+
+    def _resample(self, max_output_frames):
+        available_end = self.buffer_start + len(self.buffer)     # input frame index after the buffer
+        # estimate the number of output frames that have all their input frames available, then refine it
+        end = min(max_output_frames, (available_end - self.half_taps) * self.up // self.down + 2)
+        end = max(end, self.output_frames)
+        positions = self._positions(self.output_frames, end)
+        positions = positions[positions // self.phases + self.half_taps < available_end]
+        taps = numpy.arange(2 * self.half_taps)
+        results = []
+        for offset in range(0, len(positions), self.process_chunk):
+            chunk = positions[offset:offset + self.process_chunk]
+            first = chunk // self.phases - self.half_taps + 1 - self.buffer_start
+            inputs = self.buffer[first[:, numpy.newaxis] + taps]    # shape (frames, taps, channels)
+            results.append(numpy.einsum("nt,ntc->nc", self.bank[chunk % self.phases], inputs))
+        self.output_frames += len(positions)
+        # discard the input frames that the next output frames no longer need
+        next_first = self._positions(self.output_frames, self.output_frames + 1)[0] // self.phases - self.half_taps + 1
+        discard = min(max(0, next_first - self.buffer_start), len(self.buffer))
+        self.buffer = self.buffer[discard:]
+        self.buffer_start += discard
+        if results:
+            return numpy.concatenate(results)
+        return numpy.zeros((0, self.nchannels))
+
+    def resample(self, values):
+        """Resamples a complete block of sample values at once."""
+        result = self.process(values)
+        return numpy.concatenate((result, self.flush()))
@@ -13,24 +13,33 @@ Written by Irmen de Jong (irmen@razorvine.net) - License: MIT open-source.
 import sys
 import os
 import wave
+import struct
 import audioop
 import array
 import threading
 import queue
 import math
 import itertools
+import collections
+import time
 try:
     import pyaudio
 except ImportError:
     pyaudio = None
-    import winsound
+    try:
+        import winsound
+    except ImportError:
+        winsound = None
 try:
     import numpy
 except ImportError:
     numpy = None
+else:
+    from synthesizer.resampler import Resampler
 
 
-__all__ = ["Sample", "Output", "LevelMeter"]
+__all__ = ["Sample", "Output", "LevelMeter", "FrameRingBuffer", "OutputDevice", "PyAudioDevice", "VirtualClockDevice",
+           "BufferSizeController", "StreamingWavWriter"]
 
 
 samplewidths_to_arraycode = {
@@ -43,21 +52,37 @@ samplewidths_to_arraycode = {
 if array.array('i').itemsize == 4:
     samplewidths_to_arraycode[4] = 'i'
 
+# little-endian numpy dtypes for the sample widths (24 bits samples are processed as 32 bits)
+numpy_dtypes = {
+    2: '<i2',
+    4: '<i4'
+}
+numpy_float_dtype = '<f4'
+
 
 class Sample:
     """
-    Audio sample data. Supports integer sample formats of 2, 3 and 4 bytes per sample (no floating-point).
+    Audio sample data. Supports integer sample formats of 2, 3 and 4 bytes per sample,
+    and 32 bits floating-point samples (nominal range -1.0...1.0, numpy is required for these).
+    Floating-point samples don't clip or overflow when they're mixed or amplified, only when
+    they're converted back to an integer format.
     Python 3.4+ is required to support 3-bytes/24-bits sample sizes.
     Most operations modify the sample data in place (if it's not locked) and return the sample object,
     so you can easily chain several operations.
+    Streaming creates a lot of short-lived samples, so they are kept small (slots) and cheap to create
+    (from_raw_frames). Samples that are no longer used can be released to let from_raw_frames reuse them.
     """
+    __slots__ = ("__locked", "__float", "__frames", "__samplerate", "__samplewidth", "__nchannels", "__filename")
     norm_samplerate = 44100
     norm_nchannels = 2
     norm_samplewidth = 2
+    pool_size = 64      # max. number of released sample objects kept for reuse
+    __pool = []
 
     def __init__(self, wave_file=None):
         """Creates a new empty sample, or loads it from a wav file."""
         self.__locked = False
+        self.__float = False
         if wave_file:
             self.load_wav(wave_file)
             self.__filename = wave_file
@@ -73,34 +98,60 @@ class Sample:
 
     def __repr__(self):
         locked = " (locked)" if self.__locked else ""
-        return "<Sample at 0x{0:x}, {1:g} seconds, {2:d} channels, {3:d} bits, rate {4:d}{5:s}>"\
-            .format(id(self), self.duration, self.__nchannels, 8*self.__samplewidth, self.__samplerate, locked)
+        bits = "float" if self.__float else "{:d} bits".format(8*self.__samplewidth)
+        return "<Sample at 0x{0:x}, {1:g} seconds, {2:d} channels, {3:s}, rate {4:d}{5:s}>"\
+            .format(id(self), self.duration, self.__nchannels, bits, self.__samplerate, locked)
 
     def __eq__(self, other):
         if not isinstance(other, Sample):
             return False
         return self.__samplewidth == other.__samplewidth and \
+            self.__float == other.__float and \
             self.__samplerate == other.__samplerate and \
             self.__nchannels == other.__nchannels and \
             self.__frames == other.__frames
 
     @classmethod
-    def from_raw_frames(cls, frames, samplewidth, samplerate, numchannels):
-        """Creates a new sample directly from the raw sample data."""
+    def from_raw_frames(cls, frames, samplewidth, samplerate, numchannels, is_float=False):
+        """
+        Creates a new sample directly from the raw sample data. Floating-point data must be little-endian float32.
+        This is the cheap way to create a sample: it bypasses __init__ and reuses a released sample object if possible.
+        """
         assert 1 <= numchannels <= 2
         assert 2 <= samplewidth <= 4
         assert samplerate > 1
-        s = cls()
+        if is_float:
+            assert samplewidth == 4
+            if not numpy:
+                raise RuntimeError("numpy is required for floating-point samples")
+        s = None
+        if cls is Sample and Sample.__pool:
+            try:
+                s = Sample.__pool.pop()
+            except IndexError:
+                pass    # another thread took the last one
+        if s is None:
+            s = cls.__new__(cls)
+        s.__locked = False
+        s.__filename = None
         s.__frames = frames
         s.__samplerate = int(samplerate)
         s.__samplewidth = int(samplewidth)
         s.__nchannels = int(numchannels)
+        s.__float = is_float
         return s
 
     @classmethod
     def from_array(cls, array_or_list, samplerate, numchannels):
         assert 1 <= numchannels <= 2
         assert samplerate > 1
+        if numpy and isinstance(array_or_list, numpy.ndarray) and array_or_list.dtype.kind == 'f':
+            return Sample.from_raw_frames(array_or_list.astype(numpy_float_dtype).tobytes(), 4, samplerate, numchannels, True)
+        if isinstance(array_or_list, array.array) and array_or_list.typecode == 'f':
+            frames = array_or_list.tobytes()
+            if sys.byteorder == "big":
+                frames = audioop.byteswap(frames, 4)
+            return Sample.from_raw_frames(frames, 4, samplerate, numchannels, True)
         if isinstance(array_or_list, list):
             try:
                 array_or_list = Sample.get_array(2, array_or_list)
@@ -125,6 +176,11 @@ class Sample:
     def samplewidth(self):
         return self.__samplewidth
 
+    @property
+    def is_float(self):
+        """Is the sample data in 32 bits floating-point format (instead of integer)?"""
+        return self.__float
+
     @property
     def samplerate(self):
         """You can also set this to a new value, but that will directly affect the pitch and the duration of the sample."""
@@ -147,10 +203,14 @@ class Sample:
 
     @property
     def maximum(self):
+        if self.__float:
+            return float(numpy.max(numpy.abs(self.__frames_to_numpy()))) if self.__frames else 0.0
         return audioop.max(self.__frames, self.samplewidth)
 
     @property
     def rms(self):
+        if self.__float:
+            return float(numpy.sqrt(numpy.mean(numpy.square(self.__frames_to_numpy())))) if self.__frames else 0.0
         return audioop.rms(self.__frames, self.samplewidth)
 
     @property
@@ -169,6 +229,16 @@ class Sample:
         This method is probably only useful if processed on very short sample fragments in sequence,
         so the db levels could be used to show a level meter for the duration of the sample.
         """
+        if self.__float:
+            values = numpy.abs(self.__frames_to_numpy())
+            if not len(values):
+                return -60.0, -60.0
+            if rms_mode:
+                peaks = numpy.sqrt(numpy.mean(numpy.square(values), axis=0)) + 1e-6
+            else:
+                peaks = numpy.max(values, axis=0) + 1e-6
+            peak_left, peak_right = peaks[0], peaks[-1]
+            return max(20.0*math.log(peak_left, 10), -60.0), max(20.0*math.log(peak_right, 10), -60.0)
         maxvalue = 2**(8*self.__samplewidth-1)
         if self.nchannels == 1:
             if rms_mode:
@@ -193,6 +263,11 @@ class Sample:
 
     def get_frame_array(self):
         """Returns the sample values as array. Warning: this can copy large amounts of data."""
+        if self.__float:
+            values = array.array('f', self.__frames)
+            if sys.byteorder == "big":
+                values.byteswap()
+            return values
         return Sample.get_array(self.samplewidth, self.__frames)
 
     @staticmethod
@@ -202,10 +277,20 @@ class Sample:
 
     def copy(self):
         """Returns a copy of the sample (unlocked)."""
-        cpy = Sample()
-        cpy.copy_from(self)
+        cpy = Sample.from_raw_frames(self.__frames, self.__samplewidth, self.__samplerate, self.__nchannels, self.__float)
+        cpy.__filename = self.__filename
         return cpy
 
+    def release(self):
+        """
+        Hands the sample object back, so that from_raw_frames can reuse it (this avoids a lot of allocations
+        in streaming loops). Only do this when the sample isn't referenced anywhere else anymore!
+        """
+        if type(self) is Sample and not self.__locked and len(Sample.__pool) < self.pool_size:
+            self.__frames = b""
+            self.__filename = None
+            Sample.__pool.append(self)
+
     def copy_from(self, other):
         """Overwrite the current sample with a copy of the other."""
         assert not self.__locked
@@ -214,6 +299,7 @@ class Sample:
         self.__samplerate = other.__samplerate
         self.__nchannels = other.__nchannels
         self.__filename = other.__filename
+        self.__float = other.__float
         return self
 
     def lock(self):
@@ -236,6 +322,7 @@ class Sample:
             self.__nchannels = w.getnchannels()
             self.__samplerate = w.getframerate()
             self.__samplewidth = w.getsampwidth()
+            self.__float = False
             nframes = w.getnframes()
             if nframes*self.__nchannels*self.__samplewidth > 2**26:
                 # Requested number of frames is way to large. Probably dealing with a stream.
@@ -251,7 +338,22 @@ class Sample:
             return self
 
     def write_wav(self, file_or_stream):
-        """Write a wav file with the current sample data. You can use a filename or a stream object."""
+        """
+        Write a wav file with the current sample data. You can use a filename or a stream object.
+        Floating-point samples are written in the IEEE float wav format (which the wave module can't read).
+        """
+        if self.__float:
+            header = struct.pack("<4sI4s4sIHHIIHH4sI", b"RIFF", 36 + len(self.__frames), b"WAVE", b"fmt ", 16, 3,
+                                 self.nchannels, self.samplerate, self.samplerate * 4 * self.nchannels,
+                                 4 * self.nchannels, 32, b"data", len(self.__frames))
+            if isinstance(file_or_stream, str):
+                with open(file_or_stream, "wb") as out:
+                    out.write(header)
+                    out.write(self.__frames)
+            else:
+                file_or_stream.write(header)
+                file_or_stream.write(self.__frames)
+            return
         with wave.open(file_or_stream, "wb") as out:
             out.setparams((self.nchannels, self.samplewidth, self.samplerate, 0, "NONE", "not compressed"))
             out.writeframes(self.__frames)
@@ -282,6 +384,10 @@ class Sample:
         """Write the raw sample data to the output stream."""
         stream.write(self.__frames)
 
+    def view_frame_data(self):
+        """Returns a memoryview on the raw sample data, without copying it. Don't modify the sample while using it."""
+        return memoryview(self.__frames)
+
     def normalize(self):
         """
         Normalize the sample, meaning: convert it to the default samplerate, sample width and number of channels.
@@ -289,6 +395,8 @@ class Sample:
         """
         assert not self.__locked
         self.resample(self.norm_samplerate)
+        if self.__float:
+            self.make_16bit(maximize_amplitude=False)
         if self.samplewidth != self.norm_samplewidth:
             # Convert to 16 bit sample size.
             self.__frames = audioop.lin2lin(self.__frames, self.samplewidth, self.norm_samplewidth)
@@ -302,12 +410,13 @@ class Sample:
     def resample(self, samplerate):
         """
         Resamples to a different sample rate, without changing the pitch and duration of the sound.
-        The algorithm used is simple, and it will cause a loss of sound quality.
+        If numpy is available this uses a high quality windowed-sinc resampler (see Resampler).
+        Otherwise the algorithm used is simple, and it will cause a loss of sound quality.
         """
         assert not self.__locked
         if samplerate == self.__samplerate:
             return self
-        self.__frames = audioop.ratecv(self.__frames, self.samplewidth, self.nchannels, self.samplerate, samplerate, None)[0]
+        self.__frames = self.__resampled_frames(self.samplerate, samplerate)
         self.__samplerate = samplerate
         return self
 
@@ -315,17 +424,22 @@ class Sample:
         """
         Changes the playback speed of the sample, without changing the sample rate.
         This will change the pitch and duration of the sound accordingly.
-        The algorithm used is simple, and it will cause a loss of sound quality.
+        If numpy is available this uses a high quality windowed-sinc resampler (see Resampler).
+        Otherwise the algorithm used is simple, and it will cause a loss of sound quality.
         """
         assert not self.__locked
         assert speed > 0
         if speed == 1.0:
             return self
-        rate = self.samplerate
-        self.__frames = audioop.ratecv(self.__frames, self.samplewidth, self.nchannels, int(self.samplerate*speed), rate, None)[0]
-        self.__samplerate = rate
+        self.__frames = self.__resampled_frames(int(self.samplerate*speed), self.samplerate)
         return self
 
+    def __resampled_frames(self, from_rate, to_rate):
+        if numpy and self.__samplewidth in (2, 3, 4):
+            values = Resampler(from_rate, to_rate, self.__nchannels).resample(self.__frames_to_numpy())
+            return self.__numpy_to_frames(values if self.__float else numpy.rint(values))
+        return audioop.ratecv(self.__frames, self.samplewidth, self.nchannels, from_rate, to_rate, None)[0]
+
     def make_32bit(self, scale_amplitude=True):
         """
         Convert to 32 bit integer sample width, usually also scaling the amplitude to fit in the new 32 bits range.
@@ -336,10 +450,13 @@ class Sample:
         assert not self.__locked
         self.__frames = self.get_32bit_frames(scale_amplitude)
         self.__samplewidth = 4
+        self.__float = False
         return self
 
     def get_32bit_frames(self, scale_amplitude=True):
         """Returns the raw sample frames scaled to 32 bits. See make_32bit method for more info."""
+        if self.__float:
+            return self.__float_to_int_frames(4 if scale_amplitude else 2, 4)
         if self.samplewidth == 4:
             return self.__frames
         frames = audioop.lin2lin(self.__frames, self.samplewidth, 4)
@@ -359,14 +476,48 @@ class Sample:
         assert self.samplewidth >= 2
         if maximize_amplitude:
             self.amplify_max()
-        if self.samplewidth > 2:
+        if self.__float:
+            self.__frames = self.__float_to_int_frames(2, 2)
+            self.__samplewidth = 2
+            self.__float = False
+        elif self.samplewidth > 2:
             self.__frames = audioop.lin2lin(self.__frames, self.samplewidth, 2)
             self.__samplewidth = 2
         return self
 
+    def make_float(self):
+        """
+        Convert to 32 bits floating-point samples, scaling the full integer range to -1.0...1.0. Requires numpy.
+        Mixing and amplifying float samples can't clip or overflow, so there's no need to create headroom for that.
+        """
+        assert not self.__locked
+        if self.__float:
+            return self
+        if not numpy:
+            raise RuntimeError("numpy is required for floating-point samples")
+        values = self.__frames_to_numpy().astype(numpy_float_dtype)
+        values *= 1.0 / 2 ** (8 * (4 if self.__samplewidth == 3 else self.__samplewidth) - 1)
+        self.__frames = values.tobytes()
+        self.__samplewidth = 4
+        self.__float = True
+        return self
+
+    def __float_to_int_frames(self, value_width, samplewidth):
+        # float values -1.0...1.0 scaled to the integer range of value_width, and clipped, in samplewidth sized frames
+        maxvalue = 2 ** (8 * value_width - 1)
+        # in double precision: 2**31-1 isn't representable as a 32 bits float and would be rounded up to overflow
+        values = numpy.rint(self.__frames_to_numpy().astype(numpy.float64) * maxvalue)
+        numpy.clip(values, -maxvalue, maxvalue - 1, out=values)
+        return values.astype(numpy_dtypes[samplewidth]).tobytes()
+
     def amplify_max(self):
         """Amplify the sample to maximum volume without clipping or overflow happening."""
         assert not self.__locked
+        if self.__float:
+            max_amp = self.maximum
+            if max_amp > 0:
+                self.__frames = self.__numpy_to_frames(self.__frames_to_numpy() * ((1.0 - 2.0 / 2 ** 15) / max_amp))
+            return self
         max_amp = audioop.max(self.__frames, self.samplewidth)
         max_target = 2 ** (8 * self.samplewidth - 1) - 2
         if max_amp > 0:
@@ -377,9 +528,86 @@ class Sample:
     def amplify(self, factor):
         """Amplifies (multiplies) the sample by the given factor. May cause clipping/overflow if factor is too large."""
         assert not self.__locked
+        if self.__float:
+            self.__frames = self.__numpy_to_frames(self.__frames_to_numpy() * numpy.float32(factor))
+            return self
         self.__frames = audioop.mul(self.__frames, self.samplewidth, factor)
         return self
 
+    def amplify_ramp(self, start_factor, end_factor):
+        """
+        Amplifies the sample by a factor that changes linearly over the duration of the sample,
+        from start_factor at the first frame towards end_factor (which is reached right after the last frame).
+        So consecutive fragments can be ramped seamlessly. This avoids clicks when changing the volume.
+        The sample values are clipped if the factors are too large.
+        """
+        assert not self.__locked
+        if start_factor == end_factor:
+            return self.amplify(start_factor)
+        numframes = len(self)
+        if not numframes:
+            return self
+        if numpy:
+            ramp = numpy.linspace(start_factor, end_factor, numframes, endpoint=False)
+            self.__frames = self.__numpy_to_frames(self.__frames_to_numpy() * ramp[:, numpy.newaxis])
+        else:
+            frames, samplewidth = self.__frames, self.__samplewidth
+            if samplewidth == 3:
+                frames, samplewidth = audioop.lin2lin(frames, 3, 4), 4
+            values = Sample.get_array(samplewidth, frames)
+            step = (end_factor - start_factor) / numframes
+            maxvalue = 2 ** (8 * samplewidth - 1)
+            for i in range(len(values)):
+                value = int(values[i] * (start_factor + step * (i // self.__nchannels)))
+                values[i] = max(-maxvalue, min(maxvalue - 1, value))
+            frames = values.tobytes()
+            if sys.byteorder == "big":
+                frames = audioop.byteswap(frames, samplewidth)
+            if self.__samplewidth == 3:
+                frames = audioop.lin2lin(frames, 4, 3)
+            self.__frames = frames
+        return self
+
+    def get_frames_numpy(self):
+        """
+        Returns the sample values as a (read-only) numpy array of shape (frames, channels), without copying if possible.
+        Floating-point samples give float32 values, 24 bits samples are scaled to 32 bits. Requires numpy.
+        """
+        return self.__frames_to_numpy()
+
+    def set_frames_numpy(self, values):
+        """
+        Replaces the sample data by the values in a numpy array of shape (frames, channels), the inverse of get_frames_numpy.
+        The number of channels follows from the array. Floating-point values are clipped and truncated for integer samples.
+        """
+        assert not self.__locked
+        assert 1 <= values.shape[1] <= 2
+        self.__frames = self.__numpy_to_frames(values)
+        self.__nchannels = values.shape[1]
+        return self
+
+    def __frames_to_numpy(self):
+        # returns the sample values as a numpy array of shape (frames, channels). 24 bits samples are scaled to 32 bits.
+        if self.__float:
+            return numpy.frombuffer(self.__frames, dtype=numpy_float_dtype).reshape(-1, self.__nchannels)
+        frames, samplewidth = self.__frames, self.__samplewidth
+        if samplewidth == 3:
+            frames, samplewidth = audioop.lin2lin(frames, 3, 4), 4
+        return numpy.frombuffer(frames, dtype=numpy_dtypes[samplewidth]).reshape(-1, self.__nchannels)
+
+    def __numpy_to_frames(self, values):
+        # converts (and clips) numpy sample values back into raw frames, the inverse of __frames_to_numpy.
+        if self.__float:
+            return values.astype(numpy_float_dtype).tobytes()
+        samplewidth = 4 if self.__samplewidth == 3 else self.__samplewidth
+        maxvalue = 2 ** (8 * samplewidth - 1)
+        if values.dtype.kind == 'f':
+            values = numpy.clip(values.astype(numpy.float64, copy=False), -maxvalue, maxvalue - 1)
+        frames = values.astype(numpy_dtypes[samplewidth]).tobytes()
+        if self.__samplewidth == 3:
+            frames = audioop.lin2lin(frames, 4, 3)
+        return frames
+
     def at_volume(self, volume):
         """
         Returns a copy of the sample at the given volume level 0-1, leaves original untouched.
@@ -409,7 +637,7 @@ class Sample:
             chopped.__frames = self.__frames[end:]
             self.__frames = self.__frames[:end]
             return chopped
-        return Sample.from_raw_frames(b"", self.__samplewidth, self.__samplerate, self.__nchannels)
+        return Sample.from_raw_frames(b"", self.__samplewidth, self.__samplerate, self.__nchannels, self.__float)
 
     def add_silence(self, seconds, at_start=False):
         """Add silence at the end (or at the start)"""
@@ -425,6 +653,7 @@ class Sample:
         """Add another sample at the end of the current one. The other sample must have the same properties."""
         assert not self.__locked
         assert self.samplewidth == other.samplewidth
+        assert self.__float == other.__float
         assert self.samplerate == other.samplerate
         assert self.nchannels == other.nchannels
         self.__frames += other.__frames
@@ -440,6 +669,10 @@ class Sample:
         end = self.__frames[i:]  # we fade this chunk
         numsamples = len(end)/self.__samplewidth
         decrease = 1-target_volume
+        if self.__float:
+            values = numpy.frombuffer(end, dtype=numpy_float_dtype)
+            self.__frames = begin + (values * (1 - numpy.arange(len(values)) / numsamples * decrease)).astype(numpy_float_dtype).tobytes()
+            return self
         for i in range(int(numsamples)):
             amplitude = 1-(i/numsamples)*decrease
             s = audioop.getsample(end, self.__samplewidth, i)
@@ -460,6 +693,10 @@ class Sample:
         end = self.__frames[i:]
         numsamples = len(begin)/self.__samplewidth
         increase = 1-start_volume
+        if self.__float:
+            values = numpy.frombuffer(begin, dtype=numpy_float_dtype)
+            self.__frames = (values * (numpy.arange(len(values)) * increase / numsamples + start_volume)).astype(numpy_float_dtype).tobytes() + end
+            return self
         for i in range(int(numsamples)):
             amplitude = i*increase/numsamples+start_volume
             s = audioop.getsample(begin, self.__samplewidth, i)
@@ -487,8 +724,9 @@ class Sample:
             modulator = (v/biggest for v in itertools.cycle(modulator))
         else:
             modulator = iter(modulator)
+        to_value = float if self.__float else int
         for i in range(len(frames)):
-            frames[i] = int(frames[i] * next(modulator))
+            frames[i] = to_value(frames[i] * next(modulator))
         self.__frames = frames.tobytes()
         if sys.byteorder == "big":
             self.__frames = audioop.byteswap(self.__frames, self.__samplewidth)
@@ -534,6 +772,9 @@ class Sample:
     def bias(self, bias):
         """Add a bias constant to each sample value."""
         assert not self.__locked
+        if self.__float:
+            self.__frames = self.__numpy_to_frames(self.__frames_to_numpy() + numpy.float32(bias))
+            return self
         self.__frames = audioop.bias(self.__frames, self.__samplewidth, bias)
         return self
 
@@ -543,7 +784,11 @@ class Sample:
         if self.__nchannels == 1:
             return self
         if self.__nchannels == 2:
-            self.__frames = audioop.tomono(self.__frames, self.__samplewidth, left_factor, right_factor)
+            if self.__float:
+                values = self.__frames_to_numpy()
+                self.__frames = self.__numpy_to_frames(values[:, 0] * left_factor + values[:, 1] * right_factor)
+            else:
+                self.__frames = audioop.tomono(self.__frames, self.__samplewidth, left_factor, right_factor)
             self.__nchannels = 1
             return self
         raise ValueError("sample must be stereo or mono already")
@@ -569,12 +814,21 @@ class Sample:
         """
         assert not self.__locked
         if self.__nchannels == 2:
+            if numpy:
+                # scale both channels in a single pass (the values are floored, like audioop does)
+                values = self.__frames_to_numpy() * numpy.array([left_factor, right_factor])
+                self.__frames = self.__numpy_to_frames(values if self.__float else numpy.floor(values))
+                return self
             # first split the left and right channels and then remix them
             right = self.copy().right()
             self.left().amplify(left_factor)
             return self.stereo_mix(right, 'R', right_factor)
         if self.__nchannels == 1:
-            self.__frames = audioop.tostereo(self.__frames, self.__samplewidth, left_factor, right_factor)
+            if self.__float:
+                values = self.__frames_to_numpy()
+                self.__frames = self.__numpy_to_frames(values * numpy.array([left_factor, right_factor], dtype=numpy.float32))
+            else:
+                self.__frames = audioop.tostereo(self.__frames, self.__samplewidth, left_factor, right_factor)
             self.__nchannels = 2
             return self
         raise ValueError("sample must be mono or stereo already")
@@ -589,6 +843,7 @@ class Sample:
         assert other.__nchannels == 1
         assert other.__samplerate == self.__samplerate
         assert other.__samplewidth == self.__samplewidth
+        assert other.__float == self.__float
         assert other_channel in ('L', 'R')
         if self.__nchannels == 1:
             # turn self into stereo first
@@ -607,12 +862,24 @@ class Sample:
     def pan(self, panning=0, lfo=None):
         """
         Linear Stereo panning, -1 = full left, 1 = full right.
-        If you provide a LFO that will be used for panning instead.
+        If you provide a LFO that will be used for panning instead. That can also be a block of
+        precomputed panning values (an array or sequence with a value for every frame).
         """
         assert not self.__locked
-        if not lfo:
+        if lfo is None:
             return self.stereo((1-panning)/2, (1+panning)/2)
+        if numpy:
+            panning = self.__lfo_values(lfo)
+            gains = numpy.empty((len(panning), 2))
+            gains[:, 0] = 1 - panning
+            gains[:, 1] = 1 + panning
+            gains *= 0.5
+            # mono samples become stereo here, because the values are broadcast over both gain columns
+            self.__frames = self.__numpy_to_frames(self.__frames_to_numpy() * gains)
+            self.__nchannels = 2
+            return self
         lfo = iter(lfo)
+        to_value = float if self.__float else int
         if self.__nchannels == 2:
             right = self.copy().right().get_frame_array()
             left = self.copy().left().get_frame_array()
@@ -621,42 +888,151 @@ class Sample:
                 panning = next(lfo)
                 left_s = left[i]*(1-panning)/2
                 right_s = right[i]*(1+panning)/2
-                stereo[i*2] = int(left_s)
-                stereo[i*2+1] = int(right_s)
+                stereo[i*2] = to_value(left_s)
+                stereo[i*2+1] = to_value(right_s)
         else:
             mono = self.get_frame_array()
             stereo = mono+mono
             for i, sample in enumerate(mono):
                 panning = next(lfo)
-                stereo[i*2] = int(sample*(1-panning)/2)
-                stereo[i*2+1] = int(sample*(1+panning)/2)
+                stereo[i*2] = to_value(sample*(1-panning)/2)
+                stereo[i*2+1] = to_value(sample*(1+panning)/2)
             self.__nchannels = 2
         self.__frames = Sample.from_array(stereo, self.__samplerate, 2).__frames
         return self
 
+    def __lfo_values(self, lfo):
+        # the next value of the lfo for every frame, as a numpy array. The lfo can also be a block of values already.
+        nframes = len(self)
+        if isinstance(lfo, (numpy.ndarray, list, tuple, array.array)):
+            if len(lfo) < nframes:
+                raise ValueError("not enough lfo values for the sample")
+            return numpy.asarray(lfo, dtype=float)[:nframes]
+        return numpy.fromiter(itertools.islice(lfo, nframes), dtype=float, count=nframes)
+
+    def balance(self, balance):
+        """
+        Stereo balance, -1 = only the left channel, 0 = unchanged, 1 = only the right channel.
+        The channel on the side of the balance keeps its volume, the other one is attenuated.
+        A mono sample is made stereo first.
+        """
+        assert not self.__locked
+        assert -1 <= balance <= 1
+        if self.__nchannels == 1:
+            self.stereo()
+        return self.stereo(min(1.0, 1.0-balance), min(1.0, 1.0+balance))
+
+    def stereo_width(self, width):
+        """
+        Changes the width of the stereo image, using mid/side processing.
+        0 = mono (both channels the same), 1 = unchanged, >1 = wider (this may clip).
+        """
+        assert not self.__locked
+        assert self.__nchannels == 2
+        assert width >= 0
+        if numpy:
+            values = self.__frames_to_numpy()
+            mid = values[:, 0] * 0.5 + values[:, 1] * 0.5
+            side = values[:, 0] * (0.5 * width) - values[:, 1] * (0.5 * width)
+            result = numpy.empty((len(mid), 2))
+            if self.__float:
+                numpy.add(mid, side, out=result[:, 0])
+                numpy.subtract(mid, side, out=result[:, 1])
+            else:
+                # floored and clipped at the same steps as the audioop operations of the fallback below,
+                # in units of the sample width (24 bits values are handled as 32 bits values)
+                unit = 256 if self.__samplewidth == 3 else 1
+                maxvalue = 2 ** (8 * self.__samplewidth - 1)
+                mid = numpy.floor(mid / unit)
+                side = numpy.floor(numpy.clip(side / unit, -maxvalue, maxvalue - 1))
+                numpy.add(mid, side, out=result[:, 0])
+                numpy.add(mid, numpy.minimum(-side, maxvalue - 1), out=result[:, 1])
+                numpy.clip(result, -maxvalue, maxvalue - 1, out=result)
+                result *= unit
+            self.__frames = self.__numpy_to_frames(result)
+            return self
+        mid = self.copy().mono(0.5, 0.5)
+        side = self.copy().mono(0.5*width, -0.5*width)
+        left = mid.copy().mix(side)
+        right = mid.mix(side.invert())
+        return self.copy_from(left).stereo_mix(right, 'R')
+
+    def swap_channels(self):
+        """Swaps the left and right channels."""
+        assert not self.__locked
+        assert self.__nchannels == 2
+        if numpy:
+            self.__frames = self.__numpy_to_frames(self.__frames_to_numpy()[:, ::-1])
+            return self
+        left = self.copy().left()
+        return self.right().stereo_mix(left, 'R')
+
     def echo(self, length, amount, delay, decay):
         """
         Adds the given amount of echos into the end of the sample,
         using a given length of sample data (from the end of the sample).
         The decay is the factor with which each echo is decayed in volume (can be >1 to increase in volume instead).
-        If you use a very short delay the echos blend into the sound and the effect is more like a reverb.
+        If you use a very short delay the echos blend into the sound and the effect is more like a reverb
+        (but for a real reverb, see the reverb method).
+        Every echo is the previous echo decayed once more, so echo k has a gain of decay**(1+2+...+k).
+        That can't be done by a feedback delay line with a single decay factor (see effects.Echo), so with numpy
+        every echo is added separately, with one vectorized multiply-add over the used length of sample data.
+        Echos whose gain is too small to be heard are skipped.
         """
         assert not self.__locked
         if amount > 0:
+            # avoid computing echos that you can't hear
+            threshold = 1.0/(2**(8*(3 if self.__float else self.__samplewidth)-1))
+            audible = 0
+            echo_amp = decay
+            while audible < amount and echo_amp >= threshold:
+                audible += 1
+                echo_amp *= decay
             length = max(0, self.duration - length)
+            if numpy and audible and delay > 0:
+                values = self.__frames_to_numpy()
+                start = self.frame_idx(length) // self.__samplewidth // self.__nchannels
+                delay_frames = max(1, int(round(delay * self.samplerate)))
+                tail = values[start:]
+                result = numpy.zeros((len(values) + audible*delay_frames, self.__nchannels))
+                result[:len(values)] = values
+                for echo in range(1, audible + 1):
+                    gain = decay ** (echo * (echo + 1) // 2)
+                    if abs(gain) < threshold:
+                        break   # the gains only get smaller from here
+                    offset = start + echo*delay_frames
+                    result[offset:offset + len(tail)] += gain * tail
+                self.__frames = self.__numpy_to_frames(result if self.__float else numpy.rint(result))
+                return self
             echo = self.copy()
             echo.__frames = self.__frames[self.frame_idx(length):]
             echo_amp = decay
-            for _ in range(amount):
-                if echo_amp < 1.0/(2**(8*self.__samplewidth-1)):
-                    # avoid computing echos that you can't hear
-                    break
+            for _ in range(audible):
                 length += delay
                 echo = echo.copy().amplify(echo_amp)
                 self.mix_at(length, echo)
                 echo_amp *= decay
         return self
 
+    def reverb(self, impulse_response, wet=0.3, dry=1.0):
+        """
+        Convolution reverb with the impulse response (a Sample, of a room for instance), see effects.ConvolutionReverb.
+        The sample is made longer by the duration of the impulse response, to let the reverb ring out.
+        Requires numpy.
+        """
+        assert not self.__locked
+        if not numpy:
+            raise RuntimeError("numpy is required for the reverb")
+        from synthesizer.effects import ConvolutionReverb
+        reverb = ConvolutionReverb(impulse_response, wet, dry)
+        reverb.set_params(self.samplerate, self.__nchannels, None)
+        values = numpy.zeros((len(self) + int(impulse_response.duration*self.samplerate), self.__nchannels))
+        values[:len(self)] = self.__frames_to_numpy()
+        values = reverb.process(values, 0)
+        self.__frames = self.__numpy_to_frames(values if self.__float else numpy.rint(values))
+        self.__nchannels = values.shape[1]
+        return self
+
     def envelope(self, attack, decay, sustainlevel, release):
         """Apply an ADSR volume envelope. A,D,R are in seconds, Sustainlevel is a factor."""
         assert not self.__locked
@@ -684,6 +1060,7 @@ class Sample:
         """
         assert not self.__locked
         assert self.samplewidth == other.samplewidth
+        assert self.__float == other.__float
         assert self.samplerate == other.samplerate
         assert self.nchannels == other.nchannels
         frames1 = self.__frames
@@ -696,7 +1073,7 @@ class Sample:
                 frames1 += b"\0"*(len(frames2)-len(frames1))
             elif len(frames2) < len(frames1):
                 frames2 += b"\0"*(len(frames1)-len(frames2))
-        self.__frames = audioop.add(frames1, frames2, self.samplewidth)
+        self.__frames = self.__add_frames(frames1, frames2)
         return self
 
     def mix_at(self, seconds, other, other_seconds=None):
@@ -708,6 +1085,7 @@ class Sample:
             return self.mix(other, other_seconds)
         assert not self.__locked
         assert self.samplewidth == other.samplewidth
+        assert self.__float == other.__float
         assert self.samplerate == other.samplerate
         assert self.nchannels == other.nchannels
         start_frame_idx = self.frame_idx(seconds)
@@ -718,11 +1096,17 @@ class Sample:
         # Mix the frames. Unfortunately audioop requires splitting and copying the sample data, which is slow.
         pre, to_mix, post = self._mix_split_frames(len(other_frames), start_frame_idx)
         self.__frames = None  # allow for garbage collection
-        mixed = audioop.add(to_mix, other_frames, self.samplewidth)
+        mixed = self.__add_frames(to_mix, other_frames)
         del to_mix  # more garbage collection
         self.__frames = self._mix_join_frames(pre, mixed, post)
         return self
 
+    def __add_frames(self, frames1, frames2):
+        # integer samples are clipped by audioop, floating-point samples don't need that
+        if self.__float:
+            return (numpy.frombuffer(frames1, dtype=numpy_float_dtype) + numpy.frombuffer(frames2, dtype=numpy_float_dtype)).tobytes()
+        return audioop.add(frames1, frames2, self.samplewidth)
+
     def _mix_join_frames(self, pre, mid, post):
         # warning: slow due to copying (but only significant when not streaming)
         return pre + mid + post
@@ -743,46 +1127,378 @@ class Sample:
             self.__frames += b"\0" * (required_length - len(self.__frames))
 
 
+class FrameRingBuffer:
+    """
+    Preallocated ring buffer of audio frames, for one writer thread and one reader thread.
+    It doesn't need locks: the read and write positions are ever increasing byte counters
+    and each of them is only ever changed by one side. The writer blocks while the buffer is full.
+    """
+    def __init__(self, capacity_frames, framesize):
+        self.framesize = framesize
+        self.capacity = capacity_frames * framesize
+        self.buffer = bytearray(self.capacity)
+        self.view = memoryview(self.buffer)
+        self.write_position = 0
+        self.read_position = 0
+        self.discard_requested = False
+        self.space_available = threading.Event()
+
+    @property
+    def capacity_frames(self):
+        return self.capacity // self.framesize
+
+    @property
+    def queued_frames(self):
+        return (self.write_position - self.read_position) // self.framesize
+
+    def write(self, data):
+        """Writes the frames into the buffer, waits for free space as long as needed."""
+        data = memoryview(data).cast("B")
+        offset = 0
+        while offset < len(data):
+            free = self.capacity - (self.write_position - self.read_position)
+            if not free:
+                self.space_available.clear()
+                if self.capacity == self.write_position - self.read_position:
+                    self.space_available.wait(0.1)
+                continue
+            amount = min(free, len(data) - offset)
+            position = self.write_position % self.capacity
+            first = min(amount, self.capacity - position)
+            self.view[position:position + first] = data[offset:offset + first]
+            if amount > first:
+                self.view[:amount - first] = data[offset + first:offset + amount]
+            self.write_position += amount   # only now the reader can see the new frames
+            offset += amount
+
+    def read_into(self, destination):
+        """Copies as many whole frames as available (and fit) into the destination buffer. Returns the number of bytes."""
+        if self.discard_requested:
+            self.read_position = self.write_position
+            self.discard_requested = False
+        available = self.write_position - self.read_position
+        amount = min(available, len(destination))
+        amount -= amount % self.framesize
+        position = self.read_position % self.capacity
+        first = min(amount, self.capacity - position)
+        destination[:first] = self.view[position:position + first]
+        if amount > first:
+            destination[first:amount] = self.view[:amount - first]
+        self.read_position += amount
+        self.space_available.set()
+        return amount
+
+    def clear(self):
+        """Discards the queued frames. (this is done by the reader, the next time it reads)"""
+        self.discard_requested = True
+
+
+class StreamingWavWriter:
+    """
+    Writes a wav file from a stream of sample data, for (very) long recordings.
+    All writes are collected into a large buffer that is written to the file in one go, so the file is
+    written in big chunks at block-aligned positions, no matter how small the writes are.
+    The sizes in the header are only filled in when the file is closed. If the data grew beyond
+    what a normal wav file can hold (4 Gb), the file is turned into an RF64 file instead.
+    (the space for its extra header chunk is reserved with a JUNK chunk, as the RF64 spec recommends)
+    """
+    buffer_size = 4 * 1024 * 1024
+
+    def __init__(self, filename, samplerate, samplewidth, nchannels, fsync=False):
+        self.file = open(filename, "wb")
+        self.fsync = fsync
+        self.samplewidth = samplewidth
+        self.nchannels = nchannels
+        self.data_size = 0
+        blockalign = samplewidth * nchannels
+        header = struct.pack("<4sI4s4sI28s4sIHHIIHH4sI", b"RIFF", 0, b"WAVE", b"JUNK", 28, b"", b"fmt ", 16, 1,
+                             nchannels, samplerate, samplerate * blockalign, blockalign, 8 * samplewidth, b"data", 0)
+        self.data_offset = len(header)
+        self.buffer = bytearray(self.buffer_size)
+        self.buffer[:len(header)] = header
+        self.buffered = len(header)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, frames):
+        frames = memoryview(frames).cast("B")
+        self.data_size += len(frames)
+        offset = 0
+        while offset < len(frames):
+            amount = min(len(frames) - offset, self.buffer_size - self.buffered)
+            self.buffer[self.buffered:self.buffered + amount] = frames[offset:offset + amount]
+            self.buffered += amount
+            offset += amount
+            if self.buffered == self.buffer_size:
+                self.file.write(self.buffer)
+                self.buffered = 0
+
+    def close(self):
+        if self.file.closed:
+            return
+        if self.data_size & 1:
+            self.write(b"\0")     # chunks are padded to an even size
+            self.data_size -= 1
+        self.file.write(memoryview(self.buffer)[:self.buffered])
+        riff_size = self.data_offset - 8 + self.data_size + (self.data_size & 1)
+        if riff_size <= 0xffffffff:
+            self.file.seek(4)
+            self.file.write(struct.pack("<I", riff_size))
+            self.file.seek(self.data_offset - 4)
+            self.file.write(struct.pack("<I", self.data_size))
+        else:
+            self.file.seek(0)
+            self.file.write(struct.pack("<4sI4s4sIQQQI", b"RF64", 0xffffffff, b"WAVE", b"ds64", 28, riff_size,
+                                        self.data_size, self.data_size // (self.samplewidth * self.nchannels), 0))
+            self.file.seek(self.data_offset - 4)
+            self.file.write(struct.pack("<I", 0xffffffff))
+        self.file.flush()
+        if self.fsync:
+            os.fsync(self.file.fileno())
+        self.file.close()
+
+
+class OutputDevice:
+    """
+    Base class of the audio devices that Output can play on.
+    A device has a start(samplerate, samplewidth, nchannels, period_frames, fill_period) method, that makes it
+    start pulling the audio by itself, one period of frames at a time, by calling the fill_period function.
+    fill_period(nframes) returns a buffer with exactly that many frames.
+    """
+    latency = 0.0   # the latency of the device itself, in seconds
+
+    def close(self):
+        pass
+
+
+class PyAudioDevice(OutputDevice):
+    """Audio output device using a PyAudio stream in callback mode."""
+    def __init__(self):
+        self.audio = pyaudio.PyAudio()
+        self.stream = None
+
+    @staticmethod
+    def pyaudio_format_from_width(width):
+        if width == 2:
+            return pyaudio.paInt16
+        elif width == 3:
+            return pyaudio.paInt24
+        elif width == 4:
+            return pyaudio.paInt32
+        else:
+            raise ValueError("Invalid width: %d" % width)
+
+    def start(self, samplerate, samplewidth, nchannels, period_frames, fill_period):
+        def callback(in_data, frame_count, time_info, status):
+            # pyaudio only accepts an immutable buffer, so this is the one copy that can't be avoided
+            return bytes(fill_period(frame_count)), pyaudio.paContinue
+        self.stream = self.audio.open(format=self.pyaudio_format_from_width(samplewidth), channels=nchannels,
+                                      rate=samplerate, output=True, frames_per_buffer=period_frames,
+                                      stream_callback=callback)
+
+    @property
+    def latency(self):
+        return self.stream.get_output_latency() if self.stream else 0.0
+
+    def close(self):
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+        if self.audio:
+            self.audio.terminate()
+            self.audio = None
+
+
+class VirtualClockDevice(OutputDevice):
+    """
+    Output device that doesn't need sound hardware. A thread pulls the periods of audio on a virtual clock
+    that runs at exactly real-time rate (or speed times faster), and discards them or writes them to a wav file.
+    It counts the periods it couldn't pull on time, so you can load-test the real-time audio path headless.
+    """
+    def __init__(self, speed=1.0, filename=None):
+        assert speed > 0
+        self.speed = speed
+        self.filename = filename
+        self.wav = None
+        self.samplerate = 0
+        self.frames_played = 0
+        self.late_periods = 0
+        self.max_lateness = 0.0     # seconds
+        self.stopped = threading.Event()
+        self.thread = None
+
+    @property
+    def clock(self):
+        """The virtual time (seconds) that has been played so far."""
+        return self.frames_played / self.samplerate if self.samplerate else 0.0
+
+    def start(self, samplerate, samplewidth, nchannels, period_frames, fill_period):
+        self.samplerate = samplerate
+        if self.filename:
+            self.wav = StreamingWavWriter(self.filename, samplerate, samplewidth, nchannels)
+        self.thread = threading.Thread(target=self._pull_periods, args=(period_frames, fill_period),
+                                       name="virtualclockdevice", daemon=True)
+        self.thread.start()
+
+    def _pull_periods(self, period_frames, fill_period):
+        period_time = period_frames / self.samplerate / self.speed
+        next_time = time.perf_counter()
+        while not self.stopped.is_set():
+            frames = fill_period(period_frames)
+            if self.wav:
+                self.wav.write(frames)
+            self.frames_played += period_frames
+            next_time += period_time
+            delay = next_time - time.perf_counter()
+            if delay < 0:
+                # we're late; a real device would have skipped, don't try to catch up
+                self.late_periods += 1
+                self.max_lateness = max(self.max_lateness, -delay)
+                next_time = time.perf_counter()
+            else:
+                self.stopped.wait(delay)
+
+    def close(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+        if self.wav:
+            self.wav.close()
+            self.wav = None
+
+
 class Output:
     """Plays samples to audio output device or streams them to a file."""
 
     class SoundOutputter(threading.Thread):
-        """Sound outputter running in its own thread. Requires PyAudio."""
-        def __init__(self, samplerate, samplewidth, nchannels, queuesize=100):
+        """
+        Sound outputter running in its own thread. Requires PyAudio, or another OutputDevice.
+        The thread moves the queued samples into a preallocated ring buffer of frames. The audio device pulls
+        fixed size periods from that buffer by itself (callback mode), so it never has to wait on the code that
+        produces the samples. If the ring buffer runs dry while audio is playing, that is counted as an underrun.
+        """
+        period_frames = 1024    # frames the device pulls at once
+        buffer_periods = 8      # size of the ring buffer
+
+        def __init__(self, samplerate, samplewidth, nchannels, queuesize=100, device=None):
             super().__init__(name="soundoutputter", daemon=True)
-            self.audio = pyaudio.PyAudio()
-            self.stream = self.audio.open(
-                format=self.pyaudio_format_from_width(samplewidth),
-                channels=nchannels, rate=samplerate, output=True)
+            self.samplerate = samplerate
+            self.framesize = samplewidth * nchannels
             self.queue = queue.Queue(maxsize=queuesize)
-
-        def pyaudio_format_from_width(self, width):
-            if width == 2:
-                return pyaudio.paInt16
-            elif width == 3:
-                return pyaudio.paInt24
-            elif width == 4:
-                return pyaudio.paInt32
-            else:
-                raise ValueError("Invalid width: %d" % width)
+            self.ring = FrameRingBuffer(self.period_frames * self.buffer_periods, self.framesize)
+            self.period_buffer = bytearray(self.period_frames * self.framesize)
+            self.silence = bytes(len(self.period_buffer))
+            self.frames_queued = 0      # counted by the producing side
+            self.frames_dequeued = 0    # counted by the outputter thread
+            self.underruns = 0
+            self.playing = False
+            self.wiped = False
+            self.drain_position = 0
+            self.drain_events = collections.deque()     # (ring position, event) to set when played up to there
+            self.latency_marks = collections.deque()    # (ring position, time) where a sample starts, and when it was queued
+            self.last_latency = 0.0
+            self.max_latency = 0.0
+            self.max_jitter = 0.0
+            self.last_period_time = None
+            self.scratch_values = None          # reusable buffers for the conversion to 16 bits
+            self.converted_values = None
+            self.device = device or PyAudioDevice()
+            self.device.start(samplerate, samplewidth, nchannels, self.period_frames, self.fill_period)
 
         def run(self):
             while True:
-                sample = self.queue.get()
-                if not sample:
+                item = self.queue.get()
+                if item is None:
                     break
-                sample.write_frames(self.stream)
-            # time.sleep(self.stream.get_output_latency()+self.stream.get_input_latency()+0.001)
+                if isinstance(item, threading.Event):
+                    self.add_drain_event(item)
+                    continue
+                queued_time, sample, amplification = item
+                self.frames_dequeued += len(sample)
+                self.latency_marks.append((self.ring.write_position, queued_time))
+                if amplification is None:
+                    sample.write_frames(self.ring)
+                else:
+                    self.ring.write(self.convert_to_16bit(sample.view_frame_data(), amplification, sample.is_float))
+            # let the device play what's left in the ring buffer, then stop it
+            played = threading.Event()
+            self.add_drain_event(played)
+            played.wait(self.ring.capacity_frames / self.samplerate + 1.0)
+            self.device.close()
+
+        def convert_to_16bit(self, frames, amplification, is_float=False):
+            # the same as amplify(amplification).make_16bit(False) on a 32 bits sample,
+            # but into a buffer that is reused every time (if numpy is available).
+            # Floating-point values are scaled as if they were 32 bits samples in the 16 bits range.
+            if not numpy:
+                return audioop.lin2lin(audioop.mul(frames, 4, amplification), 4, 2)
+            if is_float:
+                values = numpy.frombuffer(frames, dtype=numpy_float_dtype)
+                amplification *= 32768
+            else:
+                values = numpy.frombuffer(frames, dtype=numpy_dtypes[4])
+            if self.scratch_values is None or len(self.scratch_values) < len(values):
+                self.scratch_values = numpy.empty(len(values))
+                self.converted_values = numpy.empty(len(values), dtype=numpy_dtypes[2])
+            scratch = self.scratch_values[:len(values)]
+            converted = self.converted_values[:len(values)]
+            numpy.multiply(values, amplification / 65536, out=scratch)
+            numpy.floor(scratch, out=scratch)
+            numpy.clip(scratch, -32768, 32767, out=scratch)
+            converted[...] = scratch
+            return converted.data
+
+        def add_drain_event(self, event):
+            # the event is set when the device has played everything that is in the ring buffer now
+            self.drain_position = self.ring.write_position
+            self.drain_events.append((self.drain_position, event))
+
+        def fill_period(self, nframes):
+            # called by the audio device for every period of audio it needs
+            now = time.perf_counter()
+            if self.last_period_time:
+                jitter = abs(now - self.last_period_time - nframes / self.samplerate)
+                self.max_jitter = max(self.max_jitter, jitter)
+            self.last_period_time = now
+            size = nframes * self.framesize
+            if len(self.period_buffer) < size:
+                self.period_buffer = bytearray(size)
+                self.silence = bytes(size)
+            period = memoryview(self.period_buffer)[:size]
+            amount = self.ring.read_into(period)
+            if amount < size:
+                period[amount:] = memoryview(self.silence)[:size - amount]
+                if self.playing and self.ring.read_position != self.drain_position and not self.wiped:
+                    self.underruns += 1
+                self.wiped = False
+                self.playing = False
+            else:
+                self.playing = True
+            while self.drain_events and self.ring.read_position >= self.drain_events[0][0]:
+                self.drain_events.popleft()[1].set()
+            while self.latency_marks and self.ring.read_position > self.latency_marks[0][0]:
+                self.last_latency = now - self.latency_marks.popleft()[1] + self.device.latency
+                self.max_latency = max(self.max_latency, self.last_latency)
+            return period
 
         def play_immediately(self, sample, continuous=False):
-            sample.write_frames(self.stream)
+            self.add_to_queue(sample)
             if not continuous:
-                filler = b"\0"*sample.samplewidth*sample.nchannels*self.stream.get_write_available()
-                self.stream.write(filler)
-                # time.sleep(self.stream.get_output_latency()+self.stream.get_input_latency()+0.001)
+                self.wait_until_played()
+
+        def add_to_queue(self, sample, amplification=None):
+            """If an amplification is given, the (32 bits or float) sample is converted to 16 bits with it, while outputting."""
+            self.queue.put((time.perf_counter(), sample, amplification))
+            self.frames_queued += len(sample)
 
-        def add_to_queue(self, sample):
-            self.queue.put(sample)
+        def wait_until_played(self):
+            played = threading.Event()
+            self.queue.put(played)
+            played.wait()
 
         _wipe_lock = threading.Lock()
 
@@ -790,27 +1506,61 @@ class Output:
             with self._wipe_lock:
                 try:
                     while True:
-                        self.queue.get(block=False)
+                        item = self.queue.get(block=False)
+                        if isinstance(item, threading.Event):
+                            item.set()
+                        elif item:
+                            self.frames_queued -= len(item[1])
                 except queue.Empty:
                     pass
+                self.wiped = True   # running out of audio now is not an underrun
+                self.ring.clear()
 
         def queue_size(self):
             return self.queue.qsize()
 
+        @property
+        def queued_frames(self):
+            """Frames waiting in the queue and the ring buffer."""
+            return self.frames_queued - self.frames_dequeued + self.ring.queued_frames
+
+        @property
+        def latency(self):
+            """How long it takes before a sample that is queued now, will be heard (in seconds)."""
+            return self.queued_frames / self.samplerate + self.device.latency
+
+        def stats(self):
+            stats = {
+                "underruns": self.underruns,
+                "queued_ms": 1000.0 * self.queued_frames / self.samplerate,
+                "latency_ms": 1000.0 * self.last_latency,
+                "max_latency_ms": 1000.0 * self.max_latency,
+                "max_jitter_ms": 1000.0 * self.max_jitter
+            }
+            self.max_latency = self.last_latency
+            self.max_jitter = 0.0
+            return stats
+
         def close(self):
-            if self.stream:
-                self.stream.close()
-                self.stream = None
-            if self.audio:
-                self.audio.terminate()
-                self.audio = None
-
-    def __init__(self, samplerate=Sample.norm_samplerate, samplewidth=Sample.norm_samplewidth, nchannels=Sample.norm_nchannels, queuesize=100):
+            # the thread plays what's left in the ring buffer and closes the device, wait until it has done that
+            if self.is_alive():
+                self.queue.put(None)
+                self.join()
+
+    def __init__(self, samplerate=Sample.norm_samplerate, samplewidth=Sample.norm_samplewidth, nchannels=Sample.norm_nchannels,
+                 queuesize=100, device=None):
+        """
+        The device is the OutputDevice that plays the audio. By default this is a PyAudio stream,
+        unless another device is configured in the environment (see device_from_environment).
+        """
         self.samplerate = samplerate
         self.samplewidth = samplewidth
         self.nchannels = nchannels
-        if pyaudio:
-            self.outputter = Output.SoundOutputter(samplerate, samplewidth, nchannels, queuesize)
+        self.closed = threading.Event()
+        if device is None:
+            device = self.device_from_environment()
+        if pyaudio or device:
+            self.outputter = Output.SoundOutputter(samplerate, samplewidth, nchannels, queuesize, device)
             self.outputter.start()
             self.supports_streaming = True
         else:
@@ -825,6 +1575,21 @@ class Output:
     def for_sample(cls, sample):
         return cls(sample.samplerate, sample.samplewidth, sample.nchannels)
 
+    @staticmethod
+    def device_from_environment():
+        """
+        Returns the output device configured in the SYNTHESIZER_OUTPUT environment variable, or None.
+        'virtual[:speed[:wavfile]]' selects a VirtualClockDevice, to run without sound hardware.
+        """
+        spec = os.environ.get("SYNTHESIZER_OUTPUT")
+        if not spec:
+            return None
+        name, _, options = spec.partition(":")
+        if name != "virtual":
+            raise ValueError("unknown output device: " + name)
+        speed, _, filename = options.partition(":")
+        return VirtualClockDevice(float(speed or 1.0), filename or None)
+
     def __enter__(self):
         return self
 
@@ -832,11 +1597,18 @@ class Output:
         self.close()
 
     def close(self):
+        self.closed.set()
         if self.outputter:
-            self.outputter.add_to_queue(None)
+            self.outputter.close()
 
     def play_sample(self, sample, async=False):
-        """Play a single sample."""
+        """Play a single sample. Floating-point samples are converted to the integer format of the output."""
+        if sample.is_float:
+            sample = sample.copy()
+            if self.samplewidth == 2:
+                sample.make_16bit(maximize_amplitude=False)
+            else:
+                sample.make_32bit()
         assert sample.samplewidth == self.samplewidth
         assert sample.samplerate == self.samplerate
         assert sample.nchannels == self.nchannels
@@ -847,6 +1619,9 @@ class Output:
                 self.outputter.play_immediately(sample)
         else:
             # try to fallback to winsound (only works on windows)
+            if not winsound:
+                raise RuntimeError("Sorry but pyaudio is not installed. You need it to play audio output "
+                                   "(or set SYNTHESIZER_OUTPUT to use a virtual output device).")
             sample_file = "__temp_sample.wav"
             sample.write_wav(sample_file)
             winsound.PlaySound(sample_file, winsound.SND_FILENAME)
@@ -855,11 +1630,20 @@ class Output:
     def play_samples(self, samples, async=False):
         """Plays all the given samples immediately after each other, with no pauses."""
         if self.outputter:
-            for s in self.normalized_samples(samples, 26000):
-                if async:
-                    self.outputter.add_to_queue(s)
+            for sample in samples:
+                if sample.samplewidth == 4:
+                    # 32 bits and floating-point samples are normalized to 16 bits by the outputter itself,
+                    # in the same way as normalized_samples does
+                    if sample.nchannels == 1:
+                        sample.stereo()
+                    assert sample.nchannels == 2
+                    assert sample.samplerate == 44100
+                    self.outputter.add_to_queue(sample, 26000)
                 else:
-                    self.outputter.play_immediately(s, True)
+                    for sample in self.normalized_samples([sample], 26000):
+                        self.outputter.add_to_queue(sample)
+            if not async:
+                self.outputter.wait_until_played()
         else:
             # winsound doesn't cut it when playing many small sample files...
             raise RuntimeError("Sorry but pyaudio is not installed. You need it to play streaming audio output.")
@@ -867,7 +1651,11 @@ class Output:
     def normalized_samples(self, samples, global_amplification=26000):
         """Generator that produces samples normalized to 16 bit using a single amplification value for all."""
         for sample in samples:
-            if sample.samplewidth != 2:
+            if sample.is_float:
+                # floating-point samples are in the 16 bits range when 1.0 is the maximum of that range,
+                # so they get the same amplification as 32 bits samples with 16 bits values would
+                sample = sample.amplify(global_amplification / 65536).make_16bit(False)
+            elif sample.samplewidth != 2:
                 # We can't use automatic global max amplitude because we're streaming
                 # the samples individually. So use a fixed amplification value instead
                 # that will be used to amplify all samples in stream by the same amount.
@@ -883,10 +1671,10 @@ class Output:
         """Saves the samples after each other into one single output wav file."""
         samples = self.normalized_samples(samples, 26000)
         sample = next(samples)
-        with Sample.wave_write_begin(filename, sample) as out:
+        with StreamingWavWriter(filename, sample.samplerate, sample.samplewidth, sample.nchannels) as out:
+            sample.write_frames(out)
             for sample in samples:
-                Sample.wave_write_append(out, sample)
-            Sample.wave_write_end(out)
+                sample.write_frames(out)
 
     def wipe_queue(self):
         """Remove all pending samples to be played from the queue"""
@@ -896,6 +1684,75 @@ class Output:
         """Return approximation of the number of items in the async play queue"""
         return self.outputter.queue_size()
 
+    def queued_frames(self):
+        """Return approximation of the number of frames still to be played (in the queue and the output buffer)"""
+        return self.outputter.queued_frames
+
+    def latency(self):
+        """Return approximation of the time (seconds) before a sample that is queued now, will be heard"""
+        return self.outputter.latency
+
+    def underruns(self):
+        """Return the number of times the output buffer ran dry while playing"""
+        return self.outputter.underruns
+
+    def stats(self):
+        """
+        Return a dict with statistics to tune the buffering with:
+        underruns (since the start), queued_ms (audio waiting to be played), latency_ms (time between queueing
+        the last sample and the device playing it), max_latency_ms, and max_jitter_ms (the largest deviation
+        of the time between two periods pulled by the device, from the period duration).
+        The maximums are measured since the previous call.
+        """
+        return self.outputter.stats()
+
+    def log_stats(self, interval=10.0, log=print):
+        """Periodically log the stats (using the log function) until the output is closed."""
+        def log_periodically():
+            while not self.closed.wait(interval):
+                log("output: underruns={underruns:d} queued={queued_ms:.0f}ms latency={latency_ms:.0f}ms "
+                    "(max {max_latency_ms:.0f}ms) jitter={max_jitter_ms:.1f}ms".format(**self.stats()))
+        threading.Thread(target=log_periodically, name="outputstats", daemon=True).start()
+
+
+class BufferSizeController:
+    """
+    Adapts the amount of audio that is kept buffered for an Output, to how well the system keeps up:
+    after underruns the buffer time grows, and when there haven't been any for a while it slowly shrinks
+    back again to get a lower latency. The buffer time never exceeds the latency ceiling.
+    Call update regularly (for instance every time you're about to produce more audio).
+    """
+    grow_factor = 1.5
+    shrink_factor = 0.9
+    stable_time = 30.0     # seconds without underruns before the buffer time is reduced
+
+    def __init__(self, output, min_buffer_time=0.05, latency_ceiling=1.0):
+        assert 0 < min_buffer_time <= latency_ceiling
+        self.output = output
+        self.min_buffer_time = min_buffer_time
+        self.latency_ceiling = latency_ceiling
+        self.buffer_time = min_buffer_time
+        self.underruns = output.underruns()
+        self.last_change = time.perf_counter()
+
+    def update(self):
+        """Checks for new underruns and adapts the buffer time. Returns the buffer time (in seconds)."""
+        now = time.perf_counter()
+        underruns = self.output.underruns()
+        if underruns > self.underruns:
+            self.buffer_time = min(self.latency_ceiling, self.buffer_time * self.grow_factor)
+            self.last_change = now
+        elif now - self.last_change >= self.stable_time and self.buffer_time > self.min_buffer_time:
+            self.buffer_time = max(self.min_buffer_time, self.buffer_time * self.shrink_factor)
+            self.last_change = now
+        self.underruns = underruns
+        return self.buffer_time
+
+    def block_frames(self, samplerate, smallest=1024, largest=16384):
+        """A block size (power of two) to produce the audio in, of about half the buffer time."""
+        frames = max(smallest, min(largest, int(self.buffer_time * samplerate / 2)))
+        return 2 ** int(math.log(frames, 2))
+
 
 # noinspection PyAttributeOutsideInit
 class LevelMeter:
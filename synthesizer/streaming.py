@@ -8,16 +8,29 @@ import subprocess
 import shutil
 import json
 import wave
+import struct
+import audioop
 import os
 import io
+import sys
+import math
+import heapq
+import threading
+import itertools
+import tempfile
 from functools import namedtuple
 from synthesizer.sample import Sample
+from synthesizer.probecache import AudioFormatProbe, FormatProbeCache
+try:
+    import numpy
+except ImportError:
+    numpy = None
+else:
+    from synthesizer.resampler import Resampler
 
 
-__all__ = ["AudiofileToWavStream", "StreamMixer", "VolumeFilter", "EndlessFramesFilter", "SampleStream"]
-
-
-AudioFormatProbe = namedtuple("AudioFormatProbe", ["rate", "channels", "sampformat", "fileformat", "duration"])
+__all__ = ["AudiofileToWavStream", "StreamMixer", "VolumeFilter", "GainRampFilter", "EndlessFramesFilter", "SampleStream", "ReadAheadReader", "FormatProbeCache",
+           "PrefetchedWavStream", "ResamplingReader", "SampleReader"]
 
 
 class AudiofileToWavStream(io.RawIOBase):
@@ -25,6 +38,7 @@ class AudiofileToWavStream(io.RawIOBase):
     Streams WAV PCM audio data from the given sound source file.
     If the file is not already a .wav, and/or you want to resample it,
     ffmpeg/ffprobe are used to convert it in the background.
+    Wav files are recognised and converted in-process instead, if possible (see WavConversionStream).
     For HQ resampling, ffmpeg has to be built with libsoxr support.
 
     Input: audio file of any supported format
@@ -32,6 +46,8 @@ class AudiofileToWavStream(io.RawIOBase):
     """
     ffmpeg_executable = "ffmpeg"
     ffprobe_executable = "ffprobe"
+    probe_cache = FormatProbeCache()    # set to None to always run ffprobe
+    _hq_resample_support = {}   # ffmpeg executable->libsoxr support
 
     def __init__(self, filename, outputfilename=None, samplerate=Sample.norm_samplerate,
                  channels=Sample.norm_nchannels, sampleformat=str(8*Sample.norm_samplewidth), hqresample=True):
@@ -45,7 +61,17 @@ class AudiofileToWavStream(io.RawIOBase):
         self.sampleformat_options = []
         self.conversion_required = True
         self.format_probe = None
-        if self.ffprobe_executable:
+        self.wav_conversion = None
+        wav_format = WavConversionStream.read_format(filename)
+        if wav_format:
+            # it's a wav file, we know its format from the header and don't have to run ffprobe
+            probe = wav_format.probe()
+            self.conversion_required = probe.rate != samplerate or probe.channels != channels \
+                                       or probe.sampformat != sampleformat
+            self.format_probe = probe
+            if self.conversion_required and WavConversionStream.can_convert(wav_format, samplerate, channels, sampleformat, hqresample):
+                self.wav_conversion = (wav_format, samplerate, channels, sampleformat, hqresample)
+        elif self.ffprobe_executable:
             try:
                 # probe the existing file format, to see if we can avoid needless conversion
                 probe = self.probe_format(self.filename)
@@ -54,7 +80,7 @@ class AudiofileToWavStream(io.RawIOBase):
                 self.format_probe = probe
             except (subprocess.CalledProcessError, IOError, OSError):
                 pass
-        if self.conversion_required:
+        if self.conversion_required and not self.wav_conversion:
             if samplerate:
                 samplerate = int(samplerate)
                 assert 2000 <= samplerate <= 200000
@@ -83,11 +109,19 @@ class AudiofileToWavStream(io.RawIOBase):
 
     @classmethod
     def supports_hq_resample(cls):
-        buildconf = subprocess.check_output([cls.ffmpeg_executable, "-v", "error", "-buildconf"]).decode()
-        return "--enable-libsoxr" in buildconf
+        """Is ffmpeg compiled with libsoxr? (this is only checked once per process)"""
+        if cls.ffmpeg_executable not in cls._hq_resample_support:
+            buildconf = subprocess.check_output([cls.ffmpeg_executable, "-v", "error", "-buildconf"]).decode()
+            cls._hq_resample_support[cls.ffmpeg_executable] = "--enable-libsoxr" in buildconf
+        return cls._hq_resample_support[cls.ffmpeg_executable]
 
     @classmethod
     def probe_format(cls, filename):
+        """Probe the audio format of the file using ffprobe. The result is cached in the probe_cache, if set."""
+        if cls.probe_cache:
+            probe = cls.probe_cache.get(filename)
+            if probe:
+                return probe
         command = [cls.ffprobe_executable, "-v", "error", "-print_format", "json", "-show_format", "-show_streams", "-i", filename]
         probe = subprocess.check_output(command)
         probe = json.loads(probe.decode())
@@ -105,7 +139,10 @@ class AudiofileToWavStream(io.RawIOBase):
         fileformat = probe["format"]["format_name"]
         duration = probe["format"].get("duration") or stream.get("duration")
         duration = float(duration) if duration else None
-        return AudioFormatProbe(samplerate, nchannels, sampleformat, fileformat, duration)
+        probe = AudioFormatProbe(samplerate, nchannels, sampleformat, fileformat, duration)
+        if cls.probe_cache:
+            cls.probe_cache.put(filename, probe)
+        return probe
 
     def start_stream(self):
         if not self.conversion_required:
@@ -115,6 +152,13 @@ class AudiofileToWavStream(io.RawIOBase):
                         shutil.copyfileobj(source, dest)
                 return
             self.stream = open(self.filename, "rb")
+        elif self.wav_conversion:
+            converter = WavConversionStream(self.filename, *self.wav_conversion)
+            if self.outputfilename:
+                converter.write_file(self.outputfilename)
+                converter.close()
+                return
+            self.stream = converter
         else:
             command = [self.ffmpeg_executable, "-v", "error", "-hide_banner", "-loglevel", "error", "-i", self.filename, "-f", "wav"]
             command.extend(self.resample_options)
@@ -144,20 +188,562 @@ class AudiofileToWavStream(io.RawIOBase):
             return True
 
 
+class WavFileFormat(namedtuple("WavFileFormat", ["formatcode", "rate", "channels", "samplewidth", "data_offset", "data_size"])):
+    """The audio format of a wav file, as read from its header. See WavConversionStream.read_format"""
+    @property
+    def sampleformat(self):
+        if self.formatcode == WavConversionStream.WAVE_FORMAT_IEEE_FLOAT:
+            return "float"
+        return str(8*self.samplewidth)
+
+    @property
+    def duration(self):
+        if self.data_size is None:
+            return None
+        return self.data_size / self.samplewidth / self.channels / self.rate
+
+    def probe(self):
+        return AudioFormatProbe(self.rate, self.channels, self.sampleformat, "wav", self.duration)
+
+
+class WavConversionStream(io.RawIOBase):
+    """
+    Streams WAV PCM audio data converted from another wav file, without using an external process.
+    Converts integer and floating point sample formats, the number of channels (mono/stereo),
+    and the sample rate (using the simple audioop algorithm, or the Resampler for hq resampling).
+    The conversion is done in large chunks at a time; numpy is required to convert floating point samples
+    and for hq resampling.
+    """
+    WAVE_FORMAT_PCM = 1
+    WAVE_FORMAT_IEEE_FLOAT = 3
+    WAVE_FORMAT_EXTENSIBLE = 0xfffe
+    sampleformat_widths = {"8": 1, "16": 2, "24": 3, "32": 4, "float": 4}
+    chunk_frames = 65536
+
+    def __init__(self, filename, wav_format, samplerate=None, channels=None, sampleformat=None, hqresample=False):
+        self.wav_format = wav_format
+        self.samplerate = int(samplerate or wav_format.rate)
+        self.nchannels = int(channels or wav_format.channels)
+        self.sampleformat = sampleformat or wav_format.sampleformat
+        self.samplewidth = self.sampleformat_widths[self.sampleformat]
+        self.file = open(filename, "rb")
+        self.file.seek(wav_format.data_offset)
+        self.remaining = wav_format.data_size
+        self.ratecv_state = None
+        self.resampler = None
+        if hqresample and self.samplerate != wav_format.rate:
+            self.resampler = Resampler(wav_format.rate, self.samplerate, self.nchannels)
+        data_size = 0xffffffff
+        if wav_format.data_size is not None and self.samplerate == wav_format.rate:
+            data_size = wav_format.data_size // wav_format.samplewidth // wav_format.channels * self.samplewidth * self.nchannels
+        self.formatcode = self.WAVE_FORMAT_IEEE_FLOAT if self.sampleformat == "float" else self.WAVE_FORMAT_PCM
+        self.buffer = bytearray(self.wav_header(self.formatcode, self.samplerate, self.nchannels, self.samplewidth, data_size))
+
+    @classmethod
+    def read_format(cls, filename):
+        """Reads the format from the header of the wav file. Returns None if it's not a wav file we understand."""
+        with open(filename, "rb") as f:
+            riff = f.read(12)
+            if len(riff) < 12 or riff[:4] != b"RIFF" or riff[8:12] != b"WAVE":
+                return None
+            file_size = os.fstat(f.fileno()).st_size
+            fmt = None
+            while True:
+                chunk = f.read(8)
+                if len(chunk) < 8:
+                    return None
+                chunk_id, chunk_size = struct.unpack("<4sI", chunk)
+                if chunk_id == b"fmt ":
+                    fmt = f.read(chunk_size)
+                    if len(fmt) < 16:
+                        return None
+                    if chunk_size & 1:
+                        f.read(1)
+                elif chunk_id == b"data":
+                    if not fmt:
+                        return None
+                    formatcode, channels, rate, _, blockalign, bits = struct.unpack("<HHIIHH", fmt[:16])
+                    if formatcode == cls.WAVE_FORMAT_EXTENSIBLE and len(fmt) >= 26:
+                        formatcode = struct.unpack("<H", fmt[24:26])[0]
+                    if not channels or not rate or bits % 8 or blockalign != channels * bits // 8:
+                        return None
+                    data_offset = f.tell()
+                    data_size = chunk_size
+                    if data_size == 0 or data_size == 0xffffffff or data_offset + data_size > file_size:
+                        data_size = None    # unknown size (written by a streaming encoder), read until the end
+                    return WavFileFormat(formatcode, rate, channels, bits // 8, data_offset, data_size)
+                else:
+                    f.seek(chunk_size + (chunk_size & 1), io.SEEK_CUR)
+
+    @classmethod
+    def can_convert(cls, wav_format, samplerate=None, channels=None, sampleformat=None, hqresample=False):
+        """Can the given wav file format be converted in-process to the desired format?"""
+        if wav_format.formatcode == cls.WAVE_FORMAT_PCM:
+            if not 1 <= wav_format.samplewidth <= 4:
+                return False
+        elif wav_format.formatcode == cls.WAVE_FORMAT_IEEE_FLOAT:
+            if wav_format.samplewidth not in (4, 8) or not numpy:
+                return False
+        else:
+            return False
+        if sampleformat and sampleformat not in cls.sampleformat_widths:
+            return False
+        if sampleformat == "float" and not numpy:
+            return False
+        if channels and channels != wav_format.channels and not (1 <= channels <= 2 and 1 <= wav_format.channels <= 2):
+            return False
+        if samplerate and samplerate != wav_format.rate and hqresample and not numpy:
+            return False    # the simple resampling algorithm is not high quality, leave that to ffmpeg
+        return True
+
+    @staticmethod
+    def wav_header(formatcode, samplerate, nchannels, samplewidth, data_size):
+        blockalign = nchannels * samplewidth
+        riff_size = min(0xffffffff, 36 + data_size)
+        return struct.pack("<4sI4s4sIHHIIHH4sI", b"RIFF", riff_size, b"WAVE", b"fmt ", 16, formatcode, nchannels,
+                           samplerate, samplerate * blockalign, blockalign, 8 * samplewidth, b"data", data_size)
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            frames = self.convert_next_chunk()
+            if frames is None:
+                break
+            self.buffer.extend(frames)
+        if size < 0:
+            size = len(self.buffer)
+        result = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return result
+
+    def convert_next_chunk(self):
+        """Reads and converts the next chunk of frames. Returns None at the end of the data."""
+        if self.file.closed:
+            return None
+        fmt = self.wav_format
+        size = self.chunk_frames * fmt.channels * fmt.samplewidth
+        if self.remaining is not None:
+            size = min(size, self.remaining)
+        frames = self.file.read(size)
+        frames = frames[:len(frames) - len(frames) % (fmt.channels * fmt.samplewidth)]
+        target_width = 4 if self.sampleformat == "float" else self.samplewidth
+        if not frames:
+            if self.resampler:
+                # end of the data, get the last frames out of the resampler
+                frames = self.hq_resampled(self.resampler.flush(), target_width)
+                self.resampler = None
+                if frames:
+                    return self.encode_frames(frames, target_width)
+            return None
+        if self.remaining is not None:
+            self.remaining -= len(frames)
+        # decode into native signed integer samples
+        width = fmt.samplewidth
+        if fmt.formatcode == self.WAVE_FORMAT_IEEE_FLOAT:
+            values = numpy.frombuffer(frames, dtype="<f4" if width == 4 else "<f8")
+            # scale in double precision: in float32, 2**31-1 rounds up to 2**31 and full scale would wrap around
+            frames = (numpy.clip(values.astype(numpy.float64), -1.0, 1.0) * (2**31 - 1)).astype(numpy.int32).tobytes()
+            width = 4
+        elif width == 1:
+            frames = audioop.bias(frames, 1, -128)   # 8 bits wav samples are unsigned
+        elif sys.byteorder == "big":
+            frames = audioop.byteswap(frames, width)
+        # convert channels, sample width and rate
+        if self.nchannels != fmt.channels:
+            if self.nchannels == 1:
+                frames = audioop.tomono(frames, width, 0.5, 0.5)
+            else:
+                frames = audioop.tostereo(frames, width, 1, 1)
+        if target_width != width:
+            frames = audioop.lin2lin(frames, width, target_width)
+        if self.resampler:
+            values = numpy.frombuffer(audioop.lin2lin(frames, target_width, 4), dtype=numpy.int32)
+            frames = self.hq_resampled(self.resampler.process(values.reshape(-1, self.nchannels)), target_width)
+        elif self.samplerate != fmt.rate:
+            frames, self.ratecv_state = audioop.ratecv(frames, target_width, self.nchannels, fmt.rate,
+                                                       self.samplerate, self.ratecv_state)
+        return self.encode_frames(frames, target_width)
+
+    @staticmethod
+    def hq_resampled(values, width):
+        # converts the 32 bits sample values from the resampler back into frames of the given sample width
+        scale = 2 ** (8 * (4 - width))
+        values = numpy.clip(numpy.rint(values / scale) * scale, -2**31, 2**31 - scale).astype(numpy.int32)
+        return audioop.lin2lin(values.tobytes(), 4, width)
+
+    def encode_frames(self, frames, target_width):
+        # encode native signed integer frames into the output format
+        if self.sampleformat == "float":
+            return (numpy.frombuffer(frames, dtype=numpy.int32) / 2**31).astype("<f4").tobytes()
+        if target_width == 1:
+            return audioop.bias(frames, 1, 128)
+        if sys.byteorder == "big":
+            frames = audioop.byteswap(frames, target_width)
+        return frames
+
+    def write_file(self, filename):
+        """Writes the converted wav data to a file (with the correct data size in the header)."""
+        with open(filename, "wb") as out:
+            out.write(self.read(44))
+            data_size = 0
+            while True:
+                data = self.read(1024*1024)
+                if not data:
+                    break
+                out.write(data)
+                data_size += len(data)
+            out.seek(0)
+            out.write(self.wav_header(self.formatcode, self.samplerate, self.nchannels, self.samplewidth, data_size))
+
+    def close(self):
+        self.file.close()
+        super().close()
+
+
+class PrefetchedWavStream(io.RawIOBase):
+    """
+    Wraps a wav stream (such as AudiofileToWavStream) and already reads the first part of it in a background thread,
+    so the decoder is running and its output is available as soon as the stream is actually used.
+    At most prefetch_size bytes are read ahead, into a buffer that stays in memory up to memory_limit bytes
+    and spills over into a temporary file beyond that. When the prefetched data has been used up,
+    the rest is read directly from the wrapped stream.
+    """
+    read_size = 65536
+
+    def __init__(self, stream, prefetch_size=8*1024*1024, memory_limit=1024*1024):
+        super().__init__()
+        self.stream = stream
+        self.format_probe = getattr(stream, "format_probe", None)
+        self.prefetch_size = prefetch_size
+        self.buffer = tempfile.SpooledTemporaryFile(max_size=memory_limit)
+        self.prefetched = 0
+        self.read_position = 0
+        self.prefetch_done = False
+        self.error = None
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self._prefetch, name="prefetch", daemon=True)
+        self.thread.start()
+
+    def _prefetch(self):
+        try:
+            while self.prefetched < self.prefetch_size and not self.closed:
+                data = self.stream.read(min(self.read_size, self.prefetch_size - self.prefetched))
+                if not data:
+                    break
+                with self.condition:
+                    if self.closed:
+                        break
+                    self.buffer.seek(0, io.SEEK_END)
+                    self.buffer.write(data)
+                    self.prefetched += len(data)
+                    self.condition.notify_all()
+        except Exception as x:
+            if not self.closed:
+                self.error = x
+        finally:
+            with self.condition:
+                self.prefetch_done = True
+                self.condition.notify_all()
+
+    @property
+    def buffered_bytes(self):
+        """The amount of prefetched data that hasn't been read yet."""
+        return self.prefetched - self.read_position
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        chunks = []
+        with self.condition:
+            while True:
+                while self.read_position >= self.prefetched and not self.prefetch_done:
+                    self.condition.wait()
+                if self.error:
+                    raise self.error
+                available = self.prefetched - self.read_position
+                if available:
+                    amount = available if size < 0 else min(size, available)
+                    self.buffer.seek(self.read_position)
+                    data = self.buffer.read(amount)
+                    chunks.append(data)
+                    self.read_position += len(data)
+                    if size >= 0:
+                        size -= len(data)
+                if size == 0 or self.prefetch_done:
+                    break
+            if self.prefetch_done and self.read_position >= self.prefetched:
+                self.buffer.close()     # everything has been read from the buffer, release it
+        if size != 0:
+            # prefetched data is used up, continue directly with the wrapped stream
+            chunks.append(self.stream.read(size))
+        return b"".join(chunks)
+
+    def close(self):
+        if self.closed:
+            return
+        with self.condition:
+            super().close()     # this also tells the prefetch thread to stop
+            self.buffer.close()
+        # the thread may be reading from the wrapped stream right now, it must be done with that before it is closed
+        self.thread.join()
+        self.stream.close()
+
+
+class ReadAheadReader:
+    """
+    Wraps a wav reader and reads frames from it ahead of time, in a background thread.
+    The frames are stored in a bounded ring buffer of preallocated blocks, so the reading side
+    (usually the mixer) only has to copy frames from memory and never waits on the source.
+    If the ring buffer runs dry before the source is exhausted, silence is returned instead
+    and the underrun is counted.
+    """
+    first_fill_timeout = 1.0
+
+    def __init__(self, wav_reader, block_frames, num_blocks=8):
+        assert block_frames > 0 and num_blocks > 1
+        self.source = wav_reader
+        self.framesize = wav_reader.getsampwidth() * wav_reader.getnchannels()
+        self.block_frames = block_frames
+        self.num_blocks = num_blocks
+        self.underruns = 0
+        self._blocks = [bytearray(block_frames * self.framesize) for _ in range(num_blocks)]
+        self._silence = bytes(block_frames * self.framesize)
+        self._lengths = [0] * num_blocks
+        self._read_idx = 0
+        self._read_offset = 0
+        self._write_idx = 0
+        self._filled = 0
+        self._eof = False
+        self._error = None
+        self._closed = False
+        self._started = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._reader, name="readahead", daemon=True)
+        self._thread.start()
+
+    def getsampwidth(self):
+        return self.source.getsampwidth()
+
+    def getframerate(self):
+        return self.source.getframerate()
+
+    def getnchannels(self):
+        return self.source.getnchannels()
+
+    @property
+    def fill_level(self):
+        """The fraction (0..1) of the ring buffer that is filled with frames waiting to be read."""
+        return self._filled / self.num_blocks
+
+    @property
+    def buffered_frames(self):
+        """The number of frames in the ring buffer that are waiting to be read."""
+        with self._condition:
+            if not self._filled:
+                return 0
+            buffered = sum(self._lengths[(self._read_idx + i) % self.num_blocks] for i in range(self._filled))
+            return (buffered - self._read_offset) // self.framesize
+
+    def _reader(self):
+        while True:
+            with self._condition:
+                while self._filled == self.num_blocks and not self._closed:
+                    self._condition.wait()
+                if self._closed:
+                    return
+                block = self._blocks[self._write_idx]
+            try:
+                frames = self.source.readframes(self.block_frames)
+            except (os.error, ValueError, EOFError) as x:
+                with self._condition:
+                    self._error = x
+                    self._eof = True
+                    self._condition.notify_all()
+                return
+            with self._condition:
+                if not frames:
+                    self._eof = True
+                    self._condition.notify_all()
+                    return
+                block[:len(frames)] = frames
+                self._lengths[self._write_idx] = len(frames)
+                self._write_idx = (self._write_idx + 1) % self.num_blocks
+                self._filled += 1
+                self._condition.notify_all()
+
+    def readframes(self, nframes):
+        """
+        Read frames from the ring buffer. Returns empty bytes when the source is exhausted.
+        The first read waits (at most first_fill_timeout seconds) until the reader thread has filled a block.
+        """
+        wanted = nframes * self.framesize
+        with self._condition:
+            if not self._started:
+                self._condition.wait_for(lambda: self._filled or self._eof, self.first_fill_timeout)
+                self._started = True
+            # the frames are copied straight out of the blocks, into the bytes object that is returned
+            parts = []
+            size = 0
+            while size < wanted and self._filled:
+                block = self._blocks[self._read_idx]
+                length = self._lengths[self._read_idx]
+                chunk = min(wanted - size, length - self._read_offset)
+                parts.append(memoryview(block)[self._read_offset:self._read_offset + chunk])
+                size += chunk
+                self._read_offset += chunk
+                if self._read_offset == length:
+                    self._read_offset = 0
+                    self._read_idx = (self._read_idx + 1) % self.num_blocks
+                    self._filled -= 1
+            if size < wanted:
+                if self._eof:
+                    if self._error and not size:
+                        raise self._error
+                else:
+                    # underrun: the source can't keep up, pad with silence rather than wait for it
+                    self.underruns += 1
+                    if len(self._silence) < wanted - size:
+                        self._silence = bytes(wanted - size)
+                    parts.append(memoryview(self._silence)[:wanted - size])
+            result = parts[0].tobytes() if len(parts) == 1 else b"".join(parts)
+            for part in parts:
+                part.release()
+            self._condition.notify_all()
+        return result
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        # the reader thread may still be reading from the source, wait for it before closing the source
+        self._thread.join()
+        self.source.close()
+
+
+class ResamplingReader:
+    """
+    Wraps a wav reader and converts its frames to another sample rate on the fly, using the Resampler
+    (numpy is required). The filter history is kept between reads so the blocks join up seamlessly,
+    and readframes returns exactly the requested number of frames (until the source is exhausted).
+    No external process is used and the source is never read completely into memory.
+    """
+    read_size = 4096
+
+    def __init__(self, wav_reader, samplerate):
+        if not numpy:
+            raise RuntimeError("resampling a stream requires numpy")
+        self.source = wav_reader
+        self.samplerate = samplerate
+        self.samplewidth = wav_reader.getsampwidth()
+        self.nchannels = wav_reader.getnchannels()
+        self.resampler = Resampler(wav_reader.getframerate(), samplerate, self.nchannels)
+        self.buffer = bytearray()
+        self.source_exhausted = False
+
+    def getsampwidth(self):
+        return self.samplewidth
+
+    def getframerate(self):
+        return self.samplerate
+
+    def getnchannels(self):
+        return self.nchannels
+
+    def readframes(self, nframes):
+        size = nframes * self.samplewidth * self.nchannels
+        while len(self.buffer) < size and not self.source_exhausted:
+            frames = self.source.readframes(self.read_size)
+            if frames:
+                values = numpy.frombuffer(audioop.lin2lin(frames, self.samplewidth, 4), dtype=numpy.int32)
+                values = self.resampler.process(values.reshape(-1, self.nchannels))
+            else:
+                values = self.resampler.flush()
+                self.source_exhausted = True
+            self.buffer.extend(WavConversionStream.hq_resampled(values, self.samplewidth))
+        result = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return result
+
+    def close(self):
+        self.source.close()
+
+
+class SampleReader:
+    """
+    A wav reader that produces the frames of a Sample, to stream a sample in the same way as a wav file.
+    Unlike the wave module, this also reads floating-point frames (see SampleStream's is_float).
+    The frames are copied, so the sample itself can be changed or released afterwards.
+    """
+    def __init__(self, sample):
+        self.frames = bytes(sample.view_frame_data())
+        self.samplewidth = sample.samplewidth
+        self.samplerate = sample.samplerate
+        self.nchannels = sample.nchannels
+        self.is_float = sample.is_float
+        self.position = 0
+
+    def getsampwidth(self):
+        return self.samplewidth
+
+    def getframerate(self):
+        return self.samplerate
+
+    def getnchannels(self):
+        return self.nchannels
+
+    def readframes(self, nframes):
+        size = nframes * self.samplewidth * self.nchannels
+        frames = self.frames[self.position:self.position + size]
+        self.position += len(frames)
+        return frames
+
+    def close(self):
+        self.frames = b""
+
+
 class SampleStream:
     """
     Turns a wav reader that produces frames, into a stream of Sample objects.
     You can add filters to the stream that process the Sample objects coming trough.
+    If you specify a number of readahead blocks, the frames are read from the wav reader
+    in a background thread (see ReadAheadReader) instead of inline when the next sample is requested.
+    If you specify a samplerate that differs from the rate of the wav reader, the frames are
+    resampled on the fly (see ResamplingReader). That requires integer frames: is_float means the
+    wav reader produces 32 bits floating-point frames, such as the SampleReader of a floating-point sample.
     """
-    def __init__(self, wav_reader, buffer_size):
+    def __init__(self, wav_reader, buffer_size, readahead=0, samplerate=None, is_float=False):
+        if samplerate and samplerate != wav_reader.getframerate():
+            if is_float:
+                raise ValueError("can't resample floating-point frames")
+            wav_reader = ResamplingReader(wav_reader, samplerate)
+        if readahead:
+            wav_reader = ReadAheadReader(wav_reader, buffer_size, readahead)
         self.source = wav_reader
         self.samplewidth = wav_reader.getsampwidth()
         self.samplerate = wav_reader.getframerate()
         self.nchannels = wav_reader.getnchannels()
+        self.is_float = is_float
         self.buffer_size = buffer_size
         self.filters = []
         self.frames_filters = []
 
+    @property
+    def buffer_fill(self):
+        """Fill level (0..1) of the readahead buffer, or None if the stream doesn't read ahead."""
+        if isinstance(self.source, ReadAheadReader):
+            return self.source.fill_level
+        return None
+
+    @property
+    def underruns(self):
+        """Number of times the readahead buffer ran dry, or None if the stream doesn't read ahead."""
+        if isinstance(self.source, ReadAheadReader):
+            return self.source.underruns
+        return None
+
     def add_frames_filter(self, filter):
         filter.set_params(self.buffer_size, self.samplerate, self.samplewidth, self.nchannels)
         self.frames_filters.append(filter)
@@ -170,12 +756,22 @@ class SampleStream:
         return self
 
     def __next__(self):
-        frames = self.source.readframes(self.buffer_size)
+        return self.read(self.buffer_size)
+
+    def read(self, nframes):
+        """
+        Returns a Sample containing at most the given number of frames, or None if the stream is exhausted.
+        Usually you just iterate over the stream instead, which reads buffer_size frames at a time.
+        """
+        frames = self.source.readframes(nframes)
         for filter in self.frames_filters:
             frames = filter(frames)
         if not frames:
             return None
-        sample = Sample.from_raw_frames(frames, self.samplewidth, self.samplerate, self.nchannels)
+        max_length = nframes * self.samplewidth * self.nchannels
+        if len(frames) > max_length:
+            frames = frames[:max_length]    # frames filters may pad up to the full buffer size
+        sample = Sample.from_raw_frames(frames, self.samplewidth, self.samplerate, self.nchannels, self.is_float)
         for filter in self.filters:
             sample = filter(sample)
         return sample
@@ -208,49 +804,178 @@ class VolumeFilter:
         return sample
 
 
+class GainRampFilter(VolumeFilter):
+    """
+    Volume filter that doesn't jump to a new volume at the start of a buffer, but
+    ramps the gain from the previous volume to the new one across the buffer instead.
+    This avoids the 'zipper noise' you get when the volume is changed often (during a fade for instance)
+    without having to use small buffers.
+    """
+    def __init__(self, volume=1.0):
+        super().__init__(volume)
+        self.current_volume = volume
+
+    def __call__(self, sample):
+        if sample:
+            volume = self.volume
+            if volume != self.current_volume:
+                sample.amplify_ramp(self.current_volume, volume)
+                self.current_volume = volume
+            elif volume != 1.0:
+                sample.amplify(volume)
+        return sample
+
+
 class StreamMixer:
     """
     Mixes one or more wav audio streams into one output.
     Takes ownership of the source streams that are being mixed, and will close them for you as needed.
+    You can schedule actions (such as adding or removing a stream, or changing a volume) to happen at an
+    exact frame position in the mixed output, independent of the buffer size.
+    Crossfades between streams are done by the mixer itself as well.
+    With is_float, the streams are mixed as floating-point samples (requires numpy), so the mix never clips.
+    The mixed samples are then float samples as well, regardless of the sample width of the streams.
     """
     buffer_size = 4096   # number of frames in a buffer
+    readahead = 0        # number of buffers to read ahead per stream in a background thread (0 = read inline)
+    crossfade_curves = ("equal-power", "linear")
 
-    def __init__(self, streams, endless=False, samplewidth=Sample.norm_samplewidth, samplerate=Sample.norm_samplerate, nchannels=Sample.norm_nchannels):
+    def __init__(self, streams, endless=False, samplewidth=Sample.norm_samplewidth, samplerate=Sample.norm_samplerate,
+                 nchannels=Sample.norm_nchannels, is_float=False):
         # assume all wave streams are the same parameters
+        if is_float and not numpy:
+            raise RuntimeError("numpy is required to mix floating-point samples")
         self.samplewidth = samplewidth
+        self.is_float = is_float
         self.samplerate = samplerate
         self.nchannels = nchannels
         self.timestamp = 0.0
+        self.frames_mixed = 0
         self.sample_streams = []
+        self.filters = []   # filters on the mixed output
         self.wrapped_streams = {}   # samplestream->wrappedstream (to close stuff properly)
+        self.scheduled_actions = []   # heap of (frame, sequence number, action)
+        self.stream_fades = {}   # samplestream->(start frame, length, curve, fading in)
+        self._schedule_sequence = itertools.count()
+        self._position = 0
+        self._lock = threading.Lock()
         for stream in streams:
-            self.add_stream(stream, endless)
+            self.add_stream(stream, endless=endless)
 
-    def add_stream(self, stream, filters=None, endless=False):
+    def add_stream(self, stream, filters=None, endless=False, readahead=None):
+        """Adds a wav stream to the mix. Returns the SampleStream that is created for it."""
+        ss = self.open_stream(stream, filters, endless, readahead)
+        with self._lock:
+            self.sample_streams.append(ss)
+        return ss
+
+    def open_stream(self, stream, filters=None, endless=False, readahead=None):
+        """
+        Creates the SampleStream for a wav stream, but doesn't add it to the mix yet (see crossfade).
+        The mixer takes ownership of the stream. Streams at another sample rate are resampled on the fly.
+        """
         ws = wave.open(stream, 'r')
-        ss = SampleStream(ws, self.buffer_size)
+        if readahead is None:
+            readahead = self.readahead
+        ss = SampleStream(ws, self.buffer_size, readahead, self.samplerate)
         if endless:
             ss.add_frames_filter(EndlessFramesFilter())
         for f in (filters or []):
             ss.add_filter(f)
-        self.sample_streams.append(ss)
         self.wrapped_streams[ss] = stream
+        return ss
+
+    def add_filter(self, filter):
+        """
+        Adds a filter that processes the mixed output, to apply effects (a reverb for instance) to the whole mix.
+        These are the same kind of filters as the SampleStream filters.
+        """
+        filter.set_params(self.buffer_size, self.samplerate, 4 if self.is_float else self.samplewidth, self.nchannels)
+        self.filters.append(filter)
 
     def remove_stream(self, stream):
         stream.close()
-        self.sample_streams.remove(stream)
+        with self._lock:
+            if stream in self.sample_streams:
+                self.sample_streams.remove(stream)
+            self.stream_fades.pop(stream, None)
         if stream in self.wrapped_streams:
             wrapped_stream = self.wrapped_streams.pop(stream)
             wrapped_stream.close()
 
     def add_sample(self, sample):
-        assert sample.samplewidth == self.samplewidth
+        """
+        Adds a sample to the mix. Returns the SampleStream that is created for it.
+        If the mixer doesn't mix floating-point samples, a floating-point sample is added
+        converted to the sample width of the mixer (with -1.0...1.0 scaled to its full range).
+        """
         assert sample.samplerate == self.samplerate
         assert sample.nchannels == self.nchannels
-        stream = io.BytesIO()
-        sample.write_wav(stream)
-        stream.seek(0, io.SEEK_SET)
-        self.add_stream(stream)
+        if sample.is_float and not self.is_float:
+            frames = sample.get_32bit_frames()
+            if self.samplewidth != 4:
+                frames = audioop.lin2lin(frames, 4, self.samplewidth)
+            sample = Sample.from_raw_frames(frames, self.samplewidth, sample.samplerate, sample.nchannels)
+        assert self.is_float or sample.samplewidth == self.samplewidth
+        reader = SampleReader(sample)
+        ss = SampleStream(reader, self.buffer_size, is_float=reader.is_float)
+        self.wrapped_streams[ss] = reader
+        with self._lock:
+            self.sample_streams.append(ss)
+        return ss
+
+    def schedule_at(self, frame, action):
+        """
+        Schedule an action (a callable without arguments) to be executed when the mix reaches the given frame.
+        The buffer that is being mixed at that time is split at that exact frame, so the action
+        takes effect sample-accurate, regardless of the buffer size (or the timing of the caller).
+        Actions scheduled for a frame that has already been mixed, are executed at the start of the next buffer.
+        """
+        with self._lock:
+            heapq.heappush(self.scheduled_actions, (int(frame), next(self._schedule_sequence), action))
+
+    def crossfade(self, from_stream, to_stream, seconds, curve="equal-power"):
+        """
+        Crossfade from one sample stream to another in the given time, starting right away.
+        The volume curves are calculated by the mixer itself for every buffer, so the fade is precise
+        and doesn't depend on the timing of the caller.
+        The curve is "equal-power" (keeps the loudness constant) or "linear".
+        If the to_stream is not yet mixed (see open_stream) it is added, starting silently.
+        When the fade is done the from_stream is removed from the mix.
+        You can use None for either stream, to only fade in or fade out the other one.
+        """
+        if curve not in self.crossfade_curves:
+            raise ValueError("invalid crossfade curve")
+        length = max(1, self.frame_at(seconds))
+        with self._lock:
+            start = self._position
+            if from_stream:
+                self.stream_fades[from_stream] = (start, length, curve, False)
+            if to_stream:
+                self.stream_fades[to_stream] = (start, length, curve, True)
+                if to_stream not in self.sample_streams:
+                    self.sample_streams.append(to_stream)
+        self.schedule_at(start + length, lambda: self._crossfade_done(from_stream, to_stream))
+
+    def _crossfade_done(self, from_stream, to_stream):
+        with self._lock:
+            self.stream_fades.pop(to_stream, None)
+        if from_stream:
+            self.remove_stream(from_stream)
+
+    @staticmethod
+    def _fade_gain(fade, frame):
+        start, length, curve, fading_in = fade
+        t = min(max((frame - start) / length, 0.0), 1.0)
+        if not fading_in:
+            t = 1.0 - t
+        if curve == "equal-power":
+            return math.sin(t * math.pi / 2)
+        return t
+
+    def frame_at(self, seconds):
+        """Returns the frame position in the mix corresponding to the given timestamp."""
+        return int(round(seconds * self.samplerate))
 
     def __enter__(self):
         return self
@@ -266,18 +991,79 @@ class StreamMixer:
     def __iter__(self):
         """
         Yields tuple(timestamp, Sample) that represent the mixed audio streams.
+        When the streams have ended (or there are none), the mix goes on with silence,
+        so the scheduled actions still happen on time.
         """
         while True:
-            mixed_sample = Sample.from_raw_frames(b"", self.samplewidth, self.samplerate, self.nchannels)
-            for sample_stream in self.sample_streams:
-                try:
-                    sample = next(sample_stream)
-                except (os.error, ValueError):
-                    # Problem reading from stream. Assume stream closed.
-                    sample = None
-                if sample:
-                    mixed_sample.mix(sample)
+            mixed_sample = self._empty_sample()
+            position = self.frames_mixed
+            block_end = position + self.buffer_size
+            while position < block_end:
+                self._position = position
+                segment_end = min(block_end, self._run_scheduled_actions(position))
+                segment = self._mix_segment(position, segment_end - position)
+                position += len(segment)
+                if mixed_sample:
+                    mixed_sample.join(segment)
+                    segment.release()
                 else:
-                    self.remove_stream(sample_stream)
+                    mixed_sample.release()
+                    mixed_sample = segment      # usually the whole block is one segment, no need to copy it
+            for filter in self.filters:
+                mixed_sample = filter(mixed_sample)
             yield self.timestamp, mixed_sample
             self.timestamp += mixed_sample.duration
+            self.frames_mixed = self._position = position
+
+    def _run_scheduled_actions(self, position):
+        # execute the actions that are due, and return the frame of the next pending action
+        while True:
+            with self._lock:
+                if not self.scheduled_actions:
+                    return sys.maxsize
+                if self.scheduled_actions[0][0] > position:
+                    return self.scheduled_actions[0][0]
+                _, _, action = heapq.heappop(self.scheduled_actions)
+            action()
+
+    def _empty_sample(self):
+        if self.is_float:
+            return Sample.from_raw_frames(b"", 4, self.samplerate, self.nchannels, True)
+        return Sample.from_raw_frames(b"", self.samplewidth, self.samplerate, self.nchannels)
+
+    def _mix_segment(self, position, nframes):
+        mixed_sample = None
+        with self._lock:
+            sample_streams = list(self.sample_streams)
+        for sample_stream in sample_streams:
+            try:
+                sample = sample_stream.read(nframes)
+            except (os.error, ValueError):
+                # Problem reading from stream. Assume stream closed.
+                sample = None
+            if sample:
+                if sample_stream.filters:
+                    # the sample that the stream's filters returned may still be referenced (or locked) by them,
+                    # so the mixer works on a copy. That doesn't copy the frame data itself.
+                    sample = sample.copy()
+                if self.is_float:
+                    sample.make_float()
+                fade = self.stream_fades.get(sample_stream)
+                if fade:
+                    sample.amplify_ramp(self._fade_gain(fade, position), self._fade_gain(fade, position + len(sample)))
+                if mixed_sample is None:
+                    mixed_sample = sample
+                else:
+                    mixed_sample.mix(sample)
+                    sample.release()
+            else:
+                self.remove_stream(sample_stream)
+        mixed_sample = mixed_sample or self._empty_sample()
+        if len(mixed_sample) < nframes:
+            # the streams didn't produce enough frames (they have ended), fill up the segment with silence
+            framesize = mixed_sample.samplewidth * mixed_sample.nchannels
+            silence = Sample.from_raw_frames(bytes((nframes - len(mixed_sample)) * framesize), mixed_sample.samplewidth,
+                                             self.samplerate, self.nchannels, mixed_sample.is_float)
+            mixed_sample.join(silence)
+            silence.release()
+        return mixed_sample
@@ -7,9 +7,15 @@ Written by Irmen de Jong (irmen@razorvine.net) - License: MIT open-source.
 
 import sys
 import itertools
+import collections
+import operator
 import random
 from math import sin, pi, floor, fabs, log
 from .sample import Sample
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 __all__ = ["key_num", "key_freq", "note_freq", "octave_notes", "note_alias", "major_chords", "major_chord_keys",
@@ -17,7 +23,7 @@ __all__ = ["key_num", "key_freq", "note_freq", "octave_notes", "note_alias", "ma
            "Pulse", "Harmonics", "WhiteNoise", "Linear",
            "FastSine", "FastPulse", "FastTriangle", "FastSawtooth", "FastSquare",
            "EnvelopeFilter", "MixingFilter", "AmpMudulationFilter", "DelayFilter", "EchoFilter",
-           "ClipFilter", "AbsFilter", "NullFilter"]
+           "ClipFilter", "AbsFilter", "NullFilter", "BiquadFilter"]
 
 
 octave_notes = ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B']
@@ -113,13 +119,20 @@ class WaveSynth:
     Waveform sample synthesizer. Can generate various wave forms based on mathematic functions:
     sine, square (perfect or with harmonics), triangle, sawtooth (perfect or with harmonics),
     variable harmonics, white noise.  It also supports an optional LFO for Frequency Modulation.
-    The resulting waveform sample data is in integer 16 or 32 bits format.
+    The resulting waveform sample data is in integer 16 or 32 bits format,
+    or in 32 bits floating-point format (-1.0...1.0) if you use is_float (this requires numpy).
     """
-    def __init__(self, samplerate=Sample.norm_samplerate, samplewidth=Sample.norm_samplewidth):
+    def __init__(self, samplerate=Sample.norm_samplerate, samplewidth=Sample.norm_samplewidth, is_float=False):
         if samplewidth not in (2, 4):
             raise ValueError("only sample widths 2 and 4 are supported")
+        if is_float:
+            if not numpy:
+                raise RuntimeError("numpy is required for floating-point samples")
+            samplewidth = 4
         self.samplerate = samplerate
         self.samplewidth = samplewidth
+        self.is_float = is_float
+        self.__value = float if is_float else int
 
     def sine(self, frequency, duration, amplitude=0.9999, phase=0.0, bias=0.0, fm_lfo=None):
         """Simple sine wave. Optional FM using a supplied LFO."""
@@ -130,7 +143,7 @@ class WaveSynth:
         """Simple sine wave generator. Optional FM using a supplied LFO."""
         wave = self.__sine(frequency, amplitude, phase, bias, fm_lfo)
         while True:
-            yield int(next(wave))
+            yield self.__value(next(wave))
 
     def square(self, frequency, duration, amplitude=0.75, phase=0.0, bias=0.0, fm_lfo=None):
         """
@@ -149,7 +162,7 @@ class WaveSynth:
         """
         wave = self.__square(frequency, amplitude, phase, bias, fm_lfo)
         while True:
-            yield int(next(wave))
+            yield self.__value(next(wave))
 
     def square_h(self, frequency, duration, num_harmonics=16, amplitude=0.9999, phase=0.0, bias=0.0, fm_lfo=None):
         """A square wave based on harmonic sine waves (more natural sounding than pure square)"""
@@ -160,7 +173,7 @@ class WaveSynth:
         """Generator for a square wave based on harmonic sine waves (more natural sounding than pure square)"""
         wave = self.__square_h(frequency, num_harmonics, amplitude, phase, bias, fm_lfo)
         while True:
-            yield int(next(wave))
+            yield self.__value(next(wave))
 
     def triangle(self, frequency, duration, amplitude=0.9999, phase=0.0, bias=0.0, fm_lfo=None):
         """Perfect triangle waveform (not using harmonics). Optional FM using a supplied LFO."""
@@ -171,7 +184,7 @@ class WaveSynth:
         """Generator for a perfect triangle waveform (not using harmonics). Optional FM using a supplied LFO."""
         wave = self.__triangle(frequency, amplitude, phase, bias, fm_lfo)
         while True:
-            yield int(next(wave))
+            yield self.__value(next(wave))
 
     def sawtooth(self, frequency, duration, amplitude=0.75, phase=0.0, bias=0.0, fm_lfo=None):
         """Perfect sawtooth waveform (not using harmonics)."""
@@ -182,7 +195,7 @@ class WaveSynth:
         """Generator for a perfect sawtooth waveform (not using harmonics)."""
         wave = self.__sawtooth(frequency, amplitude, phase, bias, fm_lfo)
         while True:
-            yield int(next(wave))
+            yield self.__value(next(wave))
 
     def sawtooth_h(self, frequency, duration, num_harmonics=16, amplitude=0.5, phase=0.0, bias=0.0, fm_lfo=None):
         """Sawtooth waveform based on harmonic sine waves"""
@@ -193,7 +206,7 @@ class WaveSynth:
         """Generator for a Sawtooth waveform based on harmonic sine waves"""
         wave = self.__sawtooth_h(frequency, num_harmonics, amplitude, phase, bias, fm_lfo)
         while True:
-            yield int(next(wave))
+            yield self.__value(next(wave))
 
     def pulse(self, frequency, duration, amplitude=0.75, phase=0.0, bias=0.0, pulsewidth=0.1, fm_lfo=None, pwm_lfo=None):
         """
@@ -212,7 +225,7 @@ class WaveSynth:
         """
         wave = self.__pulse(frequency, amplitude, phase, bias, pulsewidth, fm_lfo, pwm_lfo)
         while True:
-            yield int(next(wave))
+            yield self.__value(next(wave))
 
     def harmonics(self, frequency, duration, harmonics, amplitude=0.5, phase=0.0, bias=0.0, fm_lfo=None):
         """Makes a waveform based on harmonics. This is slow because many sine waves are added together."""
@@ -223,7 +236,7 @@ class WaveSynth:
         """Generator for a waveform based on harmonics. This is slow because many sine waves are added together."""
         wave = self.__harmonics(frequency, harmonics, amplitude, phase, bias, fm_lfo)
         while True:
-            yield int(next(wave))
+            yield self.__value(next(wave))
 
     def white_noise(self, duration, amplitude=0.9999, bias=0.0):
         """White noise (randomness) waveform."""
@@ -234,7 +247,7 @@ class WaveSynth:
         """Generator for White noise (randomness) waveform."""
         wave = self.__white_noise(amplitude, bias)
         while True:
-            yield int(next(wave))
+            yield self.__value(next(wave))
 
     def linear(self, duration, start_amp, finish_amp):
         """A linear constant or sloped waveform."""
@@ -245,7 +258,7 @@ class WaveSynth:
         """Generator for linear constant or sloped waveform (it ends when it reaches the specified duration)"""
         wave = self.__linear(duration, startamp, finishamp)
         for _ in range(int(duration*self.samplerate)):
-            yield int(next(wave))
+            yield self.__value(next(wave))
 
     def __sine(self, frequency, amplitude, phase, bias, fm_lfo):
         scale = self.__check_and_get_scale(frequency, amplitude, bias)
@@ -308,11 +321,17 @@ class WaveSynth:
         assert freq <= self.samplerate/2    # don't exceed the Nyquist frequency
         assert 0 <= amplitude <= 1.0
         assert -1 <= bias <= 1.0
+        if self.is_float:
+            return 1.0
         scale = 2 ** (self.samplewidth * 8 - 1) - 1
         return scale
 
     def __render_sample(self, duration, wave):
         wave = iter(wave)
+        if self.is_float:
+            num_samples = int(duration*self.samplerate)
+            samples = numpy.fromiter(itertools.islice(wave, num_samples), dtype=numpy.float32, count=num_samples)
+            return Sample.from_array(samples, self.samplerate, 1)
         samples = Sample.get_array(self.samplewidth)
         for _ in range(int(duration*self.samplerate)):
             samples.append(int(next(wave)))
@@ -344,7 +363,15 @@ class EnvelopeFilter(Oscillator):
     """
     Applies an ADSR volume envelope to the source.
     A,D,S,R are in seconds, sustain_level is an amplitude factor.
+    Every phase lasts a whole number of frames. The attack, decay and release ramps of amplitude factors are
+    precomputed, the sustain phase is just a repetition of its level. The envelope is multiplied with the
+    source values in one go, by a map over both. The ramps of recently used envelopes are kept (up to
+    max_cached_frames factors in total), so retriggering the same envelope doesn't have to compute them again.
     """
+    max_cached_frames = 1000000
+    _ramps_cache = collections.OrderedDict()
+    _cached_frames = 0
+
     def __init__(self, source, attack, decay, sustain, sustain_level, release, stop_at_end=False, cycle=False):
         assert attack >= 0 and decay >= 0 and sustain >= 0 and release >= 0
         assert 0 <= sustain_level <= 1
@@ -357,45 +384,46 @@ class EnvelopeFilter(Oscillator):
         self._stop_at_end = stop_at_end
         self._cycle = cycle
 
+    def ramps(self):
+        """The amplitude factors of the attack, decay and release phases, and the number of sustain frames."""
+        cls = EnvelopeFilter
+        key = (self._samplerate, self._attack, self._decay, self._sustain, self._sustain_level, self._release)
+        ramps = cls._ramps_cache.get(key)
+        if ramps is None:
+            attack, decay, sustain, release = (int(round(self._samplerate*seconds)) for seconds in
+                                               (self._attack, self._decay, self._sustain, self._release))
+            level = self._sustain_level
+            ramps = (tuple(i/attack for i in range(attack)),
+                     tuple(1.0+(level-1.0)*i/decay for i in range(decay)),
+                     sustain,
+                     tuple(level-level*i/release for i in range(release)))
+            size = attack + decay + release
+            if size <= cls.max_cached_frames:
+                while cls._cached_frames + size > cls.max_cached_frames:
+                    _, (old_attack, old_decay, _, old_release) = cls._ramps_cache.popitem(last=False)
+                    cls._cached_frames -= len(old_attack) + len(old_decay) + len(old_release)
+                cls._ramps_cache[key] = ramps
+                cls._cached_frames += size
+        else:
+            cls._ramps_cache.move_to_end(key)
+        return ramps
+
+    def envelope(self, ramps=None):
+        """Iterator over the amplitude factors for all frames of the envelope (made of the given ramps, see ramps)."""
+        attack, decay, sustain, release = ramps or self.ramps()
+        return itertools.chain(attack, decay, itertools.repeat(self._sustain_level, sustain), release)
+
     def generator(self):
-        oscillator = iter(self._source)
-        while True:
-            time = 0.0
-            end_time_decay = self._attack + self._decay
-            end_time_sustain = end_time_decay + self._sustain
-            end_time_release = end_time_sustain + self._release
-            increment = 1/self._samplerate
-            if self._attack:
-                amp_change = 1/self._attack*increment
-                amp = 0.0
-                while time < self._attack:
-                    yield next(oscillator)*amp
-                    amp += amp_change
-                    time += increment
-            if self._decay:
-                amp = 1.0
-                amp_change = (self._sustain_level-1)/self._decay*increment
-                while time < end_time_decay:
-                    yield next(oscillator)*amp
-                    amp += amp_change
-                    time += increment
-            while time < end_time_sustain:
-                yield next(oscillator)*self._sustain_level
-                time += increment
-            if self._release:
-                amp = self._sustain_level
-                amp_change = (-self._sustain_level)/self._release*increment
-                while time < end_time_release:
-                    yield next(oscillator)*amp
-                    amp += amp_change
-                    time += increment
-                if amp > 0:
-                    yield next(oscillator)*amp
-            if not self._cycle:
-                break
-        if not self._stop_at_end:
-            while True:
-                yield 0.0
+        ramps = self.ramps()
+        attack, decay, sustain, release = ramps
+        if self._cycle and (attack or decay or sustain or release):
+            # a new envelope every time the previous one has ended
+            return map(operator.mul, itertools.chain.from_iterable(map(self.envelope, itertools.repeat(ramps))), self._source)
+        # the envelope goes first in the map, so it doesn't take another value from the source when it has ended
+        envelope = map(operator.mul, self.envelope(ramps), iter(self._source))
+        if self._stop_at_end:
+            return envelope
+        return itertools.chain(envelope, itertools.repeat(0.0))
 
 
 class MixingFilter(Oscillator):
@@ -434,11 +462,10 @@ class DelayFilter(Oscillator):
     def generator(self):
         src = iter(self._source)
         if self._seconds < 0:
-            for _ in range(int(-self._samplerate*self._seconds)):
-                next(src)
+            skip = int(-self._samplerate*self._seconds)
+            next(itertools.islice(src, skip, skip), None)
         else:
-            for _ in range(int(self._samplerate*self._seconds)):
-                yield 0.0
+            yield from itertools.repeat(0.0, int(self._samplerate*self._seconds))
         yield from src
 
 
@@ -447,6 +474,10 @@ class EchoFilter(Oscillator):
     Mix given number of echos of the oscillator into itself.
     The decay is the factor with which each echo is decayed in volume (can be >1 to increase in volume instead).
     If you use a very short delay the echos blend into the sound and the effect is more like a reverb.
+    The echos come from a single delay line: when they decay, every echo is fed back into it (the echos
+    after the given amount are cancelled again), so the number of echos doesn't matter for the speed.
+    Echos that grow in volume are read from the delay line separately instead, because a feedback loop
+    would also amplify its own rounding errors.
     """
     def __init__(self, source, after, amount, delay, decay):
         super().__init__(source)
@@ -462,23 +493,36 @@ class EchoFilter(Oscillator):
     def generator(self):
         oscillator = iter(self._source)
         # first play the first part till the echos start
-        for _ in range(int(self._samplerate*self._after)):
-            yield next(oscillator)
-        # now start mixing the echos
-        amp = self._decay
-        echo_oscs = [Oscillator(src, samplerate=self._samplerate) for src in itertools.tee(oscillator, self._amount+1)]
-        echos = [echo_oscs[0]]
-        echo_delay = self._delay
-        for echo in echo_oscs[1:]:
-            echo = DelayFilter(echo, echo_delay)
-            echo = AmpMudulationFilter(echo, itertools.repeat(amp))
-            # @todo sometimes mixing the echos causes pops and clicks. Perhaps solvable by using a (very fast) fadein on the echo osc?
-            echos.append(echo)
-            echo_delay += self._delay
-            amp *= self._decay
-        echos = [iter(echo) for echo in echos]
-        while True:
-            yield sum([next(echo) for echo in echos])
+        yield from itertools.islice(oscillator, int(self._samplerate*self._after))
+        if self._amount <= 0:
+            yield from oscillator
+            return
+        delay = max(1, int(round(self._samplerate*self._delay)))
+        decay = self._decay
+        if abs(decay) < 1:
+            # echo[n] = decay * (echo[n-delay] + value[n-delay]) - decay**(amount+1) * value[n-(amount+1)*delay]
+            cancel = decay ** (self._amount+1)
+            delayed = collections.deque(itertools.repeat(0.0, delay))
+            oldest = collections.deque(itertools.repeat(0.0, delay*self._amount))
+            echos = collections.deque(itertools.repeat(0.0, delay))
+            for value in oscillator:
+                previous = delayed.popleft()
+                delayed.append(value)
+                echo = decay*(echos.popleft()+previous) - cancel*oldest.popleft()
+                oldest.append(previous)
+                echos.append(echo)
+                yield value+echo
+        else:
+            size = delay*self._amount
+            history = [0.0] * size
+            taps = [(echo*delay, decay**echo) for echo in range(1, self._amount+1)]
+            position = 0
+            for value in oscillator:
+                yield value + sum([amp*history[position-offset] for offset, amp in taps])
+                history[position] = value
+                position += 1
+                if position == size:
+                    position = 0
 
 
 class ClipFilter(Oscillator):
@@ -503,6 +547,38 @@ class AbsFilter(Oscillator):
             yield fabs(v)
 
 
+class BiquadFilter(Oscillator):
+    """
+    Biquad IIR filter on the source: lowpass, highpass, bandpass, notch, peak, lowshelf or highshelf
+    (see effects.Biquad). The frequency can be swept by a LFO, like the FM of the oscillators.
+    The source is filtered in blocks of block_frames values. Requires numpy.
+    """
+    block_frames = 1024
+
+    def __init__(self, source, kind, frequency, q=0.7071, gain=0.0, fm_lfo=None):
+        super().__init__(source)
+        self.kind = kind
+        self.frequency = frequency
+        self.q = q
+        self.gain = gain
+        self.fm_lfo = fm_lfo
+
+    def generator(self):
+        if not numpy:
+            raise RuntimeError("numpy is required for the biquad filter")
+        from .effects import Biquad
+        biquad = Biquad(self.kind, self.frequency, self.q, self.gain, self.fm_lfo)
+        biquad.set_params(self._samplerate, 1, None)
+        source = iter(self._source)
+        position = 0
+        while True:
+            block = numpy.fromiter(itertools.islice(source, self.block_frames), dtype=float)
+            if not len(block):
+                break
+            yield from biquad.process(block[:, numpy.newaxis], position)[:, 0].tolist()
+            position += len(block)
+
+
 class NullFilter(Oscillator):
     """Wraps an oscillator but does nothing."""
     def __init__(self, source):
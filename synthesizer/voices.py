@@ -0,0 +1,174 @@
+"""
+Polyphonic voice engine for real-time synthesizer playback.
+Notes are played on a fixed pool of preallocated voices, each with its own ADSR envelope.
+When all voices are in use, a new note steals the voice that is the least audible.
+All sounding voices are rendered together, block by block, into a single buffer.
+Requires numpy.
+
+Written by Irmen de Jong (irmen@razorvine.net) - License: MIT open-source.
+"""
+
+import threading
+import numpy
+from .sample import Sample
+
+
+__all__ = ["VoiceEngine"]
+
+
+class VoiceEngine:
+    """
+    Plays notes on a fixed number of voices. The waveforms are those of the Fast oscillators
+    (sine, triangle, square, sawtooth or pulse). Every voice has its own ADSR envelope
+    (A,D,R in seconds, the sustain level is an amplitude factor) that starts at note_on and
+    releases at note_off. The state of the voices is kept in arrays with an entry per voice,
+    so rendering a block is a handful of array operations for all sounding voices at once.
+    When no voice is free, a new note takes the quietest releasing voice, or else the oldest voice.
+    A retaken voice keeps its phase and the attack starts at its current level, to avoid clicks.
+    note_on and note_off can be called from another thread than the one that renders the blocks.
+    """
+    waveforms = ("sine", "triangle", "square", "sawtooth", "pulse")
+
+    def __init__(self, voices=16, samplerate=Sample.norm_samplerate, waveform="sine", amplitude=0.25,
+                 attack=0.01, decay=0.1, sustain_level=0.7, release=0.2, pulsewidth=0.1, block_frames=1024):
+        if waveform not in self.waveforms:
+            raise ValueError("invalid waveform")
+        assert voices > 0 and block_frames > 0
+        assert attack >= 0 and decay >= 0 and release >= 0
+        assert 0 <= sustain_level <= 1 and 0 <= pulsewidth <= 1
+        self.samplerate = samplerate
+        self.waveform = waveform
+        self.amplitude = amplitude
+        self.pulsewidth = pulsewidth
+        self.block_frames = block_frames
+        self.attack = int(round(attack*samplerate))
+        self.decay = int(round(decay*samplerate))
+        self.sustain_level = sustain_level
+        self.release = int(round(release*samplerate))
+        # the voices: per voice the note it plays, and the state of its oscillator and envelope
+        self.keys = [None] * voices
+        self.active = numpy.zeros(voices, dtype=bool)
+        self.frequencies = numpy.zeros(voices)
+        self.velocities = numpy.zeros(voices)
+        self.phases = numpy.zeros(voices)            # in cycles
+        self.positions = numpy.zeros(voices)         # frames since note on
+        self.start_levels = numpy.zeros(voices)      # the envelope level at note on
+        self.releases = numpy.full(voices, -1.0)     # frames since note off, -1 if the note is held
+        self.release_levels = numpy.zeros(voices)    # the envelope level at note off
+        self.levels = numpy.zeros(voices)            # the current envelope level
+        self.started = numpy.zeros(voices, dtype=numpy.int64)
+        self.notes_played = 0
+        self.lock = threading.Lock()
+
+    @property
+    def voices(self):
+        return len(self.keys)
+
+    @property
+    def active_voices(self):
+        return int(numpy.count_nonzero(self.active))
+
+    def note_on(self, frequency, velocity=1.0, key=None):
+        """
+        Starts playing a note, returns the voice it plays on. The key identifies the note for note_off
+        (the frequency is used if you don't give one). If the key is already sounding it's retriggered.
+        """
+        key = frequency if key is None else key
+        with self.lock:
+            voice = self.find_voice(key)
+            self.keys[voice] = key
+            self.frequencies[voice] = frequency
+            self.velocities[voice] = velocity
+            self.positions[voice] = 0
+            self.start_levels[voice] = self.levels[voice] if self.active[voice] else 0.0
+            self.releases[voice] = -1
+            self.active[voice] = True
+            self.notes_played += 1
+            self.started[voice] = self.notes_played
+            return voice
+
+    def note_off(self, key):
+        """Releases the note with the given key (the frequency if you didn't give a key at note_on)."""
+        with self.lock:
+            for voice, voice_key in enumerate(self.keys):
+                if voice_key == key and self.releases[voice] < 0:
+                    self.releases[voice] = 0
+                    self.release_levels[voice] = self.levels[voice]
+
+    def all_notes_off(self):
+        with self.lock:
+            held = self.active & (self.releases < 0)
+            self.releases[held] = 0
+            self.release_levels[held] = self.levels[held]
+
+    def find_voice(self, key):
+        """The voice for a new note: the voice already playing that key, a free one, or one to steal."""
+        if key in self.keys:
+            return self.keys.index(key)
+        free = numpy.flatnonzero(~self.active)
+        if len(free):
+            return int(free[0])
+        releasing = numpy.flatnonzero(self.releases >= 0)
+        if len(releasing):
+            return int(releasing[numpy.argmin(self.levels[releasing])])
+        return int(numpy.argmin(self.started))
+
+    def render(self, nframes=None):
+        """Renders the next block of nframes (default block_frames) of all voices mixed together, as a float array."""
+        nframes = nframes or self.block_frames
+        with self.lock:
+            voices = numpy.flatnonzero(self.active)
+            if not len(voices):
+                return numpy.zeros(nframes)
+            frames = numpy.arange(nframes)
+            increments = self.frequencies[voices] / self.samplerate
+            phases = self.phases[voices]
+            waves = self.wave((phases[:, numpy.newaxis] + increments[:, numpy.newaxis] * frames) % 1.0)
+            self.phases[voices] = (phases + increments * nframes) % 1.0
+            gains = self.envelopes(voices, frames)
+            self.levels[voices] = gains[:, -1]
+            self.positions[voices] += nframes
+            releasing = voices[self.releases[voices] >= 0]
+            self.releases[releasing] += nframes
+            finished = releasing[self.releases[releasing] >= self.release]
+            self.active[finished] = False
+            self.levels[finished] = 0.0
+            for voice in finished:
+                self.keys[voice] = None
+            return numpy.einsum("vn,vn,v->n", waves, gains, self.velocities[voices] * self.amplitude)
+
+    def render_sample(self, nframes=None):
+        """Renders the next block of nframes (default block_frames) as a mono floating-point Sample."""
+        return Sample.from_array(self.render(nframes).astype(numpy.float32), self.samplerate, 1)
+
+    def blocks(self):
+        """Endless generator of the rendered blocks, as Samples. Silent blocks when no note is playing."""
+        while True:
+            yield self.render_sample()
+
+    def wave(self, phases):
+        """The waveform values for the given phases (in cycles, 0 <= phase < 1)."""
+        if self.waveform == "sine":
+            return numpy.sin(2 * numpy.pi * phases)
+        if self.waveform == "triangle":
+            return 4 * (numpy.abs((phases + 0.75) % 1.0 - 0.5) - 0.25)
+        if self.waveform == "square":
+            return numpy.where(phases < 0.5, 1.0, -1.0)
+        if self.waveform == "sawtooth":
+            return 2 * (phases - numpy.floor(0.5 + phases))
+        return numpy.where(phases < self.pulsewidth, 1.0, -1.0)
+
+    def envelopes(self, voices, frames):
+        """The envelope levels of the given voices for the frames of the next block, shape (voices, frames)."""
+        times = self.positions[voices, numpy.newaxis] + frames
+        start = self.start_levels[voices, numpy.newaxis]
+        sustain = self.sustain_level
+        # attack from the start level to 1, then decay to the sustain level, where it stays
+        gains = numpy.maximum(1 + (sustain - 1) * (times - self.attack) / max(self.decay, 1), sustain)
+        gains = numpy.where(times < self.attack, start + (1 - start) * times / max(self.attack, 1), gains)
+        releases = self.releases[voices]
+        if (releases >= 0).any():
+            release_times = releases[:, numpy.newaxis] + frames
+            released = self.release_levels[voices, numpy.newaxis] * (1 - release_times / max(self.release, 1))
+            gains = numpy.where(releases[:, numpy.newaxis] >= 0, numpy.maximum(released, 0.0), gains)
+        return gains
@@ -0,0 +1,157 @@
+import pytest
+from synthesizer.sample import Sample
+
+numpy = pytest.importorskip("numpy")
+from synthesizer import effects   # noqa: E402
+
+
+def test_effect_default_is_unity_gain():
+    values = numpy.arange(20.0).reshape(10, 2)
+    assert numpy.array_equal(effects.Effect().process(values, 0), values)
+    sample = Sample.from_array(numpy.linspace(-0.5, 0.5, 100, dtype=numpy.float32), 44100, 1)
+    rendered = effects.EffectChain(effects.Gain(0.5), effects.Effect()).render(sample)
+    assert numpy.allclose(rendered.get_frames_numpy()[:, 0], sample.get_frames_numpy()[:, 0] * 0.5)
+
+
+def direct_echos(values, delay, gains):
+    result = values.astype(float)
+    for echo, gain in enumerate(gains, 1):
+        result[echo * delay:] += gain * values[:len(values) - echo * delay]
+    return result
+
+
+@pytest.mark.parametrize("decay", [0.6, -0.5, 1.2])
+def test_echo_delay_line_in_blocks(decay):
+    values = numpy.random.RandomState(1).uniform(-1, 1, (5000, 2))
+    echo = effects.Echo(0.001, decay, 4)
+    echo.set_params(44100, 2, None)
+    result = numpy.concatenate([echo.process(values[offset:offset + 700], offset) for offset in range(0, 5000, 700)])
+    expected = direct_echos(values, echo.delay_frames, [decay ** k for k in range(1, 5)])
+    assert numpy.allclose(result, expected)
+
+
+def test_echo_endless_feedback():
+    values = numpy.zeros((2000, 1))
+    values[0] = 1.0
+    echo = effects.Echo(0.001, 0.5)
+    echo.set_params(44100, 1, None)
+    result = echo.process(values, 0)[:, 0]
+    delay = echo.delay_frames
+    assert numpy.allclose(result[::delay][:10], 0.5 ** numpy.arange(10))
+
+
+@pytest.mark.parametrize("use_numpy", [True, False])
+def test_sample_echo_compounds_the_decay(monkeypatch, use_numpy):
+    import synthesizer.sample
+    if not use_numpy:
+        monkeypatch.setattr(synthesizer.sample, "numpy", None)
+    sample = Sample.from_array([0] * 100 + [10000] + [0] * 99, 1000, 1)
+    sample.echo(0.2, 3, 0.1, 0.5)
+    values = list(numpy.frombuffer(sample.view_frame_data(), dtype=numpy.int16))
+    # the echos of the pulse at 100, every echo is the previous one at half that volume
+    assert len(values) == 500
+    assert [values[100 + 100 * k] for k in range(4)] == [10000, 5000, 1250, 156]
+    assert sum(1 for v in values if v) == 4
+
+
+def direct_biquad(biquad, values, frequencies):
+    # transposed direct form II, one frame at a time, with the coefficients of every chunk of update_frames
+    result = numpy.empty_like(values)
+    s1 = s2 = numpy.zeros(values.shape[1])
+    for frame, x in enumerate(values):
+        b0, b1, b2, a1, a2 = (c[0] for c in biquad.coefficients(numpy.array([frequencies[frame]])))
+        y = b0 * x + s1
+        s1, s2 = s2 - a1 * y + b1 * x, b2 * x - a2 * y
+        result[frame] = y
+    return result
+
+
+@pytest.mark.parametrize("kind", effects.Biquad.kinds)
+def test_biquad_matches_direct_form(kind):
+    values = numpy.random.RandomState(3).uniform(-1, 1, (1000, 2))
+    biquad = effects.Biquad(kind, 2000, q=2.0, gain=6.0)
+    biquad.set_params(44100, 2, None)
+    result = numpy.concatenate([biquad.process(values[offset:offset + 300], offset) for offset in range(0, 1000, 300)])
+    assert numpy.allclose(result, direct_biquad(biquad, values, [2000] * 1000))
+
+
+def test_biquad_frequency_modulation():
+    values = numpy.random.RandomState(4).uniform(-1, 1, (1000, 1))
+    lfo = numpy.sin(numpy.arange(1000) / 100.0) * 0.5
+    biquad = effects.Biquad("lowpass", 3000, fm_lfo=lfo)
+    biquad.set_params(44100, 1, None)
+    result = numpy.concatenate([biquad.process(values[offset:offset + 320], offset) for offset in range(0, 1000, 320)])
+    size = biquad.update_frames
+    frequencies = [3000 * (1 + lfo[frame - frame % size]) for frame in range(1000)]
+    assert numpy.allclose(result, direct_biquad(biquad, values, frequencies))
+
+
+def impulse_response(nframes, nchannels, seed):
+    decay = numpy.exp(-numpy.arange(nframes) / 500.0)[:, numpy.newaxis]
+    values = numpy.random.RandomState(seed).uniform(-1, 1, (nframes, nchannels)) * decay
+    return Sample.from_array(values.astype(numpy.float32).ravel(), 44100, nchannels)
+
+
+@pytest.mark.parametrize("block_frames", [100, 1024, 5000])
+def test_reverb_matches_convolve(block_frames):
+    values = numpy.random.RandomState(6).uniform(-1, 1, (12000, 1))
+    ir = impulse_response(3000, 1, 7)
+    reverb = effects.ConvolutionReverb(ir, wet=0.5, dry=0.8, partition_frames=1024)
+    reverb.set_params(44100, 1, None)
+    result = numpy.concatenate([reverb.process(values[offset:offset + block_frames], offset)
+                                for offset in range(0, len(values), block_frames)])
+    ir_values = ir.get_frames_numpy()[:, 0].astype(float)
+    expected = 0.8 * values[:, 0] + 0.5 * numpy.convolve(values[:, 0], ir_values)[:len(values)]
+    assert numpy.allclose(result[:, 0], expected)
+
+
+def test_stereo_reverb_of_mono_sound():
+    values = numpy.random.RandomState(8).uniform(-1, 1, (4000, 1))
+    ir = impulse_response(1500, 2, 9)
+    reverb = effects.ConvolutionReverb(ir, wet=1.0, dry=0.0, partition_frames=512)
+    reverb.set_params(44100, 1, None)
+    result = reverb.process(values, 0)
+    assert result.shape == (4000, 2)
+    ir_values = ir.get_frames_numpy().astype(float)
+    for channel in range(2):
+        assert numpy.allclose(result[:, channel], numpy.convolve(values[:, 0], ir_values[:, channel])[:4000])
+
+
+@pytest.mark.parametrize("decay", [0.7, -0.6, 1.1])
+def test_sample_echo_numpy_matches_fallback(monkeypatch, decay):
+    import synthesizer.sample
+    # times that are exact in binary, so that the fallback (which works in seconds) puts the echos on the same frames
+    values = numpy.random.RandomState(10).randint(-2000, 2000, 1024).tolist()
+    with_numpy = Sample.from_array(values, 1024, 1).echo(0.5, 6, 0.125, decay)
+    monkeypatch.setattr(synthesizer.sample, "numpy", None)
+    fallback = Sample.from_array(values, 1024, 1).echo(0.5, 6, 0.125, decay)
+    expected = numpy.frombuffer(fallback.view_frame_data(), dtype=numpy.int16).astype(int)
+    result = numpy.frombuffer(with_numpy.view_frame_data(), dtype=numpy.int16).astype(int)
+    assert len(result) == len(expected)
+    # the fallback truncates every echo it amplifies, and that error is amplified again with the next echos
+    assert numpy.max(numpy.abs(result - expected)) <= 2 + 2 * sum(abs(decay) ** (k * (k + 1) / 2) for k in range(1, 7))
+
+
+def test_fused_gains_match_effects_one_after_another():
+    values = numpy.random.RandomState(11).uniform(-0.5, 0.5, 50000).astype(numpy.float32)
+    sample = Sample.from_array(values, 10000, 1)
+    lfo = numpy.sin(numpy.arange(30000) / 1000.0)     # shorter than the sound: the last value is kept
+
+    def make_effects():
+        return [effects.Fade(0.5, 1.0, 0.1), effects.Envelope(0.2, 0.3, 0.6, 0.8), effects.Pan(lfo=lfo), effects.Gain(0.9)]
+
+    fused = effects.EffectChain(*make_effects()).render(sample)
+    one_by_one = sample
+    for effect in make_effects():
+        one_by_one = effects.EffectChain(effect).render(one_by_one)
+    assert fused.nchannels == one_by_one.nchannels == 2
+    result = fused.get_frames_numpy()
+    assert numpy.allclose(result, one_by_one.get_frames_numpy(), atol=1e-6)
+    panning = numpy.concatenate((lfo, numpy.full(20000, lfo[-1])))
+    assert numpy.allclose(result[:, 1] * (1 - panning), result[:, 0] * (1 + panning), atol=1e-6)
+    # the same chain as a filter on a stream, block by block
+    chain = effects.EffectChain(*make_effects(), duration=5.0)
+    chain.set_params(3000, 10000, 4, 1)
+    blocks = [chain(Sample.from_array(values[offset:offset + 3000], 10000, 1)) for offset in range(0, 50000, 3000)]
+    streamed = numpy.concatenate([block.get_frames_numpy() for block in blocks])
+    assert numpy.allclose(streamed, result, atol=1e-6)
@@ -0,0 +1,59 @@
+import array
+import audioop
+import os
+import subprocess
+import sys
+import wave
+from synthesizer.sample import Sample, Output, VirtualClockDevice
+
+
+def test_import_without_audio_libraries():
+    # sample must be importable without pyaudio and winsound, to use the virtual output device on a server
+    code = ("import sys; sys.modules['pyaudio'] = None; sys.modules['winsound'] = None\n"
+            "import synthesizer.sample as sample\n"
+            "assert sample.pyaudio is None and sample.winsound is None\n"
+            "out = sample.Output(device=sample.VirtualClockDevice(speed=100))\n"
+            "assert out.supports_streaming\n"
+            "out.close()\n")
+    subprocess.check_call([sys.executable, "-c", code], cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def test_virtual_device_writes_the_played_audio(tmpdir):
+    filename = str(tmpdir.join("out.wav"))
+    device = VirtualClockDevice(speed=100, filename=filename)
+    sample = Sample.from_array([1000, -1000] * 5000, 44100, 2)
+    with Output(44100, 2, 2, device=device) as out:
+        out.play_sample(sample)
+    with wave.open(filename) as w:
+        assert (w.getnchannels(), w.getsampwidth(), w.getframerate()) == (2, 2, 44100)
+        frames = w.readframes(w.getnframes())
+    assert sample.view_frame_data() in frames
+
+
+def test_play_samples_of_all_widths(tmpdir):
+    samples = []
+    for width in (2, 3, 4):
+        filename = str(tmpdir.join("in{:d}.wav".format(width)))
+        with wave.open(filename, "wb") as w:
+            w.setparams((1, width, 44100, 0, "NONE", "not compressed"))
+            w.writeframes(audioop.lin2lin(array.array("h", [0, 3000, -3000, 6000] * 1000).tobytes(), 2, width))
+        samples.append(Sample(filename))
+    filename = str(tmpdir.join("out.wav"))
+    device = VirtualClockDevice(speed=100, filename=filename)
+    with Output(44100, 2, 2, device=device) as out:
+        out.play_samples(samples)
+    with wave.open(filename) as w:
+        assert w.getnframes() >= 3 * 4000
+
+
+def test_close_finishes_the_output_file(tmpdir, monkeypatch):
+    # only through Output: closing it must play everything and finish the wav file of the virtual device
+    filename = str(tmpdir.join("out.wav"))
+    monkeypatch.setenv("SYNTHESIZER_OUTPUT", "virtual:50:" + filename)
+    sample = Sample.from_array([2000, -2000] * 3000, 44100, 2)
+    with Output(44100, 2, 2) as out:
+        out.play_sample(sample, True)
+    with wave.open(filename) as w:
+        assert w.getnframes() >= len(sample)
+        frames = w.readframes(w.getnframes())
+    assert sample.view_frame_data() in frames
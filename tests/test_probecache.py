@@ -0,0 +1,77 @@
+import os
+import sqlite3
+import subprocess
+import sys
+import pytest
+from synthesizer.probecache import FormatProbeCache, AudioFormatProbe
+
+
+probe = AudioFormatProbe(44100, 2, "16", "mp3", 123.4)
+
+
+def make_file(tmpdir, name, content=b"data"):
+    filename = str(tmpdir.join(name))
+    with open(filename, "wb") as f:
+        f.write(content)
+    return filename
+
+
+def test_cache_get_put(tmpdir):
+    cache = FormatProbeCache()
+    filename = make_file(tmpdir, "track.mp3")
+    assert cache.get(filename) is None
+    cache.put(filename, probe)
+    assert cache.get(filename) == probe
+    make_file(tmpdir, "track.mp3", b"changed data")
+    assert cache.get(filename) is None
+
+
+def test_cache_is_bounded(tmpdir):
+    cache = FormatProbeCache()
+    cache.max_entries = 3
+    filenames = [make_file(tmpdir, "track{}.mp3".format(i)) for i in range(5)]
+    for filename in filenames[:3]:
+        cache.put(filename, probe)
+    cache.get(filenames[0])     # now the most recently used one
+    cache.put(filenames[3], probe)
+    cache.put(filenames[4], probe)
+    assert len(cache.probes) == 3
+    assert [cache.get(filename) is not None for filename in filenames] == [True, False, False, True, True]
+
+
+def test_no_audio_output_imports():
+    code = "import sys, synthesizer.probecache; assert 'synthesizer.sample' not in sys.modules"
+    subprocess.check_call([sys.executable, "-c", code], cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def test_database_cache(tmpdir):
+    musicfiledb = pytest.importorskip("jukebox.musicfiledb")
+    dbfile = str(tmpdir.join("tracks.sqlite"))
+    filename = make_file(tmpdir, "track.mp3")
+    cache = musicfiledb.FormatProbeDatabase(dbfile)
+    cache.put(filename, probe)
+    cache.close()
+    cache = musicfiledb.FormatProbeDatabase(dbfile)
+    assert cache.get(filename) == probe
+    cache.close()
+
+
+def test_locked_database_falls_back(tmpdir):
+    musicfiledb = pytest.importorskip("jukebox.musicfiledb")
+    dbfile = str(tmpdir.join("tracks.sqlite"))
+    filenames = [make_file(tmpdir, "track{}.mp3".format(i)) for i in range(2)]
+    cache = musicfiledb.FormatProbeDatabase(dbfile)
+    cache.dbconn.execute("PRAGMA busy_timeout=100")
+    cache.put(filenames[0], probe)
+    cache.probes.clear()
+    other = sqlite3.connect(dbfile)
+    other.execute("BEGIN EXCLUSIVE")    # another process (the backend) holds a lock on the database
+    try:
+        assert cache.get(filenames[0]) is None
+        cache.put(filenames[1], probe)
+        assert cache.get(filenames[1]) == probe
+    finally:
+        other.rollback()
+        other.close()
+    assert cache.get(filenames[0]) == probe
+    cache.close()
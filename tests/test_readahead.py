@@ -0,0 +1,121 @@
+import threading
+import time
+from synthesizer.streaming import ReadAheadReader, SampleStream, PrefetchedWavStream
+
+
+class SlowReader:
+    """Fake wav reader that produces numbered 16 bits mono frames, and can be slowed down."""
+    def __init__(self, nframes, delay=0.0):
+        self.frames = bytes(i % 251 for i in range(nframes * 2))
+        self.position = 0
+        self.delay = delay
+        self.closed = False
+        self.reading = threading.Event()
+
+    def getsampwidth(self):
+        return 2
+
+    def getframerate(self):
+        return 44100
+
+    def getnchannels(self):
+        return 1
+
+    def readframes(self, nframes):
+        assert not self.closed, "read from a closed source"
+        self.reading.set()
+        time.sleep(self.delay)
+        result = self.frames[self.position:self.position + nframes * 2]
+        self.position += len(result)
+        return result
+
+    def close(self):
+        self.closed = True
+
+
+def wait_until_read(reader, nframes):
+    deadline = time.time() + 5
+    while reader.buffered_frames < nframes and time.time() < deadline:
+        time.sleep(0.01)
+
+
+def test_reads_all_frames_in_order():
+    source = SlowReader(10000)
+    reader = ReadAheadReader(source, 1000, 12)
+    wait_until_read(reader, 10000)
+    result = b""
+    while True:
+        # odd sized reads that span the blocks
+        frames = reader.readframes(777)
+        if not frames:
+            break
+        assert isinstance(frames, bytes)
+        result += frames
+    assert result == source.frames
+    assert reader.underruns == 0
+    reader.close()
+
+
+def test_first_read_waits_for_the_first_fill():
+    source = SlowReader(4000, delay=0.1)
+    reader = ReadAheadReader(source, 1000, 4)
+    assert reader.readframes(1000) == source.frames[:2000]
+    assert reader.underruns == 0
+    reader.close()
+
+
+def test_underrun_pads_with_silence():
+    source = SlowReader(4000, delay=0.1)
+    reader = ReadAheadReader(source, 1000, 4)
+    reader.readframes(1000)
+    assert reader.readframes(1000) == bytes(2000)
+    assert reader.underruns == 1
+    reader.close()
+
+
+def test_close_waits_for_the_reader_thread():
+    source = SlowReader(100000, delay=0.2)
+    reader = ReadAheadReader(source, 1000, 4)
+    source.reading.wait()
+    reader.close()      # the source read in progress must finish before the source is closed
+    assert source.closed
+    assert not reader._thread.is_alive()
+
+
+def test_sample_stream_readahead():
+    source = SlowReader(5000)
+    stream = SampleStream(source, 1000, readahead=8)
+    wait_until_read(stream.source, 5000)
+    samples = list(iter(stream.__next__, None))
+    assert b"".join(sample.view_frame_data() for sample in samples) == source.frames
+    assert stream.underruns == 0
+    stream.close()
+
+
+class SlowStream:
+    """Fake byte stream that is slow to read, and remembers if it was closed during a read."""
+    def __init__(self, delay):
+        self.delay = delay
+        self.closed = False
+        self.closed_while_reading = False
+        self.reading = threading.Event()
+
+    def read(self, size):
+        self.reading.set()
+        time.sleep(self.delay)
+        if self.closed:
+            self.closed_while_reading = True
+        return bytes(size)
+
+    def close(self):
+        self.closed = True
+
+
+def test_prefetch_close_waits_for_the_prefetch_thread():
+    source = SlowStream(0.2)
+    stream = PrefetchedWavStream(source, prefetch_size=1024*1024)
+    source.reading.wait()
+    stream.close()
+    assert source.closed
+    assert not stream.thread.is_alive()
+    assert not source.closed_while_reading
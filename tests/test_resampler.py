@@ -0,0 +1,26 @@
+import pytest
+
+numpy = pytest.importorskip("numpy")
+from synthesizer.resampler import Resampler   # noqa: E402
+
+
+@pytest.mark.parametrize("from_rate, to_rate", [(44100, 48000), (48000, 44100), (22050, 44100), (44100, 44100 * 1.0137)])
+def test_streaming_matches_one_shot(from_rate, to_rate):
+    values = numpy.random.RandomState(5).uniform(-1, 1, (10000, 2))
+    expected = Resampler(from_rate, to_rate, 2).resample(values)
+    resampler = Resampler(from_rate, to_rate, 2)
+    sizes = [1, 999, 2000, 3, 997, 5000, 1000]
+    offsets = numpy.cumsum([0] + sizes)
+    blocks = [resampler.process(values[offset:offset + size]) for offset, size in zip(offsets, sizes)]
+    blocks.append(resampler.flush())
+    streamed = numpy.concatenate(blocks)
+    assert streamed.shape == expected.shape
+    assert numpy.allclose(streamed, expected)
+    assert len(expected) == -(-10000 * resampler.up // resampler.down)
+
+
+def test_resampled_sine():
+    values = numpy.sin(2 * numpy.pi * 1000 * numpy.arange(44100) / 44100)
+    result = Resampler(44100, 48000, 1).resample(values[:, numpy.newaxis])[:, 0]
+    ideal = numpy.sin(2 * numpy.pi * 1000 * numpy.arange(len(result)) / 48000)
+    assert numpy.max(numpy.abs(result - ideal)[1000:-1000]) < 1e-3
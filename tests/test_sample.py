@@ -0,0 +1,55 @@
+import audioop
+import pytest
+from synthesizer.sample import Sample
+
+
+def test_float_to_32bit_full_scale():
+    numpy = pytest.importorskip("numpy")
+    sample = Sample.from_array(numpy.array([1.0, -1.0, 2.0, 0.5], dtype=numpy.float32), 44100, 1)
+    values = numpy.frombuffer(sample.make_32bit().view_frame_data(), dtype=numpy.int32)
+    assert list(values) == [2**31 - 1, -2**31, 2**31 - 1, 2**30]
+
+
+def random_stereo(samplewidth, seed):
+    numpy = pytest.importorskip("numpy")
+    maxvalue = 2 ** (8 * samplewidth - 1)
+    values = numpy.random.RandomState(seed).randint(-maxvalue, maxvalue, 2000)
+    values[:4] = [maxvalue - 1, -maxvalue, -maxvalue, maxvalue - 1]    # extremes, to check the clipping
+    frames = values.astype(numpy.int32).tobytes()
+    if samplewidth != 4:
+        frames = audioop.lin2lin(audioop.mul(frames, 4, 1.0 / 2 ** (32 - 8 * samplewidth)), 4, samplewidth)
+    return Sample.from_raw_frames(frames, samplewidth, 44100, 2)
+
+
+@pytest.mark.parametrize("samplewidth", [2, 3])
+@pytest.mark.parametrize("operation", [
+    lambda s: s.stereo(0.3, 0.8),
+    lambda s: s.balance(-0.4),
+    lambda s: s.balance(0.7),
+    lambda s: s.stereo_width(0),
+    lambda s: s.stereo_width(0.5),
+    lambda s: s.stereo_width(1),
+    lambda s: s.stereo_width(1.7),
+    lambda s: s.stereo_width(3),
+    lambda s: s.swap_channels(),
+])
+def test_channel_operations_match_the_fallback(monkeypatch, samplewidth, operation):
+    import synthesizer.sample
+    sample = random_stereo(samplewidth, 12)
+    with_numpy = operation(sample.copy()).view_frame_data().tobytes()
+    monkeypatch.setattr(synthesizer.sample, "numpy", None)
+    fallback = operation(sample.copy()).view_frame_data().tobytes()
+    assert with_numpy == fallback
+
+
+@pytest.mark.parametrize("nchannels", [1, 2])
+def test_pan_lfo_matches_the_fallback(monkeypatch, nchannels):
+    import synthesizer.sample
+    sample = random_stereo(2, 13)
+    if nchannels == 1:
+        sample.mono(0.5, 0.5)
+    lfo = [((i % 200) - 100) / 100 for i in range(len(sample))]
+    with_numpy = sample.copy().pan(lfo=lfo).view_frame_data().tobytes()
+    monkeypatch.setattr(synthesizer.sample, "numpy", None)
+    fallback = sample.copy().pan(lfo=lfo).view_frame_data().tobytes()
+    assert with_numpy == fallback
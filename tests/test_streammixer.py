@@ -0,0 +1,106 @@
+import pytest
+from synthesizer.sample import Sample
+from synthesizer.streaming import StreamMixer
+
+
+def make_sample(nframes, value=1000):
+    return Sample.from_array([value] * nframes, 44100, 1)
+
+
+def test_empty_mix_goes_on_with_silence():
+    mixer = StreamMixer([], nchannels=1)
+    mixer.buffer_size = 1000
+    mixed = iter(mixer)
+    for block in range(3):
+        timestamp, sample = next(mixed)
+        assert len(sample) == 1000
+        assert sample.view_frame_data() == bytes(2000)
+    assert timestamp == 2000 / 44100
+
+
+def test_scheduled_actions_run_without_streams():
+    mixer = StreamMixer([], nchannels=1)
+    mixer.buffer_size = 1000
+    ran_at = []
+    mixer.schedule_at(2500, lambda: ran_at.append(mixer._position))
+    mixed = iter(mixer)
+    for block in range(4):
+        next(mixed)
+    assert ran_at == [2500]
+
+
+def test_scheduled_sample_starts_at_its_frame():
+    mixer = StreamMixer([], nchannels=1)
+    mixer.buffer_size = 1000
+    mixer.add_sample(make_sample(300))
+    mixer.schedule_at(1700, lambda: mixer.add_sample(make_sample(500, 2000)))
+    mixed = iter(mixer)
+    frames = b"".join(next(mixed)[1].view_frame_data() for block in range(3))
+    values = Sample.from_raw_frames(frames, 2, 44100, 1).get_frame_array()
+    assert len(values) == 3000
+    assert list(values[:300]) == [1000] * 300
+    assert list(values[300:1700]) == [0] * 1400
+    assert list(values[1700:2200]) == [2000] * 500
+    assert list(values[2200:]) == [0] * 800
+
+
+def test_add_float_sample_to_float_mix():
+    numpy = pytest.importorskip("numpy")
+    mixer = StreamMixer([], nchannels=1, is_float=True)
+    mixer.buffer_size = 1000
+    mixer.add_sample(Sample.from_array(numpy.full(1000, 1.5, dtype=numpy.float32), 44100, 1))
+    timestamp, sample = next(iter(mixer))
+    assert sample.is_float
+    assert numpy.all(numpy.frombuffer(sample.view_frame_data(), dtype=numpy.float32) == 1.5)
+
+
+def test_add_float_sample_to_integer_mix():
+    numpy = pytest.importorskip("numpy")
+    mixer = StreamMixer([], nchannels=1)
+    mixer.buffer_size = 1000
+    mixer.add_sample(Sample.from_array(numpy.array([0.5, -1.0, 1.0, 0.0] * 250, dtype=numpy.float32), 44100, 1))
+    timestamp, sample = next(iter(mixer))
+    assert not sample.is_float and sample.samplewidth == 2
+    assert list(numpy.frombuffer(sample.view_frame_data(), dtype=numpy.int16)[:4]) == [16384, -32768, 32767, 0]
+
+
+class KeepingFilter:
+    # a filter that returns its own sample, which it keeps using afterwards
+    def __init__(self):
+        self.sample = make_sample(1000, 500)
+
+    def set_params(self, buffer_size, samplerate, samplewidth, nchannels):
+        pass
+
+    def __call__(self, sample):
+        return self.sample
+
+
+def test_samples_of_filters_are_not_released():
+    mixer = StreamMixer([], nchannels=1)
+    mixer.buffer_size = 1000
+    keeping_filter = KeepingFilter()
+    stream = mixer.add_sample(make_sample(3000))
+    stream.add_filter(keeping_filter)
+    mixer.add_sample(make_sample(3000, 1))
+    mixed = iter(mixer)
+    for block in range(2):
+        timestamp, sample = next(mixed)
+        assert sample.view_frame_data() == make_sample(1000, 501).view_frame_data()
+    assert keeping_filter.sample.view_frame_data() == make_sample(1000, 500).view_frame_data()
+    assert sample is not keeping_filter.sample
+
+
+def test_samples_of_filters_are_not_changed():
+    pytest.importorskip("numpy")
+    mixer = StreamMixer([], nchannels=1, is_float=True)
+    mixer.buffer_size = 1000
+    keeping_filter = KeepingFilter()
+    keeping_filter.sample.lock()
+    stream = mixer.add_sample(make_sample(3000))
+    stream.add_filter(keeping_filter)
+    mixer.crossfade(None, stream, 1000 / 44100)    # a fade in, over the first block
+    timestamp, sample = next(iter(mixer))
+    assert sample.is_float
+    assert keeping_filter.sample.view_frame_data() == make_sample(1000, 500).view_frame_data()
+    assert not keeping_filter.sample.is_float
@@ -0,0 +1,65 @@
+import itertools
+import math
+import pytest
+from synthesizer import synth
+
+
+def test_biquad_filter_follows_the_lfo_across_blocks():
+    numpy = pytest.importorskip("numpy")
+    from synthesizer.effects import Biquad
+    lfo = numpy.linspace(-0.5, 0.5, 5000)
+    filtered = synth.BiquadFilter(synth.FastSine(440), "lowpass", 2000, fm_lfo=lfo)
+    result = list(itertools.islice(iter(filtered), 5000))
+    biquad = Biquad("lowpass", 2000, fm_lfo=lfo)
+    biquad.set_params(synth.Sample.norm_samplerate, 1, None)
+    source = numpy.array(list(itertools.islice(iter(synth.FastSine(440)), 5000)))
+    expected = biquad.process(source[:, numpy.newaxis], 0)[:, 0]
+    assert numpy.allclose(result, expected)
+
+
+def envelope_values(*args, **kwargs):
+    return list(itertools.islice(iter(synth.EnvelopeFilter(synth.Linear(1.0, samplerate=100), *args, **kwargs)), 60))
+
+
+def test_envelope_phases():
+    values = envelope_values(0.1, 0.1, 0.2, 0.5, 0.1, stop_at_end=True)
+    assert len(values) == 50
+    assert values[:10] == [i / 10 for i in range(10)]
+    assert values[10:20] == pytest.approx([1.0 - 0.05 * i for i in range(10)])
+    assert values[20:40] == [0.5] * 20
+    assert values[40:] == pytest.approx([0.5 - 0.05 * i for i in range(10)])
+    assert envelope_values(0.1, 0.1, 0.2, 0.5, 0.1) == values + [0.0] * 10
+    assert envelope_values(0.1, 0.1, 0.1, 0.5, 0.1, cycle=True) == values[:30] + values[40:] + values[:20]
+
+
+def test_envelope_cache_is_bounded(monkeypatch):
+    monkeypatch.setattr(synth.EnvelopeFilter, "max_cached_frames", 250)
+    monkeypatch.setattr(synth.EnvelopeFilter, "_ramps_cache", synth.collections.OrderedDict())
+    monkeypatch.setattr(synth.EnvelopeFilter, "_cached_frames", 0)
+    for attack in range(1, 10):
+        envelope_values(attack / 10, 0.1, 1000, 0.5, 0.1)
+    assert synth.EnvelopeFilter._cached_frames <= 250
+    assert sum(len(a) + len(d) + len(r) for a, d, s, r in synth.EnvelopeFilter._ramps_cache.values()) == \
+        synth.EnvelopeFilter._cached_frames
+    assert 1 < len(synth.EnvelopeFilter._ramps_cache) < 9
+
+
+def reference_echos(values, after, amount, delay, decay):
+    # the source itself, with from the 'after' frame on, the delayed and decayed copies of the rest mixed in
+    rest = values[after:]
+    echoed = list(rest)
+    for echo in range(1, amount + 1):
+        for frame in range(echo * delay, len(rest)):
+            echoed[frame] += decay ** echo * rest[frame - echo * delay]
+    return values[:after] + echoed
+
+
+@pytest.mark.parametrize("amount, decay", [(3, 0.6), (1000, 0.6), (4, 1.2), (0, 0.5)])
+def test_echo_filter(amount, decay):
+    values = [math.sin(i * 0.37) + 0.3 * math.cos(i * 1.9) for i in range(400)]
+    filtered = synth.EchoFilter(synth.Oscillator(values, samplerate=100), 0.1, amount, 0.05, decay)
+    if amount == 1000:
+        # without a practical limit, the amount is limited to the echos that are still audible
+        assert filtered._amount == int(math.log(0.000001, decay))
+    expected = reference_echos(values, 10, filtered._amount, 5, decay)
+    assert list(iter(filtered)) == pytest.approx(expected, abs=1e-9)
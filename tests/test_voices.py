@@ -0,0 +1,72 @@
+import pytest
+
+numpy = pytest.importorskip("numpy")
+from synthesizer.voices import VoiceEngine   # noqa: E402
+
+
+def test_sine_voice():
+    engine = VoiceEngine(voices=4, samplerate=8000, amplitude=0.5, attack=0, decay=0, sustain_level=1.0)
+    engine.note_on(440, velocity=0.5)
+    result = numpy.concatenate([engine.render(300), engine.render(700)])
+    assert numpy.allclose(result, 0.25 * numpy.sin(2 * numpy.pi * 440 * numpy.arange(1000) / 8000))
+
+
+def test_blocks_join_up():
+    def render(sizes):
+        engine = VoiceEngine(samplerate=8000, waveform="sawtooth", attack=0.01, decay=0.02, release=0.05)
+        engine.note_on(300)
+        engine.note_on(500, velocity=0.7)
+        blocks = []
+        for number, size in enumerate(sizes):
+            if number == 2:
+                engine.note_off(300)
+            blocks.append(engine.render(size))
+        return numpy.concatenate(blocks)
+    assert numpy.allclose(render([100, 100, 100, 700]), render([100, 100, 350, 450]))
+
+
+def test_envelope_and_release():
+    engine = VoiceEngine(voices=2, samplerate=1000, waveform="square", amplitude=1.0,
+                         attack=0.01, decay=0.01, sustain_level=0.5, release=0.02)
+    engine.note_on(250, key="a")
+    result = engine.render(30)
+    envelope = numpy.abs(result)
+    assert numpy.allclose(envelope[:10], numpy.arange(10) / 10)
+    assert numpy.allclose(envelope[10:20], 1 - 0.05 * numpy.arange(10))
+    assert numpy.allclose(envelope[20:], 0.5)
+    engine.note_off("a")
+    assert engine.active_voices == 1
+    released = numpy.abs(engine.render(30))
+    assert numpy.allclose(released[:20], 0.5 * (1 - numpy.arange(20) / 20))
+    assert not released[20:].any()
+    assert engine.active_voices == 0
+    assert not engine.render(10).any()
+
+
+def test_voice_stealing():
+    engine = VoiceEngine(voices=3, samplerate=1000, attack=0, decay=0, sustain_level=1.0, release=0.1)
+    assert [engine.note_on(f) for f in (100, 200, 300)] == [0, 1, 2]
+    assert engine.note_on(200) == 1     # retriggered on its own voice
+    assert engine.note_on(400) == 0     # the oldest note is taken when none is releasing
+    engine.render(10)
+    engine.note_off(300)
+    engine.render(10)
+    engine.note_off(400)
+    engine.render(10)
+    assert engine.note_on(500) == 2     # the quietest releasing voice, the one that was released first
+    assert engine.active_voices == 3
+    engine.all_notes_off()
+    engine.render(100)
+    assert engine.active_voices == 0
+    assert engine.keys == [None] * 3
+
+
+def test_render_sample():
+    engine = VoiceEngine(samplerate=8000, waveform="triangle", block_frames=500)
+    engine.note_on(440)
+    sample = engine.render_sample()
+    assert sample.is_float and len(sample) == 500 and sample.samplerate == 8000 and sample.nchannels == 1
+    blocks = engine.blocks()
+    assert len(next(blocks)) == 500
+    with pytest.raises(ValueError):
+        VoiceEngine(waveform="organ")
@@ -0,0 +1,40 @@
+import struct
+import pytest
+from synthesizer.streaming import WavConversionStream
+
+numpy = pytest.importorskip("numpy")
+
+
+def write_float_wav(filename, values):
+    data = numpy.array(values, dtype="<f4").tobytes()
+    header = WavConversionStream.wav_header(WavConversionStream.WAVE_FORMAT_IEEE_FLOAT, 44100, 1, 4, len(data))
+    with open(filename, "wb") as f:
+        f.write(header + data)
+
+
+def convert(filename, sampleformat):
+    wav_format = WavConversionStream.read_format(filename)
+    stream = WavConversionStream(filename, wav_format, sampleformat=sampleformat)
+    data = stream.read()
+    stream.close()
+    return data[44:]
+
+
+@pytest.mark.parametrize("sampleformat, dtype, full_scale", [("16", "<i2", 2**15 - 1), ("32", "<i4", 2**31 - 1)])
+def test_float_full_scale(tmpdir, sampleformat, dtype, full_scale):
+    filename = str(tmpdir.join("float.wav"))
+    write_float_wav(filename, [1.0, 0.99999999, -1.0, 0.5, 0.0, 2.0, -2.0])
+    values = numpy.frombuffer(convert(filename, sampleformat), dtype=dtype)
+    assert values[0] == values[1] == values[5] == full_scale
+    assert values[2] == values[6] <= -full_scale
+    assert abs(values[3] - full_scale / 2) <= 1
+    assert values[4] == 0
+
+
+def test_float_header(tmpdir):
+    filename = str(tmpdir.join("float.wav"))
+    write_float_wav(filename, [0.25, -0.25])
+    wav_format = WavConversionStream.read_format(filename)
+    assert wav_format.formatcode == WavConversionStream.WAVE_FORMAT_IEEE_FLOAT
+    assert (wav_format.rate, wav_format.channels, wav_format.samplewidth, wav_format.data_size) == (44100, 1, 4, 8)
+    assert struct.unpack("<2f", convert(filename, "float")) == (0.25, -0.25)
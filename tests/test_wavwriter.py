@@ -0,0 +1,54 @@
+import struct
+import wave
+from synthesizer.sample import StreamingWavWriter
+
+
+def test_small_file_is_a_normal_wav(tmpdir, monkeypatch):
+    monkeypatch.setattr(StreamingWavWriter, "buffer_size", 1000)   # to make it write the buffer several times
+    filename = str(tmpdir.join("out.wav"))
+    frames = bytes(range(256)) * 100
+    with StreamingWavWriter(filename, 44100, 2, 2) as writer:
+        for offset in range(0, len(frames), 333):
+            writer.write(frames[offset:offset + 333])
+    with wave.open(filename) as w:
+        assert (w.getnchannels(), w.getsampwidth(), w.getframerate()) == (2, 2, 44100)
+        assert w.readframes(w.getnframes()) == frames
+    with open(filename, "rb") as f:
+        data = f.read()
+    assert data[:4] == b"RIFF" and struct.unpack("<I", data[4:8])[0] == len(data) - 8
+    assert data[12:16] == b"JUNK"
+
+
+def test_odd_data_size_is_padded(tmpdir):
+    filename = str(tmpdir.join("out.wav"))
+    with StreamingWavWriter(filename, 8000, 1, 1) as writer:
+        writer.write(b"\x80" * 101)
+    with open(filename, "rb") as f:
+        data = f.read()
+    assert len(data) % 2 == 0
+    assert struct.unpack("<I", data[4:8])[0] == len(data) - 8
+    with wave.open(filename) as w:
+        assert w.getnframes() == 101
+
+
+def test_rf64_header(tmpdir):
+    filename = str(tmpdir.join("out.wav"))
+    writer = StreamingWavWriter(filename, 48000, 3, 2)
+    writer.write(bytes(600))
+    data_offset = writer.data_offset
+    writer.data_size = 5 * 2 ** 32 + 600   # pretend it has grown beyond 4 Gb, without writing all of that
+    writer.close()
+    with open(filename, "rb") as f:
+        header = f.read(data_offset)
+    riff, riff_size, wave_id = struct.unpack("<4sI4s", header[:12])
+    assert (riff, riff_size, wave_id) == (b"RF64", 0xffffffff, b"WAVE")
+    chunk, chunk_size, ds64_riff_size, ds64_data_size, ds64_frames, table_size = struct.unpack("<4sIQQQI", header[12:48])
+    assert (chunk, chunk_size) == (b"ds64", 28)
+    assert ds64_riff_size == data_offset - 8 + 5 * 2 ** 32 + 600
+    assert ds64_data_size == 5 * 2 ** 32 + 600
+    assert ds64_frames == ds64_data_size // 6
+    assert table_size == 0
+    fmt = struct.unpack("<4sIHHIIHH", header[48:72])
+    assert fmt == (b"fmt ", 16, 1, 2, 48000, 48000 * 6, 6, 24)
+    assert struct.unpack("<4sI", header[72:80]) == (b"data", 0xffffffff)
+    assert data_offset == 80